@@ -1,31 +1,43 @@
+import asyncio
+import json
 import logging
 import os
-from typing import List
+from typing import AsyncGenerator, List, Optional
 
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, status
-from llama_index.core.chat_engine.types import BaseChatEngine, NodeWithScore
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from llama_index.core.chat_engine.types import NodeWithScore
 from llama_index.core.llms import MessageRole
 from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
-from llama_index.storage.chat_store.redis import RedisChatStore
 
 from app.api.routers.events import EventCallbackHandler
 from app.api.routers.models import (
+    BatchChatData,
     ChatConfig,
     ChatData,
     Message,
     Result,
     SourceNodes,
+    SuggestionsData,
 )
 from app.api.routers.vercel_response import VercelStreamResponse
 from app.api.services.llama_cloud import LLamaCloudFileService
+from app.api.services.suggestion import NextQuestionSuggestion
 from app.engine import get_chat_engine
+from app.engine.chat_store import get_chat_store
+from app.engine.semantic_cache import CacheLookup, get_semantic_cache
+from app.engine.single_flight import get_single_flight
+from app.embedding_cache import aprefetch_query_embeddings
+from app.llm_gateway import BATCH, use_llm_priority
 
 chat_router = r = APIRouter()
 
 logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 logger = logging.getLogger("uvicorn")
 
-chat_store = RedisChatStore(redis_url=os.getenv("REDIS_URL"), ttl=300)
+# Items of a batch answered at the same time; keep it below LLM_QUEUE_BATCH_SIZE
+CHAT_BATCH_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+
 
 def process_response_nodes(
     nodes: List[NodeWithScore],
@@ -47,14 +59,9 @@ async def chat(
     request: Request,
     data: ChatData,
     background_tasks: BackgroundTasks,
-    chat_engine: BaseChatEngine = Depends(get_chat_engine),
 ):
     try:
-        if chat_store is None:
-            raise HTTPException(
-                status_code=500,
-                detail="Chat store not initialized",
-            )
+        chat_store = get_chat_store()
         user_uuid = data.user_uuid
         last_message_content = data.get_last_message_content()
         messages = data.get_history_messages()
@@ -62,15 +69,44 @@ async def chat(
         # doc_ids = data.get_chat_document_ids()
         # filters = generate_filters(doc_ids)
         # logger.info("Creating chat engine with filters", filters.dict())
-        chat_engine = get_chat_engine(chat_store=chat_store, user_uuid=user_uuid)
-        
+        filters = generate_tenant_filters(data.id_empresa, data.id_unidade)
         event_handler = EventCallbackHandler()
-        chat_engine.callback_manager.handlers.append(event_handler)  # type: ignore
+        chat_engine = get_chat_engine(
+            chat_store=chat_store,
+            filters=filters,
+            user_uuid=user_uuid,
+            handlers=[event_handler],
+        )
+
+        semantic_cache = get_semantic_cache()
+        if semantic_cache is not None:
+            question = await chat_engine.acondense(last_message_content, messages)
+            lookup = await semantic_cache.alookup(question, filters)
+            if lookup.answer is not None:
+                response = await chat_engine.areplay(
+                    last_message_content,
+                    lookup.answer.answer,
+                    lookup.answer.source_nodes,
+                )
+                return VercelStreamResponse(request, event_handler, response, data)
 
-        response = await chat_engine.astream_chat(last_message_content, messages)
+        single_flight = get_single_flight()
+        if single_flight is not None and len(messages) == 0:
+            # Without history the answer only depends on the question, so
+            # identical concurrent questions can share one LLM stream
+            response = await single_flight.astream_chat(
+                chat_engine, last_message_content, filters
+            )
+        else:
+            response = await chat_engine.astream_chat(last_message_content, messages)
         process_response_nodes(response.source_nodes, background_tasks)
+        if semantic_cache is not None and not getattr(response, "is_follower", False):
+            # Runs once the stream is finished, when the full answer is known
+            background_tasks.add_task(store_streamed_answer, lookup, response)
 
         return VercelStreamResponse(request, event_handler, response, data)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception("Error in chat engine", exc_info=True)
         raise HTTPException(
@@ -79,6 +115,11 @@ async def chat(
         ) from e
 
 
+async def store_streamed_answer(lookup: CacheLookup, response):
+    # The response text is only set if the stream was consumed until the end
+    await get_semantic_cache().astore(lookup, response.response, response.source_nodes)
+
+
 def generate_filters(doc_ids):
     if len(doc_ids) > 0:
         filters = MetadataFilters(
@@ -111,25 +152,117 @@ def generate_filters(doc_ids):
     return filters
 
 
+def generate_tenant_filters(
+    id_empresa: Optional[str], id_unidade: Optional[str]
+) -> Optional[MetadataFilters]:
+    """
+    Restrict retrieval to the documents of the tenant, as stamped on the nodes
+    by generate_single_doc. Returns None when the request carries no tenant.
+    """
+    filters = [
+        MetadataFilter(key=key, value=value)
+        for key, value in (("id_empresa", id_empresa), ("id_unidade", id_unidade))
+        if value is not None
+    ]
+    if not filters:
+        return None
+    return MetadataFilters(filters=filters)
+
+
 # non-streaming endpoint - delete if not needed
 @r.post("/request")
 async def chat_request(
     data: ChatData,
-    chat_engine: BaseChatEngine = Depends(get_chat_engine),
 ) -> Result:
+    return await answer_chat_request(data)
+
+
+async def answer_chat_request(data: ChatData) -> Result:
     last_message_content = data.get_last_message_content()
     messages = data.get_history_messages()
     user_uuid = data.user_uuid
+    filters = generate_tenant_filters(data.id_empresa, data.id_unidade)
+
+    chat_engine = get_chat_engine(
+        chat_store=get_chat_store(), filters=filters, user_uuid=user_uuid
+    )
 
-    chat_engine = get_chat_engine(chat_store=chat_store, user_uuid=user_uuid)
+    semantic_cache = get_semantic_cache()
+    if semantic_cache is not None:
+        question = await chat_engine.acondense(last_message_content, messages)
+        lookup = await semantic_cache.alookup(question, filters)
+        if lookup.answer is not None:
+            await chat_engine.aremember(last_message_content, lookup.answer.answer)
+            return Result(
+                result=Message(role=MessageRole.ASSISTANT, content=lookup.answer.answer),
+                nodes=SourceNodes.from_source_nodes(lookup.answer.source_nodes),
+            )
 
     response = await chat_engine.achat(last_message_content, messages)
+    if semantic_cache is not None:
+        await semantic_cache.astore(lookup, response.response, response.source_nodes)
     return Result(
         result=Message(role=MessageRole.ASSISTANT, content=response.response),
         nodes=SourceNodes.from_source_nodes(response.source_nodes),
     )
 
 
+@r.post("/batch")
+async def chat_batch(data: BatchChatData) -> StreamingResponse:
+    """
+    Non-streaming answers for many requests, for offline jobs (evaluations,
+    FAQ precompute). Streams one NDJSON line per item as soon as it is
+    answered, in completion order: {"index", "result"} or {"index", "error"}.
+    The LLM calls wait in the gateway's batch queue, so they are admitted under
+    the same limits as the interactive traffic, after it.
+    """
+    return StreamingResponse(
+        chat_batch_lines(data.items), media_type="application/x-ndjson"
+    )
+
+
+async def chat_batch_lines(items: List[ChatData]) -> AsyncGenerator[str, None]:
+    semaphore = asyncio.Semaphore(CHAT_BATCH_CONCURRENCY)
+
+    async def answer(index: int, item: ChatData) -> dict:
+        async with semaphore:
+            try:
+                result = await answer_chat_request(item)
+                return {"index": index, "result": result.model_dump(mode="json")}
+            except HTTPException as e:
+                error = {"status_code": e.status_code, "detail": e.detail}
+            except Exception as e:
+                logger.exception(f"Erro no item {index} do lote")
+                error = {"status_code": 500, "detail": f"Error in chat engine: {e}"}
+            return {"index": index, "error": error}
+
+    with use_llm_priority(BATCH):
+        # Questions without history are retrieved as-is, so their embeddings
+        # are computed together instead of one call per item
+        await aprefetch_query_embeddings(
+            [item.get_last_message_content() for item in items if len(item.messages) == 1],
+            CHAT_BATCH_CONCURRENCY,
+        )
+        # The tasks inherit the batch priority
+        tasks = [asyncio.create_task(answer(i, item)) for i, item in enumerate(items)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield json.dumps(await next_done, ensure_ascii=False) + "\n"
+    finally:
+        # Client gone: stop the items not answered yet
+        for task in tasks:
+            task.cancel()
+
+
+@r.post("/suggestions")
+async def chat_suggestions(data: SuggestionsData) -> List[str]:
+    """
+    Suggest the next questions for a conversation. Lets the frontend fetch
+    them lazily instead of waiting for them at the end of the chat stream.
+    """
+    return await NextQuestionSuggestion.suggest_next_questions_within(data.messages)
+
+
 @r.get("/config")
 async def chat_config() -> ChatConfig:
     starter_questions = None
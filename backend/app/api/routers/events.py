@@ -91,9 +91,22 @@ class CallbackEvent(BaseModel):
             return None
 
 
+# Only these events are turned into frames, everything else is dropped on arrival
+HANDLED_EVENTS = frozenset(
+    [CBEventType.RETRIEVE, CBEventType.FUNCTION_CALL, CBEventType.AGENT_STEP]
+)
+
+# Marks the end of the event stream in the queue
+_DONE = object()
+
+
 class EventCallbackHandler(BaseCallbackHandler):
+    """
+    Queues the responses of the handled events for the event stream, which
+    waits on the queue until `is_done` is set instead of polling it.
+    """
+
     _aqueue: asyncio.Queue
-    is_done: bool = False
 
     def __init__(
         self,
@@ -108,6 +121,47 @@ class EventCallbackHandler(BaseCallbackHandler):
         ]
         super().__init__(ignored_events, ignored_events)
         self._aqueue = asyncio.Queue()
+        self._is_done = False
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+
+    @property
+    def is_done(self) -> bool:
+        return self._is_done
+
+    @is_done.setter
+    def is_done(self, value: bool):
+        if value and not self._is_done:
+            self._put(_DONE)
+        self._is_done = value
+
+    def _put(self, item: Any):
+        # Sync retrievals run callbacks in a worker thread, which must hand the
+        # item over to the loop for the waiting generator to wake up
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self._loop is None or running_loop is self._loop:
+            self._aqueue.put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._aqueue.put_nowait, item)
+
+    def _handle_event(
+        self,
+        event_type: CBEventType,
+        payload: Optional[Dict[str, Any]],
+        event_id: str,
+    ):
+        if event_type not in HANDLED_EVENTS or self._is_done:
+            return
+        response = CallbackEvent(
+            event_id=event_id, event_type=event_type, payload=payload
+        ).to_response()
+        if response is not None:
+            self._put(response)
 
     def on_event_start(
         self,
@@ -116,9 +170,8 @@ class EventCallbackHandler(BaseCallbackHandler):
         event_id: str = "",
         **kwargs: Any,
     ) -> str:
-        event = CallbackEvent(event_id=event_id, event_type=event_type, payload=payload)
-        if event.to_response() is not None:
-            self._aqueue.put_nowait(event)
+        self._handle_event(event_type, payload, event_id)
+        return event_id
 
     def on_event_end(
         self,
@@ -127,9 +180,7 @@ class EventCallbackHandler(BaseCallbackHandler):
         event_id: str = "",
         **kwargs: Any,
     ) -> None:
-        event = CallbackEvent(event_id=event_id, event_type=event_type, payload=payload)
-        if event.to_response() is not None:
-            self._aqueue.put_nowait(event)
+        self._handle_event(event_type, payload, event_id)
 
     def start_trace(self, trace_id: Optional[str] = None) -> None:
         """No-op."""
@@ -141,9 +192,12 @@ class EventCallbackHandler(BaseCallbackHandler):
     ) -> None:
         """No-op."""
 
-    async def async_event_gen(self) -> AsyncGenerator[CallbackEvent, None]:
-        while not self._aqueue.empty() or not self.is_done:
-            try:
-                yield await asyncio.wait_for(self._aqueue.get(), timeout=0.1)
-            except asyncio.TimeoutError:
-                pass
+    async def async_event_gen(self) -> AsyncGenerator[dict, None]:
+        """
+        Yield the response of each handled event until `is_done` is set.
+        """
+        while True:
+            response = await self._aqueue.get()
+            if response is _DONE:
+                return
+            yield response
@@ -1,81 +1,88 @@
 import logging
-import os
-import psycopg2
-from psycopg2 import sql
+from datetime import datetime, time, timedelta, timezone
+from typing import Optional
 
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from llama_index.storage.chat_store.redis import RedisChatStore
+from fastapi import APIRouter, HTTPException, Query
+from pydantic import BaseModel, Field
 
-from app.engine.chat_cache import *
+from app.engine.chat_store import get_chat_store
+from app.feedback_store import FeedbackQueueFull, get_feedback_store
 
 chat_feedback = r = APIRouter()
 logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 logger = logging.getLogger("uvicorn")
 
-chat_store = RedisChatStore(redis_url=os.getenv("REDIS_URL"), ttl=1800)
-
-conn_params = {
-    'dbname': os.getenv("POSTGRES_DB_FEEDBACK"),
-    'user': os.getenv("POSTGRES_USER"),
-    'password': os.getenv("POSTGRES_PASSWORD"),
-    'host': os.getenv("POSTGRES_HOST"),
-    'port': os.getenv("POSTGRES_PORT")     
-}
-
-def inserir_dados(user_uuid: str, feedback: str, str_cache: str):
-    conn = None
-    try:
-        func_name = "inserir_dados: "
-        conn = psycopg2.connect(**conn_params)
-        logger.info(func_name+"Conexão com o POSGRESQL realizada com sucesso!")
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_schema = 'public'
-                AND table_name = 'tb_feedback_chatbot'
-            );
-        """)
-        
-        tabela_existe = cursor.fetchone()[0]
-        if tabela_existe:
-            logger.info(func_name+"Tabela TB_FEEDBACK_CHATBOT já existe! Inserindo dados...")
-        else:
-            cursor.execute("""
-                CREATE TABLE TB_FEEDBACK_CHATBOT (
-                    user_uuid VARCHAR PRIMARY KEY,
-                    feedback TEXT,
-                    conversa TEXT
-                );
-            """)
-            logger.info(func_name+"Tabela criada com sucesso!")
-
-        query = sql.SQL("INSERT INTO TB_FEEDBACK_CHATBOT (user_uuid, feedback, conversa) VALUES (%s, %s, %s)")
-        cursor.execute(query, (user_uuid, feedback, str_cache))
-        
-        conn.commit()
-        logger.info(func_name+"Dados inseridos com sucesso!")
-        
-    except Exception as e:
-        logger.error(func_name+f"Erro ao inserir dados: {e}")
-    
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
-
 class URLRequest(BaseModel):
     user_uuid: str
     feedback: str
+    rating: Optional[int] = Field(default=None, ge=1, le=5)
 
 @r.post("") 
 def user_chat_feedback(request: URLRequest):
     try:
         user_uuid = request.user_uuid
-        feedback = request.feedback
-        str_cache = get_chat_cache_string(chat_store=chat_store, user_uuid=user_uuid)
-        inserir_dados(user_uuid, feedback, str_cache)
+        messages = get_chat_store().get_messages(user_uuid)
+        get_feedback_store().enqueue(user_uuid, request.feedback, messages, request.rating)
         return {"Feedback salvo com sucesso"}, 200
+    except FeedbackQueueFull as e:
+        raise HTTPException(status_code=503, detail="Erro ao armazenar o feedback; Erro: "+str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Erro ao armazenar o feedback; Erro: "+str(e))
+
+def _utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Datetimes without a timezone are taken as UTC, like the rollup days
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+@r.get("/stats")
+def feedback_stats(
+    limit: int = Query(default=50, ge=1, le=500),
+    cursor: Optional[int] = Query(default=None, description="next_cursor da página anterior"),
+    user_uuid: Optional[str] = None,
+    rating: Optional[int] = Query(default=None, ge=1, le=5),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    include_messages: bool = False,
+):
+    """
+    Daily totals per rating for the period and one page of feedback, newest
+    first. Pass the returned `next_cursor` as `cursor` to get the next page.
+
+    The period goes from `since` up to `until` excluded, in UTC when no
+    timezone is given. The daily totals cover the whole UTC days the period
+    overlaps and are filtered by `rating` but not by `user_uuid`: they are
+    the totals of every user.
+    """
+    since, until = _utc(since), _utc(until)
+    try:
+        store = get_feedback_store()
+        items = store.list_feedback(
+            limit=limit,
+            before_id=cursor,
+            user_uuid=user_uuid,
+            rating=rating,
+            since=since,
+            until=until,
+            include_messages=include_messages,
+        )
+        until_day = None
+        if until is not None:
+            # A day is in the period if it starts before `until`
+            until_day = until.date()
+            if until.time() != time():
+                until_day += timedelta(days=1)
+        daily = store.daily_totals(
+            since=since.date() if since else None,
+            until=until_day,
+            rating=rating,
+        )
     except Exception as e:
-        raise HTTPException(status_code=500, detail="Erro ao armazenar o feedback; Erro: "+str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Erro ao consultar os feedbacks; Erro: "+str(e))
+    return {
+        "daily": daily,
+        "items": items,
+        "next_cursor": items[-1]["id"] if len(items) == limit else None,
+    }
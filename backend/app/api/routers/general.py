@@ -6,6 +6,8 @@ import re
 
 from llama_index.core import Document, VectorStoreIndex
 
+from app.llm_gateway import BATCH, use_llm_priority
+
 general_prompt_route = r = APIRouter()
 logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 logger = logging.getLogger("uvicorn")
@@ -36,7 +38,8 @@ def general_prompt_requests(request: PromptRequest):
     try:
         documents = [Document(text=" ")]
         index = VectorStoreIndex.from_documents(documents)
-        result = index.as_query_engine().query(request.prompt)
+        with use_llm_priority(BATCH):
+            result = index.as_query_engine().query(request.prompt)
         
         response_string = str(result)
         result = json_formater(response_string)
@@ -44,6 +47,8 @@ def general_prompt_requests(request: PromptRequest):
         logger.info(f"Resultado do prompt: {result}")
         return {"message": result.get("message", "")}  # Retorna apenas o campo "message" no JSON
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro no processamento do prompt: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Response, status
+
+from app.warmup import get_model_warmup
+
+health_router = r = APIRouter()
+
+
+@r.get("/live")
+def live():
+    return {"live": True}
+
+
+@r.get("/ready")
+def ready(response: Response):
+    """
+    Not ready (503) until the models are warmed up, so the load balancer
+    doesn't route requests to a cold instance.
+    """
+    warmup = get_model_warmup()
+    if not warmup.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return warmup.status()
@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+
+from app.observability import get_stats
+
+metrics_router = r = APIRouter()
+
+
+@r.get("")
+def metrics():
+    return get_stats()
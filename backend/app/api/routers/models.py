@@ -7,8 +7,12 @@ from llama_index.core.schema import NodeWithScore
 from pydantic import BaseModel, Field, validator
 from pydantic.alias_generators import to_camel
 
+from app.engine.vectordb import is_valid_tenant_id
+
 logger = logging.getLogger("uvicorn")
 
+CHAT_BATCH_MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "1000"))
+
 
 class FileContent(BaseModel):
     type: Literal["text", "ref"]
@@ -76,6 +80,9 @@ class Message(BaseModel):
 class ChatData(BaseModel):
     messages: List[Message]
     user_uuid: str
+    # Tenant of the user, used to restrict retrieval to the tenant's documents
+    id_empresa: Optional[str] = None
+    id_unidade: Optional[str] = None
 
     class Config:
         json_schema_extra = {
@@ -95,7 +102,13 @@ class ChatData(BaseModel):
         if len(v) == 0:
             raise ValueError("Mensagens não podem ser vazias")
         return v
-    
+
+    @validator("id_empresa", "id_unidade")
+    def tenant_ids_must_be_valid(cls, v):
+        if v is not None and not is_valid_tenant_id(v):
+            raise ValueError("Identificador de tenant inválido")
+        return v
+
     def get_last_message_content(self) -> str:
         """
         Get the content of the last message along with the data content if available.
@@ -148,6 +161,30 @@ class ChatData(BaseModel):
         return list(set(document_ids))
 
 
+class BatchChatData(BaseModel):
+    items: List[ChatData]
+
+    @validator("items")
+    def items_must_be_within_limit(cls, v):
+        if len(v) == 0:
+            raise ValueError("O lote não pode ser vazio")
+        if len(v) > CHAT_BATCH_MAX_ITEMS:
+            raise ValueError(
+                f"O lote não pode ter mais de {CHAT_BATCH_MAX_ITEMS} itens"
+            )
+        return v
+
+
+class SuggestionsData(BaseModel):
+    messages: List[Message]
+
+    @validator("messages")
+    def messages_must_not_be_empty(cls, v):
+        if len(v) == 0:
+            raise ValueError("Mensagens não podem ser vazias")
+        return v
+
+
 class LlamaCloudFile(BaseModel):
     file_name: str
     pipeline_id: str
@@ -3,15 +3,14 @@ from typing import List
 
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from pytesseract import pytesseract
-from pdf2image import convert_from_bytes
-import requests
 import json
 
 from llama_index.core.indices import VectorStoreIndex
 from llama_index.core import Document
 
 from app.engine.index import get_index
+from app.http_client import get_http_client
+from app.llm_gateway import BATCH, use_llm_priority
 
 ocr_llm_route = r = APIRouter()
 
@@ -44,8 +43,13 @@ def json_formater(response_text: str) -> dict:
 
 @r.post("")
 def vectorization_mode_ocr(request: OcrLLM):
+    from pdf2image import convert_from_bytes
+    from pytesseract import pytesseract
+
     try:
-        images = convert_from_bytes(requests.get(request.url).content)
+        pdf = get_http_client().get(request.url)
+        pdf.raise_for_status()
+        images = convert_from_bytes(pdf.content)
 
         documents = []
         for index, image in enumerate(images):
@@ -54,9 +58,12 @@ def vectorization_mode_ocr(request: OcrLLM):
             documents.append(doc)
         
         index = VectorStoreIndex.from_documents(documents, verbose=True)
-        response = index.as_query_engine().query(request.prompt)
+        with use_llm_priority(BATCH):
+            response = index.as_query_engine().query(request.prompt)
         result_json = json_formater(str(response))
         return result_json
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro no processamento do arquivo: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Error processing file")
@@ -3,8 +3,6 @@ import logging
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 
-from app.engine.generate import generate_single_doc
-
 s3_new_document_event_router = r = APIRouter()
 logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', level=logging.INFO)
 logger = logging.getLogger("uvicorn")
@@ -14,6 +12,8 @@ class URLRequest(BaseModel):
 
 @r.post("") 
 def s3_new_document_event(request: URLRequest):
+    from app.engine.generate import generate_single_doc
+
     try:
         url = request.url
         generate_single_doc(url)
@@ -1,13 +1,28 @@
+import asyncio
 import json
+import os
+import time
+from json.encoder import encode_basestring
+from typing import AsyncGenerator, AsyncIterator, List
 
 from aiostream import stream
 from fastapi import Request
 from fastapi.responses import StreamingResponse
-from llama_index.core.chat_engine.types import StreamingAgentChatResponse
 
 from app.api.routers.events import EventCallbackHandler
 from app.api.routers.models import ChatData, Message, SourceNodes
-from app.api.services.suggestion import NextQuestionSuggestion
+from app.api.services.suggestion import SUGGESTIONS_MODE, NextQuestionSuggestion
+from app.engine.chat_engine import CancellableStreamingResponse
+from app.observability import register_stats
+
+stream_counters = {"started": 0, "completed": 0, "cancelled": 0, "failed": 0}
+register_stats("chat_stream", lambda: dict(stream_counters))
+
+# Coalesce the tokens into one text frame every STREAM_COALESCE_MS milliseconds
+# or STREAM_COALESCE_SIZE characters, whichever comes first. 0 sends one frame
+# per token.
+STREAM_COALESCE_MS = int(os.getenv("STREAM_COALESCE_MS", "30"))
+STREAM_COALESCE_SIZE = int(os.getenv("STREAM_COALESCE_SIZE", "256"))
 
 
 class VercelStreamResponse(StreamingResponse):
@@ -20,9 +35,10 @@ class VercelStreamResponse(StreamingResponse):
 
     @classmethod
     def convert_text(cls, token: str):
-        # Escape newlines and double quotes to avoid breaking the stream
-        token = json.dumps(token)
-        return f"{cls.TEXT_PREFIX}{token}\n"
+        # Escape newlines and double quotes to avoid breaking the stream. A
+        # valid JSON string without json.dumps' per-call overhead; unlike it,
+        # non-ASCII characters are kept as is instead of escaped as \uXXXX
+        return f"{cls.TEXT_PREFIX}{encode_basestring(token)}\n"
 
     @classmethod
     def convert_data(cls, data: dict):
@@ -33,43 +49,109 @@ class VercelStreamResponse(StreamingResponse):
         self,
         request: Request,
         event_handler: EventCallbackHandler,
-        response: StreamingAgentChatResponse,
+        response: CancellableStreamingResponse,
         chat_data: ChatData,
     ):
+        # The request isn't polled for disconnects: Starlette cancels the
+        # body when the client goes away (see content_generator)
         content = VercelStreamResponse.content_generator(
-            request, event_handler, response, chat_data
+            event_handler, response, chat_data
         )
         super().__init__(content=content)
 
+    @staticmethod
+    async def coalesce(
+        tokens: AsyncIterator[str], interval_ms: int, max_size: int
+    ) -> AsyncGenerator[str, None]:
+        """
+        Group the tokens into chunks, flushed when the oldest token has waited
+        `interval_ms` or the chunk reaches `max_size` characters.
+        """
+        if interval_ms <= 0:
+            async for token in tokens:
+                yield token
+            return
+
+        interval = interval_ms / 1000
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        end = object()
+        buffer: List[str] = []
+        size = 0
+        timer = None
+
+        def flush():
+            nonlocal buffer, size, timer
+            if timer is not None:
+                timer.cancel()
+                timer = None
+            if buffer:
+                chunks.put_nowait("".join(buffer))
+                buffer, size = [], 0
+
+        async def read():
+            # A single task reads the whole stream and the flush deadlines are
+            # timers, so nothing is created or scheduled per token
+            nonlocal size, timer
+            try:
+                async for token in tokens:
+                    if not buffer:
+                        timer = loop.call_later(interval, flush)
+                    buffer.append(token)
+                    size += len(token)
+                    if size >= max_size:
+                        flush()
+                flush()
+                chunks.put_nowait(end)
+            except Exception as e:
+                if timer is not None:
+                    timer.cancel()
+                chunks.put_nowait(e)
+
+        reader = asyncio.create_task(read())
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is end:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            reader.cancel()
+            if timer is not None:
+                timer.cancel()
+
     @classmethod
     async def content_generator(
         cls,
-        request: Request,
         event_handler: EventCallbackHandler,
-        response: StreamingAgentChatResponse,
+        response: CancellableStreamingResponse,
         chat_data: ChatData,
     ):
+        pending_tasks: List[asyncio.Task] = []
+
         # Yield the text response
         async def _chat_response_generator():
-            final_response = ""
-            async for token in response.async_response_gen():
-                final_response += token
-                yield VercelStreamResponse.convert_text(token)
-
-            # Generate questions that user might interested to
-            conversation = chat_data.messages + [
-                Message(role="assistant", content=final_response)
-            ]
-            questions = await NextQuestionSuggestion.suggest_next_questions(
-                conversation
-            )
-            if len(questions) > 0:
-                yield VercelStreamResponse.convert_data(
-                    {
-                        "type": "suggested_questions",
-                        "data": questions,
-                    }
+            parts: List[str] = []
+            async for text in cls.coalesce(
+                response.async_response_gen(), STREAM_COALESCE_MS, STREAM_COALESCE_SIZE
+            ):
+                parts.append(text)
+                yield VercelStreamResponse.convert_text(text)
+            final_response = "".join(parts)
+
+            # Generate questions that user might interested to, concurrently with
+            # sending the sources and only for as long as the deadline allows
+            suggestions = None
+            if SUGGESTIONS_MODE == "inline":
+                conversation = chat_data.messages + [
+                    Message(role="assistant", content=final_response)
+                ]
+                suggestions = asyncio.create_task(
+                    NextQuestionSuggestion.suggest_next_questions_within(conversation)
                 )
+                pending_tasks.append(suggestions)
 
             # the text_generator is the leading stream, once it's finished, also finish the event stream
             event_handler.is_done = True
@@ -87,23 +169,48 @@ class VercelStreamResponse(StreamingResponse):
                 }
             )
 
+            if suggestions is not None:
+                questions = await suggestions
+                if len(questions) > 0:
+                    yield VercelStreamResponse.convert_data(
+                        {
+                            "type": "suggested_questions",
+                            "data": questions,
+                        }
+                    )
+
         # Yield the events from the event handler
         async def _event_generator():
-            async for event in event_handler.async_event_gen():
-                event_response = event.to_response()
-                if event_response is not None:
-                    yield VercelStreamResponse.convert_data(event_response)
+            async for event_response in event_handler.async_event_gen():
+                yield VercelStreamResponse.convert_data(event_response)
 
         combine = stream.merge(_chat_response_generator(), _event_generator())
         is_stream_started = False
-        async with combine.stream() as streamer:
-            async for output in streamer:
-                if not is_stream_started:
-                    is_stream_started = True
-                    # Stream a blank message to start the stream
-                    yield VercelStreamResponse.convert_text("")
-
-                yield output
-
-                if await request.is_disconnected():
-                    break
+        completed = False
+        stream_counters["started"] += 1
+        try:
+            async with combine.stream() as streamer:
+                async for output in streamer:
+                    if not is_stream_started:
+                        is_stream_started = True
+                        # Stream a blank message to start the stream
+                        yield VercelStreamResponse.convert_text("")
+
+                    yield output
+            completed = True
+            stream_counters["completed"] += 1
+        except (asyncio.CancelledError, GeneratorExit):
+            # Starlette cancels the response body as soon as the client
+            # disconnects, so there is no need to poll for it
+            stream_counters["cancelled"] += 1
+            raise
+        except Exception:
+            stream_counters["failed"] += 1
+            raise
+        finally:
+            if not completed:
+                # Stop the LLM generation and the suggestions nobody will read
+                response.cancel()
+                for task in pending_tasks:
+                    task.cancel()
+                event_handler.is_done = True
@@ -6,17 +6,10 @@ from typing import Dict, List
 from uuid import uuid4
 
 from app.engine.index import get_index
+from app.engine.semantic_cache import invalidate_semantic_cache
 from llama_index.core import VectorStoreIndex
 from llama_index.core.ingestion import IngestionPipeline
-from llama_index.core.readers.file.base import (
-    _try_loading_included_file_formats as get_file_loaders_map,
-)
-from llama_index.core.readers.file.base import (
-    default_file_metadata_func,
-)
 from llama_index.core.schema import Document
-from llama_index.indices.managed.llama_cloud.base import LlamaCloudIndex
-from llama_index.readers.file import FlatReader
 
 
 def get_llamaparse_parser():
@@ -32,6 +25,12 @@ def get_llamaparse_parser():
 
 
 def default_file_loaders_map():
+    # The file readers import their parsing libraries, so load them on first use
+    from llama_index.core.readers.file.base import (
+        _try_loading_included_file_formats as get_file_loaders_map,
+    )
+    from llama_index.readers.file import FlatReader
+
     default_loaders = get_file_loaders_map()
     default_loaders[".txt"] = FlatReader
     return default_loaders
@@ -79,6 +78,8 @@ class PrivateFileService:
 
     @staticmethod
     def process_file(base64_content: str) -> List[str]:
+        from llama_index.indices.managed.llama_cloud.base import LlamaCloudIndex
+
         file_data, extension = PrivateFileService.preprocess_base64_file(base64_content)
         documents = PrivateFileService.store_and_parse_file(file_data, extension)
 
@@ -109,5 +110,8 @@ class PrivateFileService:
                 persist_dir=os.environ.get("STORAGE_DIR", "storage")
             )
 
+        # Cached answers may be outdated by the new document
+        invalidate_semantic_cache()
+
         # Return the document ids
         return [doc.doc_id for doc in documents]
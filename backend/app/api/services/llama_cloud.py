@@ -2,8 +2,8 @@ import logging
 import os
 from typing import Any, Dict, List, Optional
 
-import requests
 from app.api.routers.models import LlamaCloudFile
+from app.http_client import get_http_client
 
 logger = logging.getLogger("uvicorn")
 
@@ -30,10 +30,10 @@ class LLamaCloudFileService:
         # Create directory if it doesn't exist
         os.makedirs(cls.LOCAL_STORE_PATH, exist_ok=True)
         # Download the file
-        with requests.get(url, stream=True) as r:
+        with get_http_client().stream("GET", url) as r:
             r.raise_for_status()
             with open(local_file_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
+                for chunk in r.iter_bytes(chunk_size=8192):
                     f.write(chunk)
         logger.info("File downloaded successfully")
 
@@ -83,6 +83,6 @@ class LLamaCloudFileService:
                 "Accept": "application/json",
                 "Authorization": f'Bearer {os.getenv("LLAMA_CLOUD_API_KEY")}',
             }
-        response = requests.request(method, url, headers=headers, data=data)
+        response = get_http_client().request(method, url, headers=headers, data=data)
         response.raise_for_status()
         return response.json()
@@ -1,6 +1,10 @@
+import asyncio
+import logging
+import os
 from typing import List
 
 from app.api.routers.models import Message
+from app.llm_gateway import SUGGESTIONS, use_llm_priority
 from llama_index.core.prompts import PromptTemplate
 from llama_index.core.settings import Settings
 from pydantic import BaseModel
@@ -15,6 +19,14 @@ NEXT_QUESTIONS_SUGGESTION_PROMPT = PromptTemplate(
 )
 N_QUESTION_TO_GENERATE = 3
 
+# "inline": sent at the end of the chat stream, within SUGGESTIONS_TIMEOUT
+# "endpoint": only generated on demand by the /api/chat/suggestions route
+# "off": never generated
+SUGGESTIONS_MODE = os.getenv("NEXT_QUESTION_SUGGESTIONS", "inline")
+SUGGESTIONS_TIMEOUT = float(os.getenv("NEXT_QUESTION_SUGGESTIONS_TIMEOUT", "5"))
+
+logger = logging.getLogger("uvicorn")
+
 
 class NextQuestions(BaseModel):
     """A list of questions that user might ask next"""
@@ -40,11 +52,32 @@ class NextQuestionSuggestion:
                 break
         conversation: str = f"{last_user_message}\n{last_assistant_message}"
 
-        output: NextQuestions = await Settings.llm.astructured_predict(
-            NextQuestions,
-            prompt=NEXT_QUESTIONS_SUGGESTION_PROMPT,
-            conversation=conversation,
-            nun_questions=number_of_questions,
-        )
+        with use_llm_priority(SUGGESTIONS):
+            output: NextQuestions = await Settings.llm.astructured_predict(
+                NextQuestions,
+                prompt=NEXT_QUESTIONS_SUGGESTION_PROMPT,
+                conversation=conversation,
+                nun_questions=number_of_questions,
+            )
 
         return output.questions
+
+    @classmethod
+    async def suggest_next_questions_within(
+        cls,
+        messages: List[Message],
+        timeout: float = SUGGESTIONS_TIMEOUT,
+    ) -> List[str]:
+        """
+        Suggest the next questions, giving up after `timeout` seconds.
+        Suggestions are optional, so failures only return an empty list.
+        """
+        try:
+            return await asyncio.wait_for(
+                cls.suggest_next_questions(messages), timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Sugestões de perguntas excederam {timeout}s, ignorando")
+        except Exception as e:
+            logger.error(f"Erro ao gerar sugestões de perguntas: {e}")
+        return []
@@ -0,0 +1,321 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from cachetools import LRUCache
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.settings import Settings
+
+from app.llm_router import RoutedEmbedding
+from app.observability import register_stats
+from app.ollama import PooledOllamaEmbedding
+
+logger = logging.getLogger("uvicorn")
+
+KEY_PREFIX = "embedding_cache"
+
+
+def embeds_queries_as_texts(embed_model: BaseEmbedding) -> bool:
+    """
+    Whether the text embedding endpoint of `embed_model` returns the same
+    vectors as its query one, so queries can go through its batched text
+    calls. Only known for Ollama and for OpenAI/Azure models without
+    separate query and document engines; other providers embed queries
+    differently (task types, instruction prefixes).
+    """
+    if isinstance(embed_model, RoutedEmbedding):
+        return all(embeds_queries_as_texts(node) for node in embed_model.nodes)
+    if isinstance(embed_model, PooledOllamaEmbedding):
+        return True
+    try:
+        # AzureOpenAIEmbedding subclasses it
+        from llama_index.embeddings.openai import OpenAIEmbedding
+    except ImportError:
+        return False
+    if isinstance(embed_model, OpenAIEmbedding):
+        query_engine = getattr(embed_model, "_query_engine", None)
+        return query_engine is not None and query_engine == getattr(
+            embed_model, "_text_engine", None
+        )
+    return False
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps the configured embedding model and caches query embeddings in two
+    tiers: an in-process LRU and, if a Redis URL is given, a shared Redis tier.
+    Entries are keyed by model name, dimension and a hash of the query text.
+    Text (document) embeddings are passed through uncached.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _local: LRUCache = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+    _redis_url: Optional[str] = PrivateAttr()
+    _redis: Any = PrivateAttr(default=None)
+    _aredis: Any = PrivateAttr(default=None)
+    _ttl: int = PrivateAttr()
+    _dimension: str = PrivateAttr()
+    _batch_queries: bool = PrivateAttr()
+    _counters: dict = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        max_entries: int = 2048,
+        redis_url: Optional[str] = None,
+        ttl: int = 86400,
+        dimension: Optional[int] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._local = LRUCache(maxsize=max_entries)
+        self._lock = threading.Lock()
+        self._redis_url = redis_url
+        self._ttl = ttl
+        self._dimension = str(dimension) if dimension else "auto"
+        self._batch_queries = embeds_queries_as_texts(embed_model)
+        self._counters = {"local_hits": 0, "redis_hits": 0, "misses": 0, "errors": 0}
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        return self._embed_model
+
+    def _key(self, query: str) -> str:
+        digest = hashlib.sha256(query.encode()).hexdigest()
+        return f"{KEY_PREFIX}:{self.model_name}:{self._dimension}:{digest}"
+
+    def _get_local(self, key: str) -> Optional[Embedding]:
+        with self._lock:
+            embedding = self._local.get(key)
+        if embedding is not None:
+            self._counters["local_hits"] += 1
+        return embedding
+
+    def _set_local(self, key: str, embedding: Embedding):
+        with self._lock:
+            self._local[key] = embedding
+
+    @staticmethod
+    def _decode(raw: bytes) -> Embedding:
+        return np.frombuffer(raw, dtype=np.float32).tolist()
+
+    @staticmethod
+    def _encode(embedding: Embedding) -> bytes:
+        return np.asarray(embedding, dtype=np.float32).tobytes()
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        key = self._key(query)
+        embedding = self._get_local(key)
+        if embedding is not None:
+            return embedding
+
+        if self._redis_url:
+            try:
+                if self._redis is None:
+                    import redis
+
+                    self._redis = redis.from_url(self._redis_url)
+                raw = self._redis.get(key)
+                if raw is not None:
+                    self._counters["redis_hits"] += 1
+                    embedding = self._decode(raw)
+                    self._set_local(key, embedding)
+                    return embedding
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.warning(f"Cache de embeddings indisponível no Redis: {e}")
+
+        self._counters["misses"] += 1
+        embedding = self._embed_model._get_query_embedding(query)
+        self._set_local(key, embedding)
+        if self._redis is not None:
+            try:
+                self._redis.set(key, self._encode(embedding), ex=self._ttl)
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.warning(f"Erro ao gravar embedding no Redis: {e}")
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        key = self._key(query)
+        embedding = self._get_local(key)
+        if embedding is not None:
+            return embedding
+
+        if self._redis_url:
+            try:
+                if self._aredis is None:
+                    import redis.asyncio as aioredis
+
+                    self._aredis = aioredis.from_url(self._redis_url)
+                raw = await self._aredis.get(key)
+                if raw is not None:
+                    self._counters["redis_hits"] += 1
+                    embedding = self._decode(raw)
+                    self._set_local(key, embedding)
+                    return embedding
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.warning(f"Cache de embeddings indisponível no Redis: {e}")
+
+        self._counters["misses"] += 1
+        embedding = await self._embed_model._aget_query_embedding(query)
+        self._set_local(key, embedding)
+        if self._aredis is not None:
+            try:
+                await self._aredis.set(key, self._encode(embedding), ex=self._ttl)
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.warning(f"Erro ao gravar embedding no Redis: {e}")
+        return embedding
+
+    async def aprefetch(self, queries: List[str], concurrency: int = 4) -> int:
+        """
+        Cache the embeddings of many queries at once: the ones missing from
+        both tiers are embedded with batched calls to the wrapped model, instead
+        of one call per query. Batches go through the text embedding endpoint,
+        so only for the models where it returns the same vectors as the query
+        one (see embeds_queries_as_texts); other models get one query call
+        each. At most `concurrency` calls are in flight, and a failed call
+        only loses its own queries. Returns the number of queries embedded.
+        """
+        keys = {self._key(query): query for query in queries}
+        missing = {
+            key: query for key, query in keys.items() if self._get_local(key) is None
+        }
+        if missing and self._redis_url:
+            try:
+                if self._aredis is None:
+                    import redis.asyncio as aioredis
+
+                    self._aredis = aioredis.from_url(self._redis_url)
+                for key, raw in zip(
+                    list(missing), await self._aredis.mget(list(missing))
+                ):
+                    if raw is not None:
+                        self._counters["redis_hits"] += 1
+                        self._set_local(key, self._decode(raw))
+                        del missing[key]
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.warning(f"Cache de embeddings indisponível no Redis: {e}")
+        if not missing:
+            return 0
+
+        # Batches of embed_batch_size texts, or single query calls, with at
+        # most `concurrency` of them in flight
+        size = self.embed_batch_size if self._batch_queries else 1
+        items = list(missing.items())
+        chunks = [items[i : i + size] for i in range(0, len(items), size)]
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def embed(chunk: List[Tuple[str, str]]) -> List[Embedding]:
+            async with semaphore:
+                if self._batch_queries:
+                    return await self._embed_model.aget_text_embedding_batch(
+                        [query for _, query in chunk]
+                    )
+                return [await self._embed_model._aget_query_embedding(chunk[0][1])]
+
+        embedded: Dict[str, Embedding] = {}
+        errors = []
+        results = await asyncio.gather(
+            *[embed(chunk) for chunk in chunks], return_exceptions=True
+        )
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, BaseException):
+                errors.append(result)
+                continue
+            for (key, _), embedding in zip(chunk, result):
+                embedded[key] = embedding
+                self._set_local(key, embedding)
+        self._counters["misses"] += len(embedded)
+        if errors:
+            logger.warning(
+                f"Falha ao calcular {len(missing) - len(embedded)} de {len(missing)} "
+                f"embeddings em lote: {errors[0]}"
+            )
+        if embedded and self._aredis is not None:
+            try:
+                pipe = self._aredis.pipeline(transaction=False)
+                for key, embedding in embedded.items():
+                    pipe.set(key, self._encode(embedding), ex=self._ttl)
+                await pipe.execute()
+            except Exception as e:
+                self._counters["errors"] += 1
+                logger.warning(f"Erro ao gravar embedding no Redis: {e}")
+        return len(embedded)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._embed_model._get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return await self._embed_model._aget_text_embedding(text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._embed_model._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._embed_model._aget_text_embeddings(texts)
+
+    def stats(self) -> dict:
+        hits = self._counters["local_hits"] + self._counters["redis_hits"]
+        lookups = hits + self._counters["misses"]
+        return {
+            **self._counters,
+            "local_entries": len(self._local),
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+def init_embedding_cache():
+    """
+    Install the query embedding cache around the configured embedding model.
+    Disable it with EMBEDDING_CACHE_ENABLED=false.
+    """
+    if os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() != "true":
+        return
+    embed_model = Settings.embed_model
+    if isinstance(embed_model, CachedEmbedding):
+        return
+
+    dimension = os.getenv("EMBEDDING_DIM")
+    cached = CachedEmbedding(
+        embed_model=embed_model,
+        max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "2048")),
+        redis_url=os.getenv("REDIS_URL"),
+        ttl=int(os.getenv("EMBEDDING_CACHE_TTL", "86400")),
+        dimension=int(dimension) if dimension else None,
+    )
+    Settings.embed_model = cached
+    register_stats("embedding_cache", cached.stats)
+
+
+async def aprefetch_query_embeddings(queries: List[str], concurrency: int = 4):
+    """
+    Embed the queries in batches ahead of their individual lookups. A no-op
+    without the cache, and failures only cost the batching.
+    """
+    embed_model = Settings.embed_model
+    if not queries or not isinstance(embed_model, CachedEmbedding):
+        return
+    try:
+        await embed_model.aprefetch(queries, concurrency)
+    except Exception as e:
+        logger.warning(f"Falha ao calcular embeddings em lote: {e}")
@@ -1,31 +1,23 @@
-import os
-from app.engine.index import get_index
+from app.engine.factory import get_chat_engine_factory
 from fastapi import HTTPException
-from llama_index.core.memory import ChatMemoryBuffer
 
-def get_chat_engine(chat_store=None, filters=None, user_uuid="default"):
-    system_prompt = os.getenv("SYSTEM_PROMPT")
-    top_k = os.getenv("TOP_K", 3)
 
-    index = get_index()
-    if index is None:
+def get_chat_engine(
+    chat_store=None, filters=None, user_uuid="default", handlers=None, memory_mode=None
+):
+    factory = get_chat_engine_factory()
+    if factory.index is None:
         raise HTTPException(
             status_code=500,
             detail=str(
                 "StorageContext is empty - call 'poetry run generate' to generate the storage first"
             ),
         )
-    
-    chat_memory = ChatMemoryBuffer.from_defaults(
-        token_limit=3000,
-        chat_store=chat_store,
-        chat_store_key=user_uuid,
-    )
 
-    return index.as_chat_engine(
-        similarity_top_k=int(top_k),
-        system_prompt=system_prompt,
-        chat_mode="condense_plus_context",
+    return factory.create_chat_engine(
+        chat_store=chat_store,
         filters=filters,
-        memory=chat_memory
+        user_uuid=user_uuid,
+        handlers=handlers,
+        memory_mode=memory_mode,
     )
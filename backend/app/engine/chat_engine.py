@@ -0,0 +1,213 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+from typing import Any, List, Optional, Tuple
+
+from llama_index.core.callbacks import trace_method
+from llama_index.core.chat_engine import CondensePlusContextChatEngine
+from llama_index.core.chat_engine.types import (
+    AgentChatResponse,
+    StreamingAgentChatResponse,
+)
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.tools import ToolOutput
+
+from app.engine.condense import CondensePolicy
+
+logger = logging.getLogger("uvicorn")
+
+
+class CancellableStreamingResponse(StreamingAgentChatResponse):
+    """
+    Streaming response that keeps the task writing the LLM stream, so the
+    generation can be stopped when nobody is reading it anymore.
+    """
+
+    _write_task: Optional[asyncio.Task] = None
+
+    def cancel(self):
+        if self._write_task is not None and not self._write_task.done():
+            self._write_task.cancel()
+        # A cancelled write task may never have started iterating the stream,
+        # so give its LLM gateway slot back directly
+        release = getattr(self.achat_stream, "release", None)
+        if release is not None:
+            release()
+
+
+class ChatEngine(CondensePlusContextChatEngine):
+    """
+    Condense plus context chat engine that exposes the condensed question
+    before retrieval, so callers can look it up in a cache first. Whether the
+    condense LLM call is made at all is up to the condense policy.
+
+    The async paths use the async methods of the memory when it has them, so
+    reading and writing the history doesn't block the event loop.
+    """
+
+    _condensed: Optional[Tuple[str, str]] = None
+
+    def __init__(self, *args: Any, condense_policy: CondensePolicy, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._condense_policy = condense_policy
+
+    async def _amemory_get(self, **kwargs: Any) -> List[ChatMessage]:
+        aget = getattr(self._memory, "aget", None)
+        return await aget(**kwargs) if aget else self._memory.get(**kwargs)
+
+    async def _amemory_set(self, messages: List[ChatMessage]):
+        aset = getattr(self._memory, "aset", None)
+        await aset(messages) if aset else self._memory.set(messages)
+
+    async def _amemory_put(self, message: ChatMessage):
+        aput = getattr(self._memory, "aput", None)
+        await aput(message) if aput else self._memory.put(message)
+
+    async def acondense(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> str:
+        if chat_history is not None:
+            await self._amemory_set(chat_history)
+        history = await self._amemory_get(input=message)
+        condensed = await self._condense_policy.acondense(
+            self._llm, self._condense_prompt_template, history, message
+        )
+        # Remember the result so the following chat call doesn't condense again
+        self._condensed = (message, condensed)
+        return condensed
+
+    def _condense_question(
+        self, chat_history: List[ChatMessage], latest_message: str
+    ) -> str:
+        return self._condense_policy.condense(
+            self._llm, self._condense_prompt_template, chat_history, latest_message
+        )
+
+    async def _acondense_question(
+        self, chat_history: List[ChatMessage], latest_message: str
+    ) -> str:
+        if self._condensed is not None and self._condensed[0] == latest_message:
+            return self._condensed[1]
+        return await self._condense_policy.acondense(
+            self._llm, self._condense_prompt_template, chat_history, latest_message
+        )
+
+    async def _arun_c3(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> Tuple[List[ChatMessage], ToolOutput, List[NodeWithScore]]:
+        if chat_history is not None:
+            await self._amemory_set(chat_history)
+
+        chat_history = await self._amemory_get(input=message)
+
+        condensed_question = await self._acondense_question(chat_history, message)
+        logger.debug(f"Condensed question: {condensed_question}")
+
+        context_str, context_nodes = await self._aretrieve_context(condensed_question)
+        context_source = ToolOutput(
+            tool_name="retriever",
+            content=context_str,
+            raw_input={"message": condensed_question},
+            raw_output=context_str,
+        )
+
+        system_message_content = self._context_prompt_template.format(
+            context_str=context_str
+        )
+        if self._system_prompt:
+            system_message_content = self._system_prompt + "\n" + system_message_content
+        system_message = ChatMessage(
+            content=system_message_content, role=self._llm.metadata.system_role
+        )
+        initial_token_count = self._token_counter.estimate_tokens_in_messages(
+            [system_message]
+        )
+
+        await self._amemory_put(ChatMessage(content=message, role=MessageRole.USER))
+        chat_messages = [
+            system_message,
+            *await self._amemory_get(initial_token_count=initial_token_count),
+        ]
+        return chat_messages, context_source, context_nodes
+
+    @trace_method("chat")
+    async def achat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> AgentChatResponse:
+        chat_messages, context_source, context_nodes = await self._arun_c3(
+            message, chat_history
+        )
+
+        chat_response = await self._llm.achat(chat_messages)
+        assistant_message = chat_response.message
+        await self._amemory_put(assistant_message)
+
+        return AgentChatResponse(
+            response=str(assistant_message.content),
+            sources=[context_source],
+            source_nodes=context_nodes,
+        )
+
+    async def _awrite_response_to_history(
+        self, chat_response: StreamingAgentChatResponse
+    ):
+        # The stock writer puts the final message with a sync call, so collect
+        # it and write it asynchronously
+        messages: List[ChatMessage] = []
+        await chat_response.awrite_response_to_history(
+            SimpleNamespace(put=messages.append)
+        )
+        for message in messages:
+            await self._amemory_put(message)
+
+    @trace_method("chat")
+    async def astream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> CancellableStreamingResponse:
+        chat_messages, context_source, context_nodes = await self._arun_c3(
+            message, chat_history
+        )
+
+        chat_response = CancellableStreamingResponse(
+            achat_stream=await self._llm.astream_chat(chat_messages),
+            sources=[context_source],
+            source_nodes=context_nodes,
+        )
+        chat_response._write_task = asyncio.create_task(
+            self._awrite_response_to_history(chat_response)
+        )
+        return chat_response
+
+    async def aset_memory(self, chat_history: List[ChatMessage]):
+        """
+        Replace the history in the memory, as the chat calls do with the one
+        they are given.
+        """
+        await self._amemory_set(chat_history)
+
+    def remember(self, message: str, answer: str):
+        """
+        Write a turn that didn't go through the LLM to the memory.
+        """
+        self._memory.put(ChatMessage(role=MessageRole.USER, content=message))
+        self._memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+
+    async def aremember(self, message: str, answer: str):
+        await self._amemory_put(ChatMessage(role=MessageRole.USER, content=message))
+        await self._amemory_put(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+
+    async def areplay(
+        self, message: str, answer: str, source_nodes: List[NodeWithScore]
+    ) -> CancellableStreamingResponse:
+        """
+        Build a finished streaming response from a stored answer, as if it had
+        been generated by the LLM.
+        """
+        await self.aremember(message, answer)
+
+        response = CancellableStreamingResponse(source_nodes=source_nodes)
+        response._ensure_async_setup()
+        response.aput_in_queue(answer)
+        response.is_done = True
+        return response
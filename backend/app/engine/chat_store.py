@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import zlib
+from typing import Any, List, Optional
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.storage.chat_store.base import BaseChatStore
+
+logger = logging.getLogger("uvicorn")
+
+# The first byte of an encoded message is MARKER | flags | role index. Messages
+# stored as JSON by RedisChatStore start with "{" and are still readable.
+MARKER = 0x80
+COMPRESSED = 0x40
+JSON_BODY = 0x20
+ROLE_MASK = 0x0F
+# Stored as indexes, only ever append to this tuple
+ROLES = (
+    MessageRole.SYSTEM,
+    MessageRole.USER,
+    MessageRole.ASSISTANT,
+    MessageRole.FUNCTION,
+    MessageRole.TOOL,
+    MessageRole.CHATBOT,
+    MessageRole.MODEL,
+)
+
+
+def encode_message(message: ChatMessage, compress_min_size: int = 0) -> bytes:
+    """
+    Header byte plus the UTF-8 content, or a JSON [content, additional_kwargs]
+    pair when the message carries extra fields. Bodies of `compress_min_size`
+    bytes or more are zlib compressed (0 disables compression).
+    """
+    flags = 0
+    if message.additional_kwargs or message.content is None:
+        flags |= JSON_BODY
+        body = json.dumps(
+            [message.content, message.additional_kwargs],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode()
+    else:
+        body = str(message.content).encode()
+    if compress_min_size and len(body) >= compress_min_size:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            flags |= COMPRESSED
+            body = compressed
+    return bytes([MARKER | flags | ROLES.index(message.role)]) + body
+
+
+def decode_message(raw: bytes) -> ChatMessage:
+    header = raw[0]
+    if not header & MARKER:
+        return ChatMessage.parse_obj(json.loads(raw))
+    body = raw[1:]
+    if header & COMPRESSED:
+        body = zlib.decompress(body)
+    role = ROLES[header & ROLE_MASK]
+    if header & JSON_BODY:
+        content, additional_kwargs = json.loads(body)
+        return ChatMessage(
+            role=role, content=content, additional_kwargs=additional_kwargs
+        )
+    return ChatMessage(role=role, content=body.decode())
+
+
+class PooledRedisChatStore(BaseChatStore):
+    """
+    Chat store over pooled sync and async Redis clients, shared by every
+    request. Messages use the compact encoding above, multi-command operations
+    are pipelined, and every access pushes the expiry of the key back by `ttl`
+    (sliding TTL), so active conversations never expire mid-session.
+    """
+
+    ttl: Optional[int] = Field(default=None, description="Sliding time to live in seconds.")
+    compress_min_size: int = Field(
+        default=512, description="Compress message bodies from this size, 0 to disable."
+    )
+
+    _redis_url: str = PrivateAttr()
+    _max_connections: int = PrivateAttr()
+    _client: Any = PrivateAttr(default=None)
+    _aclient: Any = PrivateAttr(default=None)
+
+    def __init__(
+        self,
+        redis_url: str = "redis://localhost:6379",
+        ttl: Optional[int] = None,
+        compress_min_size: int = 512,
+        max_connections: int = 50,
+        **kwargs: Any,
+    ):
+        super().__init__(ttl=ttl, compress_min_size=compress_min_size, **kwargs)
+        self._redis_url = redis_url
+        self._max_connections = max_connections
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PooledRedisChatStore"
+
+    @property
+    def redis_client(self) -> Any:
+        if self._client is None:
+            import redis
+
+            self._client = redis.Redis(
+                connection_pool=redis.ConnectionPool.from_url(
+                    self._redis_url, max_connections=self._max_connections
+                )
+            )
+        return self._client
+
+    @property
+    def aredis_client(self) -> Any:
+        if self._aclient is None:
+            import redis.asyncio as aioredis
+
+            self._aclient = aioredis.Redis(
+                connection_pool=aioredis.ConnectionPool.from_url(
+                    self._redis_url, max_connections=self._max_connections
+                )
+            )
+        return self._aclient
+
+    def encode(self, message: ChatMessage) -> bytes:
+        return encode_message(message, self.compress_min_size)
+
+    @staticmethod
+    def decode(raw: bytes) -> ChatMessage:
+        return decode_message(raw)
+
+    def expire(self, pipe: Any, *keys: str):
+        """
+        Queue the sliding expiry of `keys` on a pipeline.
+        """
+        if self.ttl:
+            for key in keys:
+                pipe.expire(key, self.ttl)
+
+    def _set_pipeline(self, pipe: Any, key: str, messages: List[ChatMessage]):
+        pipe.delete(key)
+        if messages:
+            pipe.rpush(key, *[self.encode(message) for message in messages])
+        self.expire(pipe, key)
+
+    def set_messages(self, key: str, messages: List[ChatMessage]) -> None:
+        pipe = self.redis_client.pipeline(transaction=True)
+        self._set_pipeline(pipe, key, messages)
+        pipe.execute()
+
+    async def aset_messages(self, key: str, messages: List[ChatMessage]) -> None:
+        pipe = self.aredis_client.pipeline(transaction=True)
+        self._set_pipeline(pipe, key, messages)
+        await pipe.execute()
+
+    def get_messages(self, key: str) -> List[ChatMessage]:
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.lrange(key, 0, -1)
+        self.expire(pipe, key)
+        return [self.decode(raw) for raw in pipe.execute()[0]]
+
+    async def aget_messages(self, key: str) -> List[ChatMessage]:
+        pipe = self.aredis_client.pipeline(transaction=False)
+        pipe.lrange(key, 0, -1)
+        self.expire(pipe, key)
+        return [self.decode(raw) for raw in (await pipe.execute())[0]]
+
+    def add_message(self, key: str, message: ChatMessage) -> None:
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.rpush(key, self.encode(message))
+        self.expire(pipe, key)
+        pipe.execute()
+
+    async def aadd_message(self, key: str, message: ChatMessage) -> None:
+        pipe = self.aredis_client.pipeline(transaction=False)
+        pipe.rpush(key, self.encode(message))
+        self.expire(pipe, key)
+        await pipe.execute()
+
+    def delete_messages(self, key: str) -> Optional[List[ChatMessage]]:
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        return [self.decode(raw) for raw in pipe.execute()[0]]
+
+    async def adelete_messages(self, key: str) -> Optional[List[ChatMessage]]:
+        pipe = self.aredis_client.pipeline(transaction=True)
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        return [self.decode(raw) for raw in (await pipe.execute())[0]]
+
+    def delete_message(self, key: str, idx: int) -> Optional[ChatMessage]:
+        messages = self.get_messages(key)
+        if not 0 <= idx < len(messages):
+            return None
+        removed = messages.pop(idx)
+        self.set_messages(key, messages)
+        return removed
+
+    def delete_last_message(self, key: str) -> Optional[ChatMessage]:
+        raw = self.redis_client.rpop(key)
+        return self.decode(raw) if raw is not None else None
+
+    async def adelete_last_message(self, key: str) -> Optional[ChatMessage]:
+        raw = await self.aredis_client.rpop(key)
+        return self.decode(raw) if raw is not None else None
+
+    def get_keys(self) -> List[str]:
+        return [key.decode("utf-8") for key in self.redis_client.scan_iter()]
+
+    async def aclose(self):
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+chat_store: Optional[PooledRedisChatStore] = None
+
+
+def get_chat_store() -> PooledRedisChatStore:
+    """
+    The chat store shared by the chat and feedback routes. CHAT_STORE_TTL is
+    the sliding expiry of the conversations and CHAT_STORE_COMPRESS_MIN_SIZE
+    the message size from which they are compressed (0 disables it).
+    """
+    global chat_store
+
+    if chat_store is None:
+        chat_store = PooledRedisChatStore(
+            redis_url=os.getenv("REDIS_URL"),
+            ttl=int(os.getenv("CHAT_STORE_TTL", "1800")),
+            compress_min_size=int(os.getenv("CHAT_STORE_COMPRESS_MIN_SIZE", "512")),
+            max_connections=int(os.getenv("CHAT_STORE_MAX_CONNECTIONS", "50")),
+        )
+    return chat_store
+
+
+async def aclose_chat_store():
+    if chat_store is not None:
+        await chat_store.aclose()
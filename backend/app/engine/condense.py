@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import List, Optional
+
+from cachetools import TTLCache
+from llama_index.core.base.llms.generic_utils import messages_to_history_str
+from llama_index.core.llms import LLM, ChatMessage
+from llama_index.core.prompts import BasePromptTemplate
+from llama_index.core.settings import Settings
+
+from app.llm_gateway import GatewayLLM
+from app.llm_router import RoutedLLM
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+
+class CondensePolicy:
+    """
+    Decides when the condense-question LLM call is worth making.
+
+    The question is used as-is when there is no history (nothing to resolve),
+    condensed forms are cached by (history, message), and the condensing can be
+    done by a cheaper model than the one answering.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        llm: Optional[LLM] = None,
+        cache_size: int = 1024,
+        ttl: int = 600,
+    ):
+        self.enabled = enabled
+        self.llm = llm
+        self._cache = TTLCache(maxsize=cache_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._counters = {"skipped": 0, "hits": 0, "condensed": 0}
+
+    @staticmethod
+    def _key(history_str: str, message: str) -> str:
+        return hashlib.sha256(f"{history_str}\n{message}".encode()).hexdigest()
+
+    def _should_skip(self, chat_history: List[ChatMessage]) -> bool:
+        if not self.enabled or len(chat_history) == 0:
+            self._counters["skipped"] += 1
+            return True
+        return False
+
+    def _get_cached(self, key: str) -> Optional[str]:
+        with self._lock:
+            condensed = self._cache.get(key)
+        if condensed is not None:
+            self._counters["hits"] += 1
+        return condensed
+
+    def _set_cached(self, key: str, condensed: str):
+        self._counters["condensed"] += 1
+        with self._lock:
+            self._cache[key] = condensed
+
+    def condense(
+        self,
+        llm: LLM,
+        prompt: BasePromptTemplate,
+        chat_history: List[ChatMessage],
+        message: str,
+    ) -> str:
+        if self._should_skip(chat_history):
+            return message
+        history_str = messages_to_history_str(chat_history)
+        key = self._key(history_str, message)
+        condensed = self._get_cached(key)
+        if condensed is None:
+            condensed = (self.llm or llm).predict(
+                prompt, question=message, chat_history=history_str
+            )
+            self._set_cached(key, condensed)
+        return condensed
+
+    async def acondense(
+        self,
+        llm: LLM,
+        prompt: BasePromptTemplate,
+        chat_history: List[ChatMessage],
+        message: str,
+    ) -> str:
+        if self._should_skip(chat_history):
+            return message
+        history_str = messages_to_history_str(chat_history)
+        key = self._key(history_str, message)
+        condensed = self._get_cached(key)
+        if condensed is None:
+            condensed = await (self.llm or llm).apredict(
+                prompt, question=message, chat_history=history_str
+            )
+            self._set_cached(key, condensed)
+        return condensed
+
+    def stats(self) -> dict:
+        return {**self._counters, "cached": len(self._cache)}
+
+
+def get_condense_llm() -> Optional[LLM]:
+    """
+    Copy of the configured LLM using CONDENSE_MODEL, if set and supported.
+    """
+    model = os.getenv("CONDENSE_MODEL")
+    if not model:
+        return None
+    # Copy the LLM behind the gateway, and keep the copy behind it too
+    llm = Settings.llm.llm if isinstance(Settings.llm, GatewayLLM) else Settings.llm
+    replica_llm = llm.nodes[0] if isinstance(llm, RoutedLLM) else llm
+    if "model" not in replica_llm.__fields__:
+        logger.warning(
+            f"CONDENSE_MODEL ignorado: {replica_llm.class_name()} não permite trocar o modelo"
+        )
+        return None
+    if isinstance(llm, RoutedLLM):
+        condense_llm = llm.copy_nodes(update={"model": model})
+    else:
+        condense_llm = llm.copy(update={"model": model})
+    if isinstance(Settings.llm, GatewayLLM):
+        return Settings.llm.wrap(condense_llm)
+    return condense_llm
+
+
+condense_policy: CondensePolicy = None
+
+
+def get_condense_policy() -> CondensePolicy:
+    global condense_policy
+
+    if condense_policy is None:
+        condense_policy = CondensePolicy(
+            enabled=os.getenv("CONDENSE_QUESTION", "true").lower() == "true",
+            llm=get_condense_llm(),
+            cache_size=int(os.getenv("CONDENSE_CACHE_SIZE", "1024")),
+            ttl=int(os.getenv("CONDENSE_CACHE_TTL", "600")),
+        )
+        register_stats("condense", condense_policy.stats)
+
+    return condense_policy
@@ -0,0 +1,155 @@
+import copy
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from cachetools import LRUCache
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.indices.base_retriever import BaseRetriever
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.settings import Settings
+from llama_index.core.vector_stores.types import MetadataFilters
+
+from app.engine.chat_engine import ChatEngine
+from app.engine.chat_store import PooledRedisChatStore
+from app.engine.condense import get_condense_policy
+from app.engine.index import get_index
+from app.engine.memory import TokenCountedChatMemory
+from app.engine.summary import SummarizingChatMemory
+from app.engine.retriever import PGVectorRetriever
+from app.engine.vectordb import RETRIEVER_MODE
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+MEMORY_TOKEN_LIMIT = 3000
+# "buffer" keeps the latest messages that fit MEMORY_TOKEN_LIMIT, "summary"
+# also compacts the older ones into a running summary (Redis chat store only)
+CHAT_MEMORY_MODE = os.getenv("CHAT_MEMORY_MODE", "buffer")
+RETRIEVER_CACHE_SIZE = int(os.getenv("RETRIEVER_CACHE_SIZE", "64"))
+
+
+class ChatEngineFactory:
+    """
+    Long-lived chat engine factory, one per worker.
+
+    The index, the retrievers (one per set of metadata filters) and the prompts
+    are built once and reused. Per request only the user's memory and the
+    callback handlers are attached to a fresh, cheap chat engine.
+    """
+
+    def __init__(self):
+        self.system_prompt = os.getenv("SYSTEM_PROMPT")
+        self.top_k = int(os.getenv("TOP_K", 3))
+        self.sparse_top_k = int(os.getenv("SPARSE_TOP_K", self.top_k))
+        self.hybrid = RETRIEVER_MODE == "hybrid"
+        self._index = None
+        self._retrievers: LRUCache = LRUCache(maxsize=RETRIEVER_CACHE_SIZE)
+        self._lock = threading.Lock()
+        self._counters = {
+            "engines": 0,
+            "index_builds": 0,
+            "index_build_seconds": 0.0,
+            "retriever_hits": 0,
+            "retriever_builds": 0,
+            "retriever_build_seconds": 0.0,
+        }
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self._lock:
+                if self._index is None:
+                    start = time.perf_counter()
+                    self._index = get_index()
+                    self._counters["index_builds"] += 1
+                    self._counters["index_build_seconds"] += time.perf_counter() - start
+        return self._index
+
+    @staticmethod
+    def _filters_key(filters: Optional[MetadataFilters]) -> Optional[str]:
+        return filters.json() if filters is not None else None
+
+    def get_retriever(self, filters: Optional[MetadataFilters] = None) -> BaseRetriever:
+        key = self._filters_key(filters)
+        retriever = self._retrievers.get(key)
+        if retriever is not None:
+            self._counters["retriever_hits"] += 1
+            return retriever
+
+        index = self.index
+        with self._lock:
+            retriever = self._retrievers.get(key)
+            if retriever is None:
+                start = time.perf_counter()
+                retriever = PGVectorRetriever(
+                    vector_store=index.vector_store,
+                    embed_model=Settings.embed_model,
+                    similarity_top_k=self.top_k,
+                    hybrid=self.hybrid,
+                    sparse_top_k=self.sparse_top_k,
+                    filters=filters,
+                )
+                self._retrievers[key] = retriever
+                self._counters["retriever_builds"] += 1
+                self._counters["retriever_build_seconds"] += (
+                    time.perf_counter() - start
+                )
+        return retriever
+
+    def create_chat_engine(
+        self,
+        chat_store=None,
+        filters: Optional[MetadataFilters] = None,
+        user_uuid: str = "default",
+        handlers: Optional[List[BaseCallbackHandler]] = None,
+        memory_mode: Optional[str] = None,
+    ) -> ChatEngine:
+        callback_manager = CallbackManager(
+            [*Settings.callback_manager.handlers, *(handlers or [])]
+        )
+        # Shallow copy so the request's handlers never leak into the shared retriever
+        retriever = copy.copy(self.get_retriever(filters))
+        retriever.callback_manager = callback_manager
+
+        # Redis histories keep per-message token counts to avoid re-tokenizing
+        if not isinstance(chat_store, PooledRedisChatStore):
+            memory_cls = ChatMemoryBuffer
+        elif (memory_mode or CHAT_MEMORY_MODE) == "summary":
+            memory_cls = SummarizingChatMemory
+        else:
+            memory_cls = TokenCountedChatMemory
+        chat_memory = memory_cls.from_defaults(
+            token_limit=MEMORY_TOKEN_LIMIT,
+            chat_store=chat_store,
+            chat_store_key=user_uuid,
+        )
+
+        self._counters["engines"] += 1
+        return ChatEngine(
+            retriever=retriever,
+            llm=Settings.llm,
+            memory=chat_memory,
+            system_prompt=self.system_prompt,
+            callback_manager=callback_manager,
+            condense_policy=get_condense_policy(),
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._counters, "retrievers_cached": len(self._retrievers)}
+
+
+chat_engine_factory: ChatEngineFactory = None
+
+
+def get_chat_engine_factory() -> ChatEngineFactory:
+    global chat_engine_factory
+
+    if chat_engine_factory is None:
+        chat_engine_factory = ChatEngineFactory()
+        register_stats("chat_engine", chat_engine_factory.stats)
+
+    return chat_engine_factory
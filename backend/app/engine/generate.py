@@ -2,13 +2,18 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+import asyncio
 import logging
 import os
 
+from app.engine.ingestion import get_ingestion_transformations
 from app.engine.loaders import get_documents
 from app.engine.loaders.s3 import S3Loader
+from app.engine.manifest import SourceManifest
+from app.engine.semantic_cache import invalidate_semantic_cache
 from app.engine.vectordb import get_vector_store
 from app.settings import init_settings
+from app.startup import get_startup_timings
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.settings import Settings
@@ -18,9 +23,9 @@ from llama_index.core.storage.docstore import SimpleDocumentStore
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
-s3_loader = S3Loader()
-
 STORAGE_DIR = os.getenv("STORAGE_DIR", "storage")
+# Reload and re-split every source instead of only the changed ones
+GENERATE_FULL = os.getenv("GENERATE_FULL", "false").lower() == "true"
 
 def get_doc_store():
 
@@ -36,7 +41,7 @@ def get_doc_store():
         return SimpleDocumentStore()
 
 
-def run_pipeline(docstore, vector_store, documents):
+def run_pipeline(docstore, vector_store, documents, docstore_strategy="upserts_and_delete"):
     pipeline = IngestionPipeline(
         transformations=[
             SentenceSplitter(
@@ -46,7 +51,7 @@ def run_pipeline(docstore, vector_store, documents):
             Settings.embed_model,
         ],
         docstore=docstore,
-        docstore_strategy="upserts_and_delete",
+        docstore_strategy=docstore_strategy,
         vector_store=vector_store, # Adiciona automaticamente os vetores no vector_store
     )
 
@@ -56,6 +61,32 @@ def run_pipeline(docstore, vector_store, documents):
     return nodes
 
 
+async def arun_pipeline(
+    docstore, vector_store, documents, docstore_strategy="upserts_and_delete"
+):
+    """
+    Like run_pipeline, but splits the documents in a process pool and embeds
+    the chunks in concurrent batches, see get_ingestion_transformations.
+    """
+    pipeline = IngestionPipeline(
+        transformations=get_ingestion_transformations(
+            Settings.embed_model,
+            chunk_size=Settings.chunk_size,
+            chunk_overlap=Settings.chunk_overlap,
+        ),
+        docstore=docstore,
+        docstore_strategy=docstore_strategy,
+        vector_store=vector_store,
+    )
+    return await pipeline.arun(documents=documents)
+
+
+def delete_documents(docstore, vector_store, doc_ids):
+    for doc_id in doc_ids:
+        docstore.delete_document(doc_id, raise_error=False)
+        vector_store.delete(doc_id)
+
+
 def persist_storage(docstore, vector_store):
     storage_context = StorageContext.from_defaults(
         docstore=docstore,
@@ -65,16 +96,48 @@ def persist_storage(docstore, vector_store):
 
 
 def generate_datasource():
-    init_settings()
+    timings = get_startup_timings()
+    with timings.phase("settings"):
+        init_settings()
     logger.info("Gerando index para os dados fornecidos")
 
-    documents = get_documents()
     docstore = get_doc_store()
     vector_store = get_vector_store()
+    manifest = SourceManifest.load(STORAGE_DIR)
+    # Without a previous manifest, every source is loaded and the docstore
+    # strategy removes what is gone, as it can't be told from the manifest
+    full = GENERATE_FULL or manifest.is_new
+    if full:
+        manifest = SourceManifest(manifest.path)
+
+    with timings.phase("load_documents"):
+        documents = get_documents(manifest)
+    # The documents sent by S3 events are not part of the configured loaders
+    manifest.keep_all("s3")
+    stale_doc_ids = [] if full else manifest.stale_doc_ids()
+    logger.info(
+        f"{len(documents)} documentos novos ou alterados, {manifest.skipped} "
+        f"fontes sem alterações, {len(stale_doc_ids)} documentos removidos"
+    )
 
-    _ = run_pipeline(docstore, vector_store, documents)
-    persist_storage(docstore, vector_store)
-
+    with timings.phase("pipeline"):
+        delete_documents(docstore, vector_store, stale_doc_ids)
+        _ = asyncio.run(
+            arun_pipeline(
+                docstore,
+                vector_store,
+                documents,
+                docstore_strategy="upserts_and_delete" if full else "upserts",
+            )
+        )
+    with timings.phase("persist"):
+        persist_storage(docstore, vector_store)
+        manifest.save()
+        vector_store.create_tenant_indexes()
+        vector_store.create_text_search_index()
+    invalidate_semantic_cache()
+
+    timings.complete()
     logger.info("Geração de index concluída")
 
 def generate_single_doc(doc_s3_url: str):
@@ -92,15 +155,35 @@ def generate_single_doc(doc_s3_url: str):
         raise ValueError(f"Documento não encontrado no banco de dados: {doc_s3_url}")
     
     logging.info(f"Metadados coletados")
-    
+
+    s3_loader = S3Loader()
+    manifest = SourceManifest.load(STORAGE_DIR)
+    source = f"s3:{doc_s3_url}"
+    etag = s3_loader.get_etag(doc_s3_url)
+    if manifest.etag_unchanged(source, etag):
+        logger.info(f"Documento {doc_s3_url} sem alterações, nada a indexar")
+        return
+
     documents = s3_loader.get_s3_single_document(doc_s3_url)
     first_document = documents[0]
+    # A stable id, so a new version of the object replaces the previous one
+    first_document.id_ = doc_s3_url
     first_document.metadata = {
         "id_empresa": metadata["id_empresa"],
         "id_unidade": metadata["id_unidade"],
     }
-    _ = run_pipeline(docstore, vector_store, [first_document])
+    # Upserts only: the other documents of the index are not part of this run
+    _ = run_pipeline(docstore, vector_store, [first_document], docstore_strategy="upserts")
     persist_storage(docstore, vector_store)
+    # Until generate_datasource writes the first manifest, its full run
+    # decides what the index holds
+    if not manifest.is_new:
+        manifest.record_etag(source, etag, [first_document])
+        manifest.keep_all()
+        manifest.save()
+    vector_store.create_tenant_indexes(metadata["id_empresa"])
+    vector_store.create_text_search_index()
+    invalidate_semantic_cache()
 
     logger.info("Geração de index do documento concluída")
 
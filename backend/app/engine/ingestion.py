@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, List, Optional, Sequence
+
+from llama_index.core.async_utils import asyncio_run
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+
+logger = logging.getLogger("uvicorn")
+
+
+def _split(nodes: List[BaseNode], chunk_size: int, chunk_overlap: int) -> List[BaseNode]:
+    return SentenceSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    ).get_nodes_from_documents(nodes)
+
+
+class ParallelSentenceSplitter(TransformComponent):
+    """
+    SentenceSplitter that splits the documents across a pool of `workers`
+    processes, in contiguous slices so the chunks keep the document order.
+    Small inputs are split in process.
+    """
+
+    chunk_size: int = Field(description="Chunk size in tokens.")
+    chunk_overlap: int = Field(description="Chunk overlap in tokens.")
+    workers: int = Field(default=1, description="Number of splitter processes.")
+    min_documents: int = Field(
+        default=16, description="Split inputs smaller than this in process."
+    )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ParallelSentenceSplitter"
+
+    def _slices(self, nodes: Sequence[BaseNode]) -> List[List[BaseNode]]:
+        size = -(-len(nodes) // self.workers)
+        return [list(nodes[i : i + size]) for i in range(0, len(nodes), size)]
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        return asyncio_run(self.acall(nodes, **kwargs))
+
+    async def acall(self, nodes: Sequence[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        if self.workers <= 1 or len(nodes) < self.min_documents:
+            return _split(list(nodes), self.chunk_size, self.chunk_overlap)
+
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        pool, _split, nodes_slice, self.chunk_size, self.chunk_overlap
+                    )
+                    for nodes_slice in self._slices(nodes)
+                ]
+            )
+        chunks = [chunk for result in results for chunk in result]
+        logger.info(
+            f"{len(nodes)} documentos divididos em {len(chunks)} chunks por "
+            f"{self.workers} processos em {time.monotonic() - start:.1f}s"
+        )
+        return chunks
+
+
+class ConcurrentEmbedding(TransformComponent):
+    """
+    Embeds the chunks in batches of `batch_size`, with up to `concurrency`
+    batches in flight. A failed batch is retried with exponential backoff and
+    halves the number of batches in flight (the embedding server is taken to
+    be saturated); each `recovery` successful batches in a row add one back,
+    up to `concurrency`.
+    """
+
+    batch_size: int = Field(default=64, description="Chunks per embedding batch.")
+    concurrency: int = Field(default=4, description="Max batches in flight.")
+    max_retries: int = Field(default=5, description="Retries of a failed batch.")
+    backoff: float = Field(default=1.0, description="First retry delay in seconds.")
+    recovery: int = Field(
+        default=8, description="Successful batches in a row to add one in flight."
+    )
+    progress_interval: float = Field(
+        default=10.0, description="Seconds between progress reports."
+    )
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _limit: int = PrivateAttr()
+    _in_flight: int = PrivateAttr(default=0)
+    _streak: int = PrivateAttr(default=0)
+    _condition: Optional[asyncio.Condition] = PrivateAttr(default=None)
+
+    def __init__(self, embed_model: BaseEmbedding, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._embed_model = embed_model
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ConcurrentEmbedding"
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: Any) -> Sequence[BaseNode]:
+        return asyncio_run(self.acall(nodes, **kwargs))
+
+    async def _acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self._limit)
+            self._in_flight += 1
+
+    async def _release(self, saturated: bool):
+        async with self._condition:
+            self._in_flight -= 1
+            if saturated:
+                self._streak = 0
+                if self._limit > 1:
+                    self._limit = max(1, self._limit // 2)
+                    logger.warning(
+                        f"Servidor de embeddings saturado, reduzindo para "
+                        f"{self._limit} lotes simultâneos"
+                    )
+            else:
+                self._streak += 1
+                if self._streak >= self.recovery and self._limit < self.concurrency:
+                    self._streak = 0
+                    self._limit += 1
+            self._condition.notify_all()
+
+    async def _aembed(self, texts: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            try:
+                embeddings = await self._embed_model.aget_text_embedding_batch(texts)
+            except Exception as e:
+                await self._release(saturated=True)
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff * 2**attempt * (0.5 + random.random())
+                logger.warning(
+                    f"Falha ao gerar embeddings de {len(texts)} chunks, nova "
+                    f"tentativa em {delay:.1f}s: {e}"
+                )
+                await asyncio.sleep(delay)
+            else:
+                await self._release(saturated=False)
+                return embeddings
+
+    async def acall(self, nodes: Sequence[BaseNode], **kwargs: Any) -> Sequence[BaseNode]:
+        self._condition = asyncio.Condition()
+        self._limit = self.concurrency
+        self._in_flight = 0
+        self._streak = 0
+        total = len(nodes)
+        done = 0
+        start = last_report = time.monotonic()
+
+        async def aembed_batch(batch: Sequence[BaseNode]) -> None:
+            nonlocal done, last_report
+            embeddings = await self._aembed(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+            )
+            for node, embedding in zip(batch, embeddings):
+                node.embedding = embedding
+            done += len(batch)
+            now = time.monotonic()
+            if now - last_report >= self.progress_interval or done == total:
+                last_report = now
+                logger.info(
+                    f"Embeddings: {done}/{total} chunks "
+                    f"({done / max(now - start, 1e-9):.1f} chunks/s, "
+                    f"{self._limit} lotes simultâneos)"
+                )
+
+        # Batches wait for their turn in _acquire, so creating them all at
+        # once is fine for the sizes generate handles
+        await asyncio.gather(
+            *[
+                aembed_batch(nodes[i : i + self.batch_size])
+                for i in range(0, total, self.batch_size)
+            ]
+        )
+        return nodes
+
+
+def get_ingestion_transformations(
+    embed_model: BaseEmbedding, chunk_size: int, chunk_overlap: int
+) -> List[TransformComponent]:
+    """
+    GENERATE_WORKERS is the number of splitter processes (defaults to the CPU
+    count, up to 4), GENERATE_EMBED_BATCH_SIZE and GENERATE_EMBED_CONCURRENCY
+    the size and max number in flight of the embedding batches.
+    """
+    return [
+        ParallelSentenceSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            workers=int(os.getenv("GENERATE_WORKERS", str(min(4, os.cpu_count() or 1)))),
+        ),
+        ConcurrentEmbedding(
+            embed_model=embed_model,
+            batch_size=int(
+                os.getenv("GENERATE_EMBED_BATCH_SIZE", str(embed_model.embed_batch_size))
+            ),
+            concurrency=int(os.getenv("GENERATE_EMBED_CONCURRENCY", "4")),
+            max_retries=int(os.getenv("GENERATE_EMBED_MAX_RETRIES", "5")),
+        ),
+    ]
@@ -1,9 +1,11 @@
 import logging
+from typing import Optional
 
 import yaml
 from app.engine.loaders.db import DBLoaderConfig, get_db_documents
 from app.engine.loaders.file import FileLoaderConfig, get_file_documents
 from app.engine.loaders.web import WebLoaderConfig, get_web_documents
+from app.engine.manifest import SourceManifest
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +16,11 @@ def load_configs():
     return configs
 
 
-def get_documents():
+def get_documents(manifest: Optional[SourceManifest] = None):
+    """
+    With a manifest, only the documents of the new and changed sources are
+    returned, and the manifest records every source seen.
+    """
     documents = []
     config = load_configs()
     for loader_type, loader_config in config.items():
@@ -23,13 +29,19 @@ def get_documents():
         )
         match loader_type:
             case "file":
-                document = get_file_documents(FileLoaderConfig(**loader_config))
+                document = get_file_documents(
+                    FileLoaderConfig(**loader_config), manifest=manifest
+                )
             case "web":
                 document = get_web_documents(WebLoaderConfig(**loader_config))
+                if manifest is not None:
+                    document = manifest.changed_documents("web", document)
             case "db":
                 document = get_db_documents(
                     configs=[DBLoaderConfig(**cfg) for cfg in loader_config]
                 )
+                if manifest is not None:
+                    document = manifest.changed_documents("db", document)
             case _:
                 raise ValueError(f"Invalid loader type: {loader_type}")
         documents.extend(document)
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import logging
 from typing import List
@@ -21,6 +22,11 @@ def get_db_documents(configs: list[DBLoaderConfig]):
         for query in entry.queries:
             logger.info(f"Loading data from database with query: {query}")
             documents = loader.load_data(query=query)
+            for document in documents:
+                # Rows have no id of their own, identify them by content
+                document.id_ = hashlib.sha256(
+                    f"{entry.uri}\n{query}\n{document.text}".encode()
+                ).hexdigest()
             docs.extend(documents)
 
-    return documents
+    return docs
@@ -1,9 +1,13 @@
 import os
 import logging
-from typing import Dict
-from llama_parse import LlamaParse
+from typing import TYPE_CHECKING, Dict, Optional
 from pydantic import BaseModel, validator
 
+if TYPE_CHECKING:
+    from llama_parse import LlamaParse
+
+    from app.engine.manifest import SourceManifest
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,6 +23,8 @@ class FileLoaderConfig(BaseModel):
 
 
 def llama_parse_parser():
+    from llama_parse import LlamaParse
+
     if os.getenv("LLAMA_CLOUD_API_KEY") is None:
         raise ValueError(
             "LLAMA_CLOUD_API_KEY environment variable is not set. "
@@ -33,14 +39,42 @@ def llama_parse_parser():
     return parser
 
 
-def llama_parse_extractor() -> Dict[str, LlamaParse]:
+def llama_parse_extractor() -> Dict[str, "LlamaParse"]:
     from llama_parse.utils import SUPPORTED_FILE_TYPES
 
     parser = llama_parse_parser()
     return {file_type: parser for file_type in SUPPORTED_FILE_TYPES}
 
 
-def get_file_documents(config: FileLoaderConfig):
+def load_changed_files(reader, manifest: "SourceManifest"):
+    """
+    Load only the files of the reader that are new or changed since the
+    manifest was written.
+    """
+    documents = []
+    unchanged = 0
+    for input_file in reader.input_files:
+        path = str(input_file)
+        source = f"file:{path}"
+        if manifest.file_unchanged(source, path):
+            unchanged += 1
+            continue
+        file_documents = reader.load_file(
+            input_file=input_file,
+            file_metadata=reader.file_metadata,
+            file_extractor=reader.file_extractor,
+            filename_as_id=reader.filename_as_id,
+            encoding=reader.encoding,
+            errors=reader.errors,
+            raise_on_error=reader.raise_on_error,
+        )
+        manifest.record_file(source, path, file_documents)
+        documents.extend(file_documents)
+    logger.info(f"{len(reader.input_files)} arquivos, {unchanged} sem alterações")
+    return reader._exclude_metadata(documents)
+
+
+def get_file_documents(config: FileLoaderConfig, manifest: Optional["SourceManifest"] = None):
     from llama_index.core.readers import SimpleDirectoryReader
 
     try:
@@ -60,6 +94,8 @@ def get_file_documents(config: FileLoaderConfig):
             raise_on_error=True,
             file_extractor=file_extractor,
         )
+        if manifest is not None:
+            return load_changed_files(reader, manifest)
         return reader.load_data()
     except Exception as e:
         import sys
@@ -1,5 +1,4 @@
 import os
-from llama_index.readers.s3 import S3Reader
 
 class S3Loader():
     def __init__(self):
@@ -16,7 +15,23 @@ class S3Loader():
             "bucket": bucket
         }
 
+    def get_etag(self, s3_doc_url: str) -> str:
+        import boto3
+
+        s3_dict_config = self.url_parser(s3_doc_url)
+        s3 = boto3.client(
+            "s3",
+            aws_access_key_id=self.__aws_access_id,
+            aws_secret_access_key=self.__aws_secret_key,
+        )
+        response = s3.head_object(
+            Bucket=s3_dict_config["bucket"], Key=s3_dict_config["key_s3_doc"]
+        )
+        return response["ETag"]
+
     def get_s3_single_document(self, s3_doc_url: str):
+        from llama_index.readers.s3 import S3Reader
+
         s3_dict_config = self.url_parser(s3_doc_url)
         loader = S3Reader(
             bucket=s3_dict_config["bucket"],
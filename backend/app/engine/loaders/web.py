@@ -31,6 +31,9 @@ def get_web_documents(config: WebLoaderConfig):
             max_depth=url.max_depth,
             driver=webdriver.Chrome(options=options),
         )
-        docs.extend(scraper.load_data(url.base_url))
+        for document in scraper.load_data(url.base_url):
+            # Identify the pages by URL, so they keep their id across crawls
+            document.id_ = document.metadata.get("URL", document.id_)
+            docs.append(document)
 
     return docs
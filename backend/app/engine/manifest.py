@@ -0,0 +1,149 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+from llama_index.core.schema import Document
+
+logger = logging.getLogger("uvicorn")
+
+MANIFEST_FILE = "manifest.json"
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_document(document: Document) -> str:
+    return hashlib.sha256(
+        json.dumps(
+            [document.text, document.metadata], sort_keys=True, default=str
+        ).encode()
+    ).hexdigest()
+
+
+class SourceManifest:
+    """
+    Content hash of every indexed source (a file, web page, database row or
+    S3 object) and the ids of the documents loaded from it, persisted next to
+    the docstore. It lets generate skip the sources that didn't change before
+    loading them, and find the documents of the sources that went away.
+
+    Files are compared by mtime and size first and only hashed when those
+    differ; S3 objects by ETag. Web pages and database rows can only be
+    compared once loaded, by the hash of their text and metadata.
+
+    A run builds the next manifest from the sources it sees; `save` replaces
+    the previous one, so call it once the documents are indexed.
+    """
+
+    def __init__(self, path: str, entries: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.path = path
+        self.entries = entries or {}
+        self.next: Dict[str, Dict[str, Any]] = {}
+        self.skipped = 0
+
+    @classmethod
+    def load(cls, storage_dir: str) -> "SourceManifest":
+        path = os.path.join(storage_dir, MANIFEST_FILE)
+        entries = None
+        if os.path.exists(path):
+            with open(path) as f:
+                entries = json.load(f)
+        return cls(path, entries)
+
+    @property
+    def is_new(self) -> bool:
+        return not self.entries
+
+    def _keep(self, source: str, **fields: Any) -> bool:
+        self.next[source] = {**self.entries[source], **fields}
+        self.skipped += 1
+        return True
+
+    def file_unchanged(self, source: str, path: str) -> bool:
+        stat = os.stat(path)
+        entry = self.entries.get(source)
+        if entry is None:
+            return False
+        if entry.get("mtime") == stat.st_mtime and entry.get("size") == stat.st_size:
+            return self._keep(source)
+        if entry.get("hash") == hash_file(path):
+            # Touched but not modified
+            return self._keep(source, mtime=stat.st_mtime, size=stat.st_size)
+        return False
+
+    def record_file(self, source: str, path: str, documents: List[Document]):
+        stat = os.stat(path)
+        self.next[source] = {
+            "hash": hash_file(path),
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "doc_ids": [document.doc_id for document in documents],
+        }
+
+    def etag_unchanged(self, source: str, etag: Optional[str]) -> bool:
+        entry = self.entries.get(source)
+        if etag is None or entry is None or entry.get("etag") != etag:
+            return False
+        return self._keep(source)
+
+    def record_etag(self, source: str, etag: Optional[str], documents: List[Document]):
+        self.next[source] = {
+            "etag": etag,
+            "doc_ids": [document.doc_id for document in documents],
+        }
+
+    def changed_documents(self, prefix: str, documents: Iterable[Document]) -> List[Document]:
+        """
+        The documents whose text or metadata changed, each document being a
+        source identified by `prefix` and its (stable) id.
+        """
+        changed = []
+        for document in documents:
+            source = f"{prefix}:{document.doc_id}"
+            digest = hash_document(document)
+            entry = self.entries.get(source)
+            if entry is not None and entry.get("hash") == digest:
+                self._keep(source)
+                continue
+            self.next[source] = {"hash": digest, "doc_ids": [document.doc_id]}
+            changed.append(document)
+        return changed
+
+    def keep_all(self, prefix: Optional[str] = None):
+        """
+        Carry over the sources under `prefix` (all of them by default) that
+        this run doesn't look at.
+        """
+        for source, entry in self.entries.items():
+            if prefix is None or source.startswith(f"{prefix}:"):
+                self.next.setdefault(source, entry)
+
+    def stale_doc_ids(self) -> List[str]:
+        """
+        Ids of the documents of the sources that are gone, and of those that
+        changed but no longer produce them (e.g. a PDF with fewer pages).
+        """
+        current = {
+            doc_id for entry in self.next.values() for doc_id in entry["doc_ids"]
+        }
+        return [
+            doc_id
+            for entry in self.entries.values()
+            for doc_id in entry["doc_ids"]
+            if doc_id not in current
+        ]
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.next, f)
+        os.replace(tmp_path, self.path)
+        self.entries = self.next
+        self.next = {}
@@ -0,0 +1,552 @@
+import hashlib
+import os
+import threading
+import uuid
+from typing import Any, Generator, List, NamedTuple, Optional, Tuple
+
+from cachetools import TTLCache
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+
+from app.observability import register_stats
+
+# Number of token counts read per round trip when walking back from the tail
+TAIL_CHUNK_SIZE = 32
+# Attempts of a history replacement that keeps racing other writes
+SET_ATTEMPTS = 5
+
+
+class TokenEntry(NamedTuple):
+    role: str
+    tokens: int
+    digest: str
+
+    def encode(self) -> str:
+        return f"{self.role}|{self.tokens}|{self.digest}"
+
+    @classmethod
+    def decode(cls, raw: bytes) -> "TokenEntry":
+        role, tokens, digest = raw.decode("utf-8").split("|", 2)
+        return cls(role, int(tokens), digest)
+
+
+class ConversationTail(NamedTuple):
+    version: Optional[bytes]
+    messages: List[ChatMessage]
+    entries: List[TokenEntry]
+    # Whether older messages were left out
+    truncated: bool
+
+
+class TailCache:
+    """
+    In-process LRU of the latest messages of recent conversations, up to the
+    memory's token limit. Every write to a conversation sets a new random
+    version in Redis; a cached tail is only used while its version is the
+    stored one, so a write by another worker is never missed. Writes made
+    through this process update the cached tail instead of dropping it.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 1800):
+        self.enabled = max_entries > 0
+        self._tails = TTLCache(maxsize=max(max_entries, 1), ttl=ttl)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stale": 0, "appended": 0}
+
+    def get(self, key: str, version: Optional[bytes]) -> Optional[ConversationTail]:
+        if not self.enabled or version is None:
+            return None
+        with self._lock:
+            tail = self._tails.get(key)
+            if tail is not None and tail.version != version:
+                self._counters["stale"] += 1
+                del self._tails[key]
+                return None
+        self._counters["hits" if tail is not None else "misses"] += 1
+        return tail
+
+    def set(
+        self,
+        key: str,
+        version: Optional[bytes],
+        messages: List[ChatMessage],
+        entries: List[TokenEntry],
+        token_limit: int,
+        truncated: bool = False,
+    ) -> ConversationTail:
+        """
+        Cache the tail of the given messages that fits the token limit and
+        return it. Without a version the tail is only returned.
+        """
+        start = 0
+        total = sum(entry.tokens for entry in entries)
+        while start < len(entries) and total > token_limit:
+            total -= entries[start].tokens
+            start += 1
+        tail = ConversationTail(
+            version, messages[start:], entries[start:], truncated or start > 0
+        )
+        if self.enabled:
+            with self._lock:
+                if version is None:
+                    self._tails.pop(key, None)
+                else:
+                    self._tails[key] = tail
+        return tail
+
+    def append(
+        self,
+        key: str,
+        previous: Optional[bytes],
+        version: bytes,
+        message: ChatMessage,
+        entry: TokenEntry,
+        token_limit: int,
+    ):
+        """
+        Write through a message appended to the conversation, if the cached
+        tail was current right before the write.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            tail = self._tails.pop(key, None)
+        if tail is None or previous is None or tail.version != previous:
+            return
+        self._counters["appended"] += 1
+        self.set(
+            key,
+            version,
+            tail.messages + [message],
+            tail.entries + [entry],
+            token_limit,
+            tail.truncated,
+        )
+
+    def stats(self) -> dict:
+        return {**self._counters, "entries": len(self._tails)}
+
+
+tail_cache: Optional[TailCache] = None
+
+
+def get_tail_cache() -> TailCache:
+    """
+    Set CHAT_MEMORY_L1_SIZE=0 to disable the in-process cache of conversation
+    tails.
+    """
+    global tail_cache
+
+    if tail_cache is None:
+        tail_cache = TailCache(
+            max_entries=int(os.getenv("CHAT_MEMORY_L1_SIZE", "1024")),
+            ttl=float(os.getenv("CHAT_MEMORY_L1_TTL", "1800")),
+        )
+        register_stats("chat_memory_l1", tail_cache.stats)
+    return tail_cache
+
+
+class TokenCountedChatMemory(ChatMemoryBuffer):
+    """
+    Chat memory over a PooledRedisChatStore that keeps the token count of every
+    message next to it, so a turn never re-tokenizes the whole history.
+
+    Messages stay in the chat store list (`key`), so other readers of the store
+    are unaffected. A parallel list (`key:tokens`) holds the role, token count
+    and content digest of each message, `key:total` the running total and
+    `key:version` the version of the last write. Reading the memory fetches
+    only the tail of messages that fits the token limit, and serves it from the
+    TailCache while the version is unchanged.
+
+    The async variants (aget, aput, aset, areset) make the same round trips on
+    the store's async client, so the event loop never blocks on Redis.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenCountedChatMemory"
+
+    @property
+    def _client(self) -> Any:
+        return self.chat_store.redis_client
+
+    @property
+    def _aclient(self) -> Any:
+        return self.chat_store.aredis_client
+
+    @property
+    def _tokens_key(self) -> str:
+        return f"{self.chat_store_key}:tokens"
+
+    @property
+    def _total_key(self) -> str:
+        return f"{self.chat_store_key}:total"
+
+    @property
+    def _version_key(self) -> str:
+        return f"{self.chat_store_key}:version"
+
+    @staticmethod
+    def _new_version() -> bytes:
+        return uuid.uuid4().hex.encode()
+
+    @staticmethod
+    def _digest(message: ChatMessage) -> str:
+        return hashlib.sha1(f"{message.role}:{message.content}".encode()).hexdigest()[:12]
+
+    def _entry(self, message: ChatMessage) -> TokenEntry:
+        tokens = len(self.tokenizer_fn(str(message.content))) if message.content else 0
+        return TokenEntry(str(message.role.value), tokens, self._digest(message))
+
+    @property
+    def _keys(self) -> Tuple[str, ...]:
+        return (
+            self.chat_store_key,
+            self._tokens_key,
+            self._total_key,
+            self._version_key,
+        )
+
+    def _expire(self, pipe: Any):
+        self.chat_store.expire(pipe, *self._keys)
+
+    def _decode_messages(self, items: List[bytes]) -> List[ChatMessage]:
+        return [self.chat_store.decode(item) for item in items]
+
+    def _budget(self, initial_token_count: int) -> int:
+        if initial_token_count > self.token_limit:
+            raise ValueError("Initial token count exceeds token limit")
+        return self.token_limit - initial_token_count
+
+    def _state_pipeline(self, pipe: Any):
+        pipe.get(self._total_key)
+        pipe.llen(self.chat_store_key)
+        pipe.llen(self._tokens_key)
+        pipe.get(self._version_key)
+        # Reading the conversation keeps it alive (sliding TTL)
+        self._expire(pipe)
+
+    def _rebuild_pipeline(
+        self, pipe: Any, messages: List[ChatMessage]
+    ) -> List[TokenEntry]:
+        """
+        Queue the token counts of a history written without them (e.g. by a
+        plain RedisChatStore). Only happens once per conversation.
+        """
+        entries = [self._entry(message) for message in messages]
+        pipe.delete(self._tokens_key)
+        if entries:
+            pipe.rpush(self._tokens_key, *[entry.encode() for entry in entries])
+        pipe.set(self._total_key, sum(entry.tokens for entry in entries))
+        self._expire(pipe)
+        return entries
+
+    @staticmethod
+    def _tail_walk(
+        length: int, budget: int
+    ) -> Generator[Tuple[int, int], List[bytes], int]:
+        """
+        Index of the first message of the longest tail that fits the budget,
+        walking back over the token counts in chunks. Yields the (begin, end)
+        range of each chunk to read and is sent the chunk back, so the sync
+        and async memories share the walk.
+        """
+        used = 0
+        end = length
+        while end > 0:
+            begin = max(0, end - TAIL_CHUNK_SIZE)
+            chunk = yield begin, end - 1
+            for offset in range(len(chunk) - 1, -1, -1):
+                used += TokenEntry.decode(chunk[offset]).tokens
+                if used > budget:
+                    return begin + offset + 1
+            end = begin
+        return 0
+
+    def _tail_pipeline(self, pipe: Any, start: int):
+        pipe.lrange(self.chat_store_key, start, -1)
+        pipe.lrange(self._tokens_key, start, -1)
+        pipe.get(self._version_key)
+
+    def _cache_tail(
+        self,
+        version: Optional[bytes],
+        messages: List[ChatMessage],
+        entries: List[TokenEntry],
+        truncated: bool = False,
+    ) -> ConversationTail:
+        return get_tail_cache().set(
+            self.chat_store_key,
+            version,
+            messages,
+            entries,
+            self.token_limit,
+            truncated,
+        )
+
+    def _loaded_tail(
+        self, version: Optional[bytes], start: int, loaded: List[Any]
+    ) -> ConversationTail:
+        raw_messages, raw_entries, current = loaded
+        # Only cache the tail if nothing was written since the version was read
+        return self._cache_tail(
+            current if current == version else None,
+            self._decode_messages(raw_messages),
+            [TokenEntry.decode(raw) for raw in raw_entries],
+            start > 0,
+        )
+
+    @staticmethod
+    def _select(tail: ConversationTail, budget: int) -> List[ChatMessage]:
+        """
+        The messages of the tail that fit the budget.
+        """
+        used = 0
+        start = 0
+        truncated = tail.truncated
+        for index in range(len(tail.entries) - 1, -1, -1):
+            used += tail.entries[index].tokens
+            if used > budget:
+                start = index + 1
+                truncated = True
+                break
+
+        # A truncated history can't start with an assistant or tool message
+        if truncated:
+            while start < len(tail.entries) and tail.entries[start].role in (
+                MessageRole.ASSISTANT.value,
+                MessageRole.TOOL.value,
+            ):
+                start += 1
+        return tail.messages[start:]
+
+    def get(
+        self, input: Optional[str] = None, initial_token_count: int = 0, **kwargs: Any
+    ) -> List[ChatMessage]:
+        budget = self._budget(initial_token_count)
+
+        pipe = self._client.pipeline()
+        self._state_pipeline(pipe)
+        total, length, counted, version = pipe.execute()[:4]
+        if length == 0:
+            return []
+        tail = get_tail_cache().get(self.chat_store_key, version)
+        if tail is not None:
+            return self._select(tail, budget)
+
+        if total is None or length != counted:
+            messages = self._decode_messages(
+                self._client.lrange(self.chat_store_key, 0, -1)
+            )
+            pipe = self._client.pipeline()
+            entries = self._rebuild_pipeline(pipe, messages)
+            pipe.execute()
+            return self._select(self._cache_tail(version, messages, entries), budget)
+
+        start = 0
+        if int(total) > self.token_limit:
+            walk = self._tail_walk(length, self.token_limit)
+            try:
+                begin, end = next(walk)
+                while True:
+                    begin, end = walk.send(self._client.lrange(self._tokens_key, begin, end))
+            except StopIteration as stop:
+                start = stop.value
+        pipe = self._client.pipeline()
+        self._tail_pipeline(pipe, start)
+        return self._select(self._loaded_tail(version, start, pipe.execute()), budget)
+
+    async def aget(
+        self, input: Optional[str] = None, initial_token_count: int = 0, **kwargs: Any
+    ) -> List[ChatMessage]:
+        budget = self._budget(initial_token_count)
+
+        pipe = self._aclient.pipeline()
+        self._state_pipeline(pipe)
+        total, length, counted, version = (await pipe.execute())[:4]
+        if length == 0:
+            return []
+        tail = get_tail_cache().get(self.chat_store_key, version)
+        if tail is not None:
+            return self._select(tail, budget)
+
+        if total is None or length != counted:
+            messages = self._decode_messages(
+                await self._aclient.lrange(self.chat_store_key, 0, -1)
+            )
+            pipe = self._aclient.pipeline()
+            entries = self._rebuild_pipeline(pipe, messages)
+            await pipe.execute()
+            return self._select(self._cache_tail(version, messages, entries), budget)
+
+        start = 0
+        if int(total) > self.token_limit:
+            walk = self._tail_walk(length, self.token_limit)
+            try:
+                begin, end = next(walk)
+                while True:
+                    begin, end = walk.send(
+                        await self._aclient.lrange(self._tokens_key, begin, end)
+                    )
+            except StopIteration as stop:
+                start = stop.value
+        pipe = self._aclient.pipeline()
+        self._tail_pipeline(pipe, start)
+        return self._select(
+            self._loaded_tail(version, start, await pipe.execute()), budget
+        )
+
+    def _put_pipeline(
+        self, pipe: Any, message: ChatMessage
+    ) -> Tuple[TokenEntry, bytes]:
+        entry = self._entry(message)
+        version = self._new_version()
+        pipe.set(self._version_key, version, get=True)
+        pipe.rpush(self.chat_store_key, self.chat_store.encode(message))
+        pipe.rpush(self._tokens_key, entry.encode())
+        pipe.incrby(self._total_key, entry.tokens)
+        self._expire(pipe)
+        return entry, version
+
+    def _cache_put(
+        self,
+        message: ChatMessage,
+        entry: TokenEntry,
+        previous: Optional[bytes],
+        version: bytes,
+    ):
+        get_tail_cache().append(
+            self.chat_store_key, previous, version, message, entry, self.token_limit
+        )
+
+    def put(self, message: ChatMessage) -> None:
+        pipe = self._client.pipeline()
+        entry, version = self._put_pipeline(pipe, message)
+        previous = pipe.execute()[0]
+        self._cache_put(message, entry, previous, version)
+
+    async def aput(self, message: ChatMessage) -> None:
+        pipe = self._aclient.pipeline()
+        entry, version = self._put_pipeline(pipe, message)
+        previous = (await pipe.execute())[0]
+        self._cache_put(message, entry, previous, version)
+
+    def _set_read_pipeline(self, pipe: Any):
+        pipe.lrange(self._tokens_key, 0, -1)
+        pipe.llen(self.chat_store_key)
+        pipe.get(self._version_key)
+
+    def _set_pipeline(
+        self, pipe: Any, state: List[Any], messages: List[ChatMessage]
+    ) -> Tuple[List[TokenEntry], bytes, List[ChatMessage]]:
+        """
+        Queue the writes replacing the stored history with `messages`, given
+        the `state` read by _set_read_pipeline. Returns the token entries, the
+        new version and the messages as stored.
+        """
+        stored_raw, length = state[:2]
+        stored = [TokenEntry.decode(raw) for raw in stored_raw]
+        if len(stored) != length:
+            stored = []
+
+        common = 0
+        while (
+            common < len(stored)
+            and common < len(messages)
+            and stored[common].digest == self._digest(messages[common])
+        ):
+            common += 1
+
+        entries = stored[:common] + [self._entry(m) for m in messages[common:]]
+        if common == 0:
+            pipe.delete(self.chat_store_key, self._tokens_key)
+        elif common < len(stored):
+            pipe.ltrim(self.chat_store_key, 0, common - 1)
+            pipe.ltrim(self._tokens_key, 0, common - 1)
+        if common < len(messages):
+            pipe.rpush(
+                self.chat_store_key,
+                *[self.chat_store.encode(message) for message in messages[common:]],
+            )
+            pipe.rpush(
+                self._tokens_key, *[entry.encode() for entry in entries[common:]]
+            )
+        pipe.set(self._total_key, sum(entry.tokens for entry in entries))
+        version = self._new_version()
+        pipe.set(self._version_key, version)
+        self._expire(pipe)
+        return entries, version, messages
+
+    def set(self, messages: List[ChatMessage]) -> None:
+        """
+        Replace the history, only tokenizing and writing the messages that
+        differ from the stored ones. The frontend resends the whole history on
+        every turn, so usually only the messages since the last turn are new.
+
+        The writes are computed from the state read first, so they are only
+        applied if the version is still the one read (WATCH), and computed
+        again otherwise.
+        """
+        import redis
+
+        for attempt in range(SET_ATTEMPTS):
+            pipe = self._client.pipeline(transaction=True)
+            self._set_read_pipeline(pipe)
+            state = pipe.execute()
+
+            with self._client.pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(self._version_key)
+                    if pipe.get(self._version_key) != state[2]:
+                        continue
+                    pipe.multi()
+                    entries, version, stored = self._set_pipeline(pipe, state, messages)
+                    pipe.execute()
+                except redis.WatchError:
+                    continue
+            self._cache_tail(version, stored, entries)
+            return
+        raise redis.WatchError(f"Conversa {self.chat_store_key} alterada durante a escrita")
+
+    async def aset(self, messages: List[ChatMessage]) -> None:
+        import redis
+
+        for attempt in range(SET_ATTEMPTS):
+            pipe = self._aclient.pipeline(transaction=True)
+            self._set_read_pipeline(pipe)
+            state = await pipe.execute()
+
+            async with self._aclient.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(self._version_key)
+                    if await pipe.get(self._version_key) != state[2]:
+                        continue
+                    pipe.multi()
+                    entries, version, stored = self._set_pipeline(pipe, state, messages)
+                    await pipe.execute()
+                except redis.WatchError:
+                    continue
+            self._cache_tail(version, stored, entries)
+            return
+        raise redis.WatchError(f"Conversa {self.chat_store_key} alterada durante a escrita")
+
+    def _reset_pipeline(self, pipe: Any) -> bytes:
+        # The version is replaced, not deleted, so it never goes back to a
+        # value a cached tail may still hold
+        version = self._new_version()
+        pipe.delete(*[key for key in self._keys if key != self._version_key])
+        pipe.set(self._version_key, version)
+        self._expire(pipe)
+        return version
+
+    def reset(self) -> None:
+        pipe = self._client.pipeline()
+        version = self._reset_pipeline(pipe)
+        pipe.execute()
+        self._cache_tail(version, [], [])
+
+    async def areset(self) -> None:
+        pipe = self._aclient.pipeline()
+        version = self._reset_pipeline(pipe)
+        await pipe.execute()
+        self._cache_tail(version, [], [])
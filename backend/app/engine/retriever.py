@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import (
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+# Constant of the reciprocal rank fusion, 60 is the value from the original paper
+RRF_K = 60
+
+
+class RetrievalTimings:
+    """
+    Accumulated per-stage retrieval timings, by retriever mode, so the hybrid
+    and dense-only paths can be compared.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Dict[str, Dict[str, float]]] = {}
+
+    def record(self, mode: str, stage: str, seconds: float):
+        stage_stats = self._stages.setdefault(mode, {}).setdefault(
+            stage, {"count": 0, "seconds": 0.0}
+        )
+        stage_stats["count"] += 1
+        stage_stats["seconds"] += seconds
+
+    def stats(self) -> dict:
+        return {
+            mode: {
+                stage: {
+                    **values,
+                    "avg_ms": values["seconds"] / values["count"] * 1000,
+                }
+                for stage, values in stages.items()
+            }
+            for mode, stages in self._stages.items()
+        }
+
+
+retrieval_timings = RetrievalTimings()
+register_stats("retrieval", retrieval_timings.stats)
+
+
+def reciprocal_rank_fusion(
+    results: List[List[NodeWithScore]], top_k: int, k: int = RRF_K
+) -> List[NodeWithScore]:
+    scores: Dict[str, float] = {}
+    nodes: Dict[str, NodeWithScore] = {}
+    for result in results:
+        for rank, node in enumerate(result):
+            node_id = node.node.node_id
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (k + rank + 1)
+            nodes.setdefault(node_id, node)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [NodeWithScore(node=nodes[i].node, score=scores[i]) for i in ranked]
+
+
+class PGVectorRetriever(BaseRetriever):
+    """
+    Retriever over the pgvector table, either dense-only or hybrid.
+
+    In hybrid mode the Postgres full-text search (over the text_search_tsv
+    column) runs concurrently with the query embedding and the dense search,
+    and both rankings are merged by reciprocal rank fusion.
+    """
+
+    def __init__(
+        self,
+        vector_store: Any,
+        embed_model: BaseEmbedding,
+        similarity_top_k: int,
+        hybrid: bool = False,
+        sparse_top_k: Optional[int] = None,
+        filters: Optional[MetadataFilters] = None,
+        callback_manager: Optional[CallbackManager] = None,
+    ):
+        super().__init__(callback_manager=callback_manager)
+        self._vector_store = vector_store
+        self._embed_model = embed_model
+        self._similarity_top_k = similarity_top_k
+        self._sparse_top_k = sparse_top_k or similarity_top_k
+        self._hybrid = hybrid
+        self._filters = filters
+        self._mode = "hybrid" if hybrid else "dense"
+
+    def _dense_query(self, embedding: List[float]) -> VectorStoreQuery:
+        return VectorStoreQuery(
+            query_embedding=embedding,
+            similarity_top_k=self._similarity_top_k,
+            filters=self._filters,
+            mode=VectorStoreQueryMode.DEFAULT,
+        )
+
+    def _sparse_query(self, query_str: str) -> VectorStoreQuery:
+        return VectorStoreQuery(
+            query_str=query_str,
+            similarity_top_k=self._sparse_top_k,
+            sparse_top_k=self._sparse_top_k,
+            filters=self._filters,
+            mode=VectorStoreQueryMode.TEXT_SEARCH,
+        )
+
+    @staticmethod
+    def _to_nodes(result: VectorStoreQueryResult) -> List[NodeWithScore]:
+        similarities = result.similarities or [None] * len(result.nodes)
+        return [
+            NodeWithScore(node=node, score=score)
+            for node, score in zip(result.nodes, similarities)
+        ]
+
+    def _record(self, stage: str, start: float) -> float:
+        now = time.perf_counter()
+        retrieval_timings.record(self._mode, stage, now - start)
+        return now
+
+    def _merge(
+        self, dense: List[NodeWithScore], sparse: Optional[List[NodeWithScore]]
+    ) -> List[NodeWithScore]:
+        if not self._hybrid or sparse is None:
+            return dense
+        start = time.perf_counter()
+        nodes = reciprocal_rank_fusion([dense, sparse], self._similarity_top_k)
+        self._record("fusion", start)
+        return nodes
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        start = total_start = time.perf_counter()
+        sparse = None
+        if self._hybrid:
+            try:
+                sparse = self._to_nodes(
+                    self._vector_store.query(self._sparse_query(query_bundle.query_str))
+                )
+            except Exception as e:
+                logger.warning(f"Busca textual indisponível, usando apenas a densa: {e}")
+            start = self._record("sparse", start)
+
+        embedding = query_bundle.embedding or self._embed_model.get_agg_embedding_from_queries(
+            query_bundle.embedding_strs
+        )
+        start = self._record("embed", start)
+        dense = self._to_nodes(self._vector_store.query(self._dense_query(embedding)))
+        self._record("dense", start)
+
+        nodes = self._merge(dense, sparse)
+        self._record("total", total_start)
+        return nodes
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        total_start = time.perf_counter()
+
+        async def timed(stage: str, coroutine):
+            start = time.perf_counter()
+            try:
+                return await coroutine
+            finally:
+                self._record(stage, start)
+
+        sparse_task = None
+        if self._hybrid:
+            # The text search doesn't need the embedding, so it starts right away
+            sparse_task = asyncio.create_task(
+                timed(
+                    "sparse",
+                    self._vector_store.aquery(self._sparse_query(query_bundle.query_str)),
+                )
+            )
+
+        try:
+            embedding = query_bundle.embedding or await timed(
+                "embed",
+                self._embed_model.aget_agg_embedding_from_queries(query_bundle.embedding_strs),
+            )
+            dense = self._to_nodes(
+                await timed("dense", self._vector_store.aquery(self._dense_query(embedding)))
+            )
+        except BaseException:
+            # Don't leave the text search running (and its error unretrieved)
+            if sparse_task is not None:
+                sparse_task.cancel()
+                sparse_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            raise
+
+        sparse = None
+        if sparse_task is not None:
+            try:
+                sparse = self._to_nodes(await sparse_task)
+            except Exception as e:
+                logger.warning(f"Busca textual indisponível, usando apenas a densa: {e}")
+
+        nodes = self._merge(dense, sparse)
+        self._record("total", total_start)
+        return nodes
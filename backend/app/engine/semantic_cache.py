@@ -0,0 +1,283 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+from llama_index.core.schema import NodeWithScore, TextNode
+from llama_index.core.settings import Settings
+from llama_index.core.vector_stores.types import MetadataFilters
+
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+KEY_PREFIX = "semantic_cache"
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    source_nodes: List[NodeWithScore]
+    similarity: float
+
+
+@dataclass
+class CacheLookup:
+    question: str
+    embedding: np.ndarray
+    namespace: str
+    answer: Optional[CachedAnswer] = None
+
+
+def serialize_nodes(nodes: List[NodeWithScore]) -> List[dict]:
+    return [
+        {
+            "id": node.node.node_id,
+            "text": node.node.get_content(),
+            "metadata": node.node.metadata,
+            "score": node.score,
+        }
+        for node in nodes
+    ]
+
+
+def deserialize_nodes(nodes: List[dict]) -> List[NodeWithScore]:
+    return [
+        NodeWithScore(
+            node=TextNode(id_=node["id"], text=node["text"], metadata=node["metadata"]),
+            score=node["score"],
+        )
+        for node in nodes
+    ]
+
+
+class SemanticAnswerCache:
+    """
+    Answer cache keyed on the embedding of the condensed question and the
+    metadata filters of the request, stored in Redis.
+
+    Every filter set gets its own namespace: a sorted set of entry ids scored by
+    last access (used for LRU eviction) and one hash per entry holding the
+    normalized embedding and the answer payload, which expires after the TTL.
+    Embeddings never change for an entry id, so each worker keeps a local copy
+    and only fetches the embeddings of entries it hasn't seen yet.
+    """
+
+    def __init__(
+        self,
+        redis_url: str,
+        threshold: float = 0.95,
+        ttl: int = 3600,
+        max_entries: int = 1000,
+    ):
+        self.redis_url = redis_url
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._aredis = None
+        self._embeddings: Dict[str, Dict[str, np.ndarray]] = {}
+        self._counters = {"lookups": 0, "hits": 0, "stores": 0, "evictions": 0}
+
+    @property
+    def aredis(self):
+        if self._aredis is None:
+            import redis.asyncio as aioredis
+
+            self._aredis = aioredis.from_url(self.redis_url)
+        return self._aredis
+
+    @staticmethod
+    def _namespace(filters: Optional[MetadataFilters]) -> str:
+        filters_key = filters.json() if filters is not None else ""
+        return hashlib.sha1(filters_key.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def _lru_key(namespace: str) -> str:
+        return f"{KEY_PREFIX}:{namespace}:lru"
+
+    @staticmethod
+    def _entry_key(namespace: str, entry_id: str) -> str:
+        return f"{KEY_PREFIX}:{namespace}:entry:{entry_id}"
+
+    async def aembed(self, question: str) -> np.ndarray:
+        embedding = np.asarray(
+            await Settings.embed_model.aget_query_embedding(question), dtype=np.float32
+        )
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    async def _sync_embeddings(self, namespace: str) -> Dict[str, np.ndarray]:
+        entry_ids = [
+            entry_id.decode()
+            for entry_id in await self.aredis.zrange(self._lru_key(namespace), 0, -1)
+        ]
+        local = self._embeddings.setdefault(namespace, {})
+        for entry_id in set(local) - set(entry_ids):
+            del local[entry_id]
+
+        missing = [entry_id for entry_id in entry_ids if entry_id not in local]
+        if missing:
+            pipe = self.aredis.pipeline()
+            for entry_id in missing:
+                pipe.hget(self._entry_key(namespace, entry_id), "embedding")
+            expired = []
+            for entry_id, raw in zip(missing, await pipe.execute()):
+                if raw is None:
+                    expired.append(entry_id)
+                else:
+                    local[entry_id] = np.frombuffer(raw, dtype=np.float32)
+            if expired:
+                await self.aredis.zrem(self._lru_key(namespace), *expired)
+        return local
+
+    async def _afind(
+        self, namespace: str, embedding: np.ndarray
+    ) -> Optional[CachedAnswer]:
+        embeddings = await self._sync_embeddings(namespace)
+        if not embeddings:
+            return None
+
+        entry_ids = list(embeddings)
+        similarities = np.stack([embeddings[i] for i in entry_ids]) @ embedding
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < self.threshold:
+            return None
+
+        entry_id = entry_ids[best]
+        raw = await self.aredis.hget(self._entry_key(namespace, entry_id), "payload")
+        if raw is None:
+            # Expired since the embeddings were synced
+            embeddings.pop(entry_id, None)
+            await self.aredis.zrem(self._lru_key(namespace), entry_id)
+            return None
+        await self.aredis.zadd(self._lru_key(namespace), {entry_id: time.time()})
+
+        payload = json.loads(raw)
+        return CachedAnswer(
+            question=payload["question"],
+            answer=payload["answer"],
+            source_nodes=deserialize_nodes(payload["nodes"]),
+            similarity=similarity,
+        )
+
+    async def alookup(
+        self, question: str, filters: Optional[MetadataFilters] = None
+    ) -> CacheLookup:
+        """
+        Look up an answer for the (condensed) question. The returned lookup is
+        passed back to `astore` on a miss, so the question is embedded only once.
+        """
+        self._counters["lookups"] += 1
+        lookup = CacheLookup(
+            question=question,
+            embedding=await self.aembed(question),
+            namespace=self._namespace(filters),
+        )
+        try:
+            lookup.answer = await self._afind(lookup.namespace, lookup.embedding)
+        except Exception as e:
+            logger.error(f"Erro ao consultar o cache semântico: {e}")
+        if lookup.answer is not None:
+            self._counters["hits"] += 1
+        return lookup
+
+    async def astore(
+        self, lookup: CacheLookup, answer: str, source_nodes: List[NodeWithScore]
+    ):
+        if not answer:
+            return
+        namespace = lookup.namespace
+        entry_id = uuid.uuid4().hex
+        entry_key = self._entry_key(namespace, entry_id)
+        lru_key = self._lru_key(namespace)
+        payload = {
+            "question": lookup.question,
+            "answer": answer,
+            "nodes": serialize_nodes(source_nodes),
+        }
+        try:
+            pipe = self.aredis.pipeline()
+            pipe.hset(
+                entry_key,
+                mapping={
+                    "embedding": lookup.embedding.astype(np.float32).tobytes(),
+                    "payload": json.dumps(payload),
+                },
+            )
+            pipe.expire(entry_key, self.ttl)
+            pipe.zadd(lru_key, {entry_id: time.time()})
+            pipe.expire(lru_key, self.ttl)
+            pipe.zcard(lru_key)
+            size = (await pipe.execute())[-1]
+            self._counters["stores"] += 1
+
+            if size > self.max_entries:
+                evicted = await self.aredis.zpopmin(lru_key, size - self.max_entries)
+                await self.aredis.delete(
+                    *[self._entry_key(namespace, entry_id.decode()) for entry_id, _ in evicted]
+                )
+                self._counters["evictions"] += len(evicted)
+        except Exception as e:
+            logger.error(f"Erro ao armazenar resposta no cache semântico: {e}")
+
+    def invalidate(self):
+        """
+        Drop every cached answer. Called whenever the indexed corpus changes.
+        """
+        import redis
+
+        client = redis.from_url(self.redis_url)
+        keys = list(client.scan_iter(match=f"{KEY_PREFIX}:*", count=1000))
+        for i in range(0, len(keys), 1000):
+            client.unlink(*keys[i : i + 1000])
+        self._embeddings.clear()
+        logger.info(f"Cache semântico invalidado ({len(keys)} chaves removidas)")
+
+    def stats(self) -> dict:
+        lookups = self._counters["lookups"]
+        return {
+            **self._counters,
+            "hit_rate": self._counters["hits"] / lookups if lookups else 0.0,
+        }
+
+
+semantic_cache: Optional[SemanticAnswerCache] = None
+
+
+def get_semantic_cache() -> Optional[SemanticAnswerCache]:
+    """
+    Return the semantic answer cache, or None if it is disabled.
+    Enable it with SEMANTIC_CACHE_ENABLED=true.
+    """
+    global semantic_cache
+
+    if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() != "true":
+        return None
+
+    if semantic_cache is None:
+        semantic_cache = SemanticAnswerCache(
+            redis_url=os.getenv("REDIS_URL"),
+            threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+            ttl=int(os.getenv("SEMANTIC_CACHE_TTL", "3600")),
+            max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000")),
+        )
+        register_stats("semantic_cache", semantic_cache.stats)
+
+    return semantic_cache
+
+
+def invalidate_semantic_cache():
+    cache = get_semantic_cache()
+    if cache is None:
+        return
+    try:
+        cache.invalidate()
+    except Exception as e:
+        logger.error(f"Erro ao invalidar o cache semântico: {e}")
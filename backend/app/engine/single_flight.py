@@ -0,0 +1,401 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import uuid
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Set
+
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.vector_stores.types import MetadataFilters
+
+from app.engine.chat_engine import ChatEngine
+from app.engine.semantic_cache import deserialize_nodes, serialize_nodes
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+KEY_PREFIX = "single_flight"
+
+
+class SharedStream:
+    """
+    Tokens of one upstream LLM stream, buffered so that every subscriber
+    receives the whole answer no matter when it joined.
+    """
+
+    def __init__(
+        self,
+        source_nodes: List[NodeWithScore],
+        on_abandoned: Optional[Callable[[], None]] = None,
+    ):
+        self.source_nodes = source_nodes
+        self.tokens: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.subscribers = 0
+        self.on_abandoned = on_abandoned
+        self._changed = asyncio.Event()
+
+    def subscribe(self):
+        self.subscribers += 1
+
+    def unsubscribe(self):
+        """
+        Drop a subscriber that stopped reading. The upstream keeps running
+        for the others and is only abandoned with the last one.
+        """
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done and self.on_abandoned is not None:
+            self.on_abandoned()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, token: str):
+        self.tokens.append(token)
+        self._notify()
+
+    def finish(self, error: Optional[Exception] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def iterate(self) -> AsyncGenerator[str, None]:
+        position = 0
+        while True:
+            changed = self._changed
+            while position < len(self.tokens):
+                yield self.tokens[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class SharedStreamResponse:
+    """
+    Subscriber view of a shared stream, with the parts of
+    StreamingAgentChatResponse that VercelStreamResponse uses.
+    """
+
+    def __init__(
+        self,
+        shared: SharedStream,
+        on_complete: Optional[Callable[[str], Awaitable[None]]] = None,
+    ):
+        self._shared = shared
+        self._on_complete = on_complete
+        self._subscribed = True
+        self.source_nodes = shared.source_nodes
+        self.sources = []
+        self.response = ""
+        shared.subscribe()
+
+    @property
+    def is_follower(self) -> bool:
+        return self._on_complete is not None
+
+    async def async_response_gen(self) -> AsyncGenerator[str, None]:
+        tokens = []
+        async for token in self._shared.iterate():
+            tokens.append(token)
+            yield token
+        self.response = "".join(tokens).strip()
+        self._subscribed = False
+        self._shared.unsubscribe()
+        if self._on_complete is not None:
+            await self._on_complete(self.response)
+
+    def cancel(self):
+        if self._subscribed:
+            self._subscribed = False
+            self._shared.unsubscribe()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent chat questions without history into one
+    upstream LLM stream whose tokens are fanned out to every waiting request.
+
+    Within a worker the streams are shared in memory. With a Redis URL, the
+    first worker to take the leader lock for a question also publishes the
+    stream to a Redis stream named after its lock token, which the other
+    workers subscribe to.
+    """
+
+    def __init__(
+        self,
+        redis_url: Optional[str] = None,
+        lease: int = 120,
+        timeout: float = 30,
+    ):
+        self.redis_url = redis_url
+        self.lease = lease
+        self.timeout = timeout
+        self._aredis = None
+        self._flights: Dict[str, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._counters = {
+            "leaders": 0,
+            "local_followers": 0,
+            "remote_followers": 0,
+            "fallbacks": 0,
+            "abandoned": 0,
+        }
+
+    @property
+    def aredis(self):
+        if self._aredis is None:
+            import redis.asyncio as aioredis
+
+            self._aredis = aioredis.from_url(self.redis_url)
+        return self._aredis
+
+    @staticmethod
+    def _key(message: str, filters: Optional[MetadataFilters]) -> str:
+        filters_key = filters.json() if filters is not None else ""
+        return hashlib.sha256(f"{filters_key}\n{message}".encode()).hexdigest()
+
+    async def astream_chat(
+        self,
+        chat_engine: ChatEngine,
+        message: str,
+        filters: Optional[MetadataFilters] = None,
+    ) -> SharedStreamResponse:
+        key = self._key(message, filters)
+        flight = self._flights.get(key)
+        if flight is not None:
+            self._counters["local_followers"] += 1
+            # Like the leader's astream_chat(message, []), start from an
+            # empty history: the client sent none
+            await chat_engine.aset_memory([])
+            shared = await asyncio.shield(flight)
+            return SharedStreamResponse(
+                shared, lambda answer: chat_engine.aremember(message, answer)
+            )
+
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        try:
+            shared = None
+            if self.redis_url:
+                shared = await self._ajoin_remote(key)
+            if shared is not None:
+                self._counters["remote_followers"] += 1
+                await chat_engine.aset_memory([])
+                on_complete = lambda answer: chat_engine.aremember(message, answer)
+            else:
+                self._counters["leaders"] += 1
+                shared = await self._alead(key, chat_engine, message)
+                on_complete = None
+            flight.set_result(shared)
+        except Exception as e:
+            self._flights.pop(key, None)
+            flight.set_exception(e)
+            # Mark the exception as retrieved in case nobody else is waiting
+            flight.exception()
+            raise
+        return SharedStreamResponse(shared, on_complete)
+
+    async def _alead(
+        self, key: str, chat_engine: ChatEngine, message: str
+    ) -> SharedStream:
+        leader = False
+        token = uuid.uuid4().hex
+        if self.redis_url:
+            try:
+                leader = await self.aredis.set(
+                    f"{KEY_PREFIX}:{key}:leader", token, nx=True, ex=self.lease
+                )
+            except Exception as e:
+                logger.warning(f"Single-flight sem coordenação via Redis: {e}")
+
+        stream_key = self._stream_key(key, token)
+        try:
+            response = await chat_engine.astream_chat(message, [])
+            shared = SharedStream(response.source_nodes)
+            if leader:
+                await self._apublish(
+                    stream_key, "start", json.dumps(serialize_nodes(response.source_nodes))
+                )
+        except BaseException:
+            # Don't leave the other workers following a flight that never started
+            if leader:
+                await self._apublish(stream_key, "end", "error")
+                await self._arelease_leader(key, token)
+            raise
+
+        async def pump():
+            error = None
+            try:
+                async for delta in response.async_response_gen():
+                    shared.publish(delta)
+                    if leader:
+                        await self._apublish(stream_key, "token", delta)
+            except Exception as e:
+                error = e
+                logger.error(f"Erro no stream compartilhado: {e}")
+            finally:
+                shared.finish(error)
+                self._release(key, shared)
+                if leader:
+                    await self._apublish(stream_key, "end", "error" if error else "")
+                    await self._arelease_leader(key, token)
+
+        task = self._start(pump())
+        if not leader:
+            # Workers subscribed through Redis aren't counted, so only a
+            # stream that isn't published can be abandoned
+            shared.on_abandoned = lambda: self._abandon(key, task, response)
+        return shared
+
+    async def _arelease_leader(self, key: str, token: str):
+        """
+        Delete the leader lock if this flight still holds it: past the lease
+        it may belong to the leader of a new flight.
+        """
+        lock_key = f"{KEY_PREFIX}:{key}:leader"
+        try:
+            async with self.aredis.pipeline(transaction=True) as pipe:
+                await pipe.watch(lock_key)
+                if await pipe.get(lock_key) != token.encode():
+                    return
+                pipe.multi()
+                pipe.delete(lock_key)
+                await pipe.execute()
+        except Exception:
+            # Including a WatchError, the lock changed hands meanwhile
+            pass
+
+    @staticmethod
+    def _stream_key(key: str, token: str) -> str:
+        # One stream per flight, so a follower never reads the entries of a
+        # previous flight for the same question
+        return f"{KEY_PREFIX}:{key}:stream:{token}"
+
+    def _start(self, coroutine) -> asyncio.Task:
+        # Keep a reference so the pump isn't garbage collected while running
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _release(self, key: str, shared: SharedStream):
+        # Only drop the flight of this stream, a new one may have replaced it
+        flight = self._flights.get(key)
+        if flight is not None and flight.done() and flight.result() is shared:
+            del self._flights[key]
+
+    def _abandon(self, key: str, task: asyncio.Task, response: Any = None):
+        """
+        Stop a stream that lost all of its subscribers.
+        """
+        self._counters["abandoned"] += 1
+        # New requests for the same question must start a new flight
+        self._flights.pop(key, None)
+        task.cancel()
+        if response is not None:
+            response.cancel()
+
+    async def _apublish(self, stream_key: str, entry_type: str, data: str):
+        try:
+            pipe = self.aredis.pipeline()
+            pipe.xadd(stream_key, {"type": entry_type, "data": data})
+            pipe.expire(stream_key, self.lease)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Erro ao publicar stream compartilhado no Redis: {e}")
+
+    async def _ajoin_remote(self, key: str) -> Optional[SharedStream]:
+        """
+        Subscribe to the stream of a leader running on another worker.
+        Returns None if there is no leader or it doesn't start in time.
+        """
+        try:
+            token = await self.aredis.get(f"{KEY_PREFIX}:{key}:leader")
+        except Exception as e:
+            logger.warning(f"Single-flight sem coordenação via Redis: {e}")
+            return None
+        if token is None:
+            return None
+
+        stream_key = self._stream_key(key, token.decode())
+        entries = self._aread_remote(stream_key)
+        try:
+            entry_type, data = await entries.__anext__()
+        except Exception as e:
+            logger.warning(f"Líder do single-flight não respondeu, gerando localmente: {e}")
+            self._counters["fallbacks"] += 1
+            await entries.aclose()
+            return None
+        if entry_type != "start":
+            await entries.aclose()
+            return None
+
+        shared = SharedStream(deserialize_nodes(json.loads(data)))
+
+        async def pump():
+            error = None
+            try:
+                async for entry_type, data in entries:
+                    if entry_type == "token":
+                        shared.publish(data)
+                    elif entry_type == "end":
+                        if data == "error":
+                            error = RuntimeError("Upstream stream failed on the leader")
+                        break
+            except Exception as e:
+                error = e
+                logger.error(f"Erro ao ler stream compartilhado do Redis: {e}")
+            finally:
+                shared.finish(error)
+                self._release(key, shared)
+
+        task = self._start(pump())
+        shared.on_abandoned = lambda: self._abandon(key, task)
+        return shared
+
+    async def _aread_remote(self, stream_key: str):
+        last_id = "0"
+        while True:
+            result = await self.aredis.xread(
+                {stream_key: last_id}, block=int(self.timeout * 1000), count=100
+            )
+            if not result:
+                raise asyncio.TimeoutError(f"No entries in {stream_key}")
+            for _, entries in result:
+                for entry_id, fields in entries:
+                    last_id = entry_id
+                    yield fields[b"type"].decode(), fields[b"data"].decode()
+
+    def stats(self) -> dict:
+        return {**self._counters, "in_flight": len(self._flights)}
+
+
+single_flight: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> Optional[SingleFlight]:
+    """
+    Return the single-flight layer, or None if SINGLE_FLIGHT_ENABLED=false.
+    Set SINGLE_FLIGHT_REDIS=true to also coalesce requests across workers.
+    """
+    global single_flight
+
+    if os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() != "true":
+        return None
+
+    if single_flight is None:
+        use_redis = os.getenv("SINGLE_FLIGHT_REDIS", "false").lower() == "true"
+        single_flight = SingleFlight(
+            redis_url=os.getenv("REDIS_URL") if use_redis else None,
+            lease=int(os.getenv("SINGLE_FLIGHT_LEASE", "120")),
+            timeout=float(os.getenv("SINGLE_FLIGHT_TIMEOUT", "30")),
+        )
+        register_stats("single_flight", single_flight.stats)
+
+    return single_flight
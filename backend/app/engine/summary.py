@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.core.base.llms.generic_utils import messages_to_history_str
+from llama_index.core.llms import LLM, ChatMessage, MessageRole
+from llama_index.core.prompts import PromptTemplate
+from llama_index.core.settings import Settings
+
+from app.engine.condense import get_condense_llm
+from app.engine.memory import TokenCountedChatMemory, TokenEntry
+from app.llm_gateway import BATCH, use_llm_priority
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+SUMMARY_PROMPT = PromptTemplate(
+    "Resuma a conversa abaixo entre um usuário e um assistente. Mantenha os "
+    "fatos, pedidos, dados informados e decisões necessários para continuar o "
+    "atendimento, sem inventar nada."
+    "\nResumo anterior:"
+    "\n---------------------\n{summary}\n---------------------"
+    "\nNovas mensagens:"
+    "\n---------------------\n{messages}\n---------------------"
+    "\nNovo resumo:"
+)
+SUMMARY_PREFIX = "Resumo da conversa até aqui:\n"
+
+
+class ConversationSummarizer:
+    """
+    Compacts the older turns of a conversation into a running summary once its
+    history passes `threshold` tokens, keeping the latest `keep_tokens` worth
+    of messages as they are. Runs in the background after the turn that
+    crossed the threshold, at most once at a time per conversation.
+    """
+
+    def __init__(self, threshold: int, keep_tokens: int, llm: Optional[LLM] = None):
+        self.threshold = threshold
+        self.keep_tokens = keep_tokens
+        self.llm = llm
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._counters = {"compacted": 0, "conflicts": 0, "failed": 0}
+
+    def schedule(self, memory: "SummarizingChatMemory", total: int):
+        key = memory.chat_store_key
+        if total <= self.threshold or key in self._tasks:
+            return
+        task = asyncio.create_task(self._arun(memory))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def _arun(self, memory: "SummarizingChatMemory"):
+        try:
+            await self.acompact(memory)
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.warning(f"Falha ao resumir a conversa {memory.chat_store_key}: {e}")
+
+    def _cut(self, messages: List[ChatMessage], entries: List[TokenEntry], first: int) -> int:
+        """
+        Index of the first message kept as is: the latest ones within
+        keep_tokens, starting with a user message.
+        """
+        cut = len(entries)
+        used = 0
+        while cut > first and used + entries[cut - 1].tokens <= self.keep_tokens:
+            cut -= 1
+            used += entries[cut].tokens
+        while cut < len(messages) and messages[cut].role != MessageRole.USER:
+            cut += 1
+        return cut
+
+    async def acompact(self, memory: "SummarizingChatMemory"):
+        import redis
+
+        client = memory._aclient
+        pipe = client.pipeline(transaction=True)
+        pipe.lrange(memory.chat_store_key, 0, -1)
+        pipe.lrange(memory._tokens_key, 0, -1)
+        pipe.get(memory._version_key)
+        pipe.hgetall(memory._summary_key)
+        raw_messages, raw_entries, version, meta = await pipe.execute()
+        if version is None or len(raw_messages) != len(raw_entries):
+            return
+
+        messages = memory._decode_messages(raw_messages)
+        entries = [TokenEntry.decode(raw) for raw in raw_entries]
+        summary, covered, chain = memory._parse_summary(meta)
+        # The stored history starts with the summary message, if there is one
+        first = 1 if summary is not None else 0
+        cut = self._cut(messages, entries, first)
+        if cut - first < 2:
+            return
+
+        compacted = messages[first:cut]
+        with use_llm_priority(BATCH):
+            text = await (self.llm or Settings.llm).apredict(
+                SUMMARY_PROMPT,
+                summary=summary or "(nenhum)",
+                messages=messages_to_history_str(compacted),
+            )
+        summary_message = memory._summary_message(text.strip())
+        summary_entry = memory._entry(summary_message)
+        new_messages = [summary_message, *messages[cut:]]
+        new_entries = [summary_entry, *entries[cut:]]
+        new_version = memory._new_version()
+
+        # Only replace the turns if the conversation didn't change meanwhile
+        try:
+            async with client.pipeline(transaction=True) as pipe:
+                await pipe.watch(memory._version_key)
+                if await pipe.get(memory._version_key) != version:
+                    self._counters["conflicts"] += 1
+                    return
+                pipe.multi()
+                pipe.ltrim(memory.chat_store_key, cut, -1)
+                pipe.lpush(memory.chat_store_key, memory.chat_store.encode(summary_message))
+                pipe.ltrim(memory._tokens_key, cut, -1)
+                pipe.lpush(memory._tokens_key, summary_entry.encode())
+                pipe.set(memory._total_key, sum(entry.tokens for entry in new_entries))
+                pipe.set(memory._version_key, new_version)
+                pipe.delete(memory._summary_key)
+                pipe.hset(
+                    memory._summary_key,
+                    mapping={
+                        "text": text.strip(),
+                        "covered": covered + len(compacted),
+                        "chain": memory._chain(compacted, chain),
+                    },
+                )
+                memory._expire(pipe)
+                await pipe.execute()
+        except redis.WatchError:
+            self._counters["conflicts"] += 1
+            return
+
+        memory._cache_tail(new_version, new_messages, new_entries)
+        self._counters["compacted"] += 1
+
+    def stats(self) -> dict:
+        return {**self._counters, "running": len(self._tasks)}
+
+
+class SummarizingChatMemory(TokenCountedChatMemory):
+    """
+    Token counted memory whose older turns are replaced by a running summary
+    (a system message at the head of the stored history), so the history kept
+    in Redis and sent to the LLM stays bounded however long the session runs.
+
+    The frontend keeps sending the full history. `key:summary` records how many
+    of its leading messages the summary covers and a hash chain of them; while
+    the incoming history still starts with those messages, they are replaced
+    by the summary before diffing against the stored history.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SummarizingChatMemory"
+
+    @property
+    def _summary_key(self) -> str:
+        return f"{self.chat_store_key}:summary"
+
+    @property
+    def _keys(self) -> Tuple[str, ...]:
+        return (*super()._keys, self._summary_key)
+
+    @staticmethod
+    def _summary_message(text: str) -> ChatMessage:
+        return ChatMessage(role=MessageRole.SYSTEM, content=f"{SUMMARY_PREFIX}{text}")
+
+    @staticmethod
+    def _parse_summary(meta: Dict[bytes, bytes]) -> Tuple[Optional[str], int, str]:
+        if not meta:
+            return None, 0, ""
+        return (
+            meta[b"text"].decode("utf-8"),
+            int(meta[b"covered"]),
+            meta[b"chain"].decode("utf-8"),
+        )
+
+    def _chain(self, messages: List[ChatMessage], chain: str = "") -> str:
+        for message in messages:
+            chain = hashlib.sha1(f"{chain}{self._digest(message)}".encode()).hexdigest()
+        return chain
+
+    def _set_read_pipeline(self, pipe: Any):
+        super()._set_read_pipeline(pipe)
+        pipe.hgetall(self._summary_key)
+
+    def _set_pipeline(
+        self, pipe: Any, state: List[Any], messages: List[ChatMessage]
+    ) -> Tuple[List[TokenEntry], bytes, List[ChatMessage]]:
+        summary, covered, chain = self._parse_summary(state[3])
+        if summary is not None:
+            if len(messages) >= covered and self._chain(messages[:covered]) == chain:
+                messages = [self._summary_message(summary), *messages[covered:]]
+            else:
+                # Another conversation, the summary doesn't apply to it
+                pipe.delete(self._summary_key)
+        return super()._set_pipeline(pipe, state, messages)
+
+    async def aput(self, message: ChatMessage) -> None:
+        pipe = self._aclient.pipeline()
+        entry, version = self._put_pipeline(pipe, message)
+        results = await pipe.execute()
+        self._cache_put(message, entry, results[0], version)
+        # Compact after the answer, once the turn is complete
+        if message.role == MessageRole.ASSISTANT:
+            get_conversation_summarizer().schedule(self, int(results[3]))
+
+
+conversation_summarizer: Optional[ConversationSummarizer] = None
+
+
+def get_conversation_summarizer() -> ConversationSummarizer:
+    """
+    CHAT_MEMORY_SUMMARY_THRESHOLD is the history size in tokens that triggers
+    a compaction, and CHAT_MEMORY_SUMMARY_KEEP the size of the latest messages
+    kept as they are. Summaries use CONDENSE_MODEL when set.
+    """
+    global conversation_summarizer
+
+    if conversation_summarizer is None:
+        conversation_summarizer = ConversationSummarizer(
+            threshold=int(os.getenv("CHAT_MEMORY_SUMMARY_THRESHOLD", "2000")),
+            keep_tokens=int(os.getenv("CHAT_MEMORY_SUMMARY_KEEP", "800")),
+            llm=get_condense_llm(),
+        )
+        register_stats("chat_memory_summary", conversation_summarizer.stats)
+    return conversation_summarizer
@@ -1,11 +1,112 @@
+import logging
 import os
+import re
+from typing import Any, Optional
+
+from llama_index.core.vector_stores.types import FilterOperator, MetadataFilter
 from llama_index.vector_stores.postgres import PGVectorStore
 from urllib.parse import urlparse
 
+logger = logging.getLogger("uvicorn")
+
 PGVECTOR_SCHEMA = os.environ.get("PGVECTOR_SCHEMA", "public")
 PGVECTOR_TABLE = os.environ.get("PGVECTOR_TABLE", "llamaindex_embedding")
+# Create a partial HNSW index for each tenant (id_empresa) that gets documents
+PGVECTOR_TENANT_HNSW = os.environ.get("PGVECTOR_TENANT_HNSW", "false").lower() == "true"
+# dense (vector only) or hybrid (vector + Postgres full-text search)
+RETRIEVER_MODE = os.environ.get("RETRIEVER_MODE", "dense").lower()
+PGVECTOR_TEXT_SEARCH_CONFIG = os.environ.get("PGVECTOR_TEXT_SEARCH_CONFIG", "portuguese")
+
+# Metadata keys stamped on every node by generate_single_doc
+TENANT_KEYS = ("id_empresa", "id_unidade")
+TENANT_ID_PATTERN = re.compile(r"^[A-Za-z0-9_\-]+$")
+
+
+def is_valid_tenant_id(value: Any) -> bool:
+    return isinstance(value, str) and TENANT_ID_PATTERN.match(value) is not None
+
+
+class TenantPGVectorStore(PGVectorStore):
+    """
+    PGVectorStore that compares the tenant metadata as text, so that tenant
+    filters are pushed down exactly as the expression and partial indexes
+    created by `create_tenant_indexes` are defined.
+    """
+
+    def _build_filter_clause(self, filter_: MetadataFilter) -> Any:
+        from sqlalchemy import text
+
+        if (
+            filter_.key in TENANT_KEYS
+            and filter_.operator == FilterOperator.EQ
+            and is_valid_tenant_id(filter_.value)
+        ):
+            # The value is embedded as a literal (it is validated above) so the
+            # planner can match the predicate of the partial HNSW indexes
+            return text(f"(metadata_->>'{filter_.key}') = '{filter_.value}'")
+        return super()._build_filter_clause(filter_)
+
+    def create_tenant_indexes(self, id_empresa: Optional[str] = None):
+        """
+        Index the tenant metadata and, if PGVECTOR_TENANT_HNSW is set, create a
+        partial HNSW index over the vectors of the given tenant.
+        """
+        from sqlalchemy import text
+
+        self._initialize()
+        table_name = self._table_class.__tablename__
+        table = f"{self.schema_name}.{table_name}"
+        with self._session() as session, session.begin():
+            for key in TENANT_KEYS:
+                session.execute(
+                    text(
+                        f"CREATE INDEX IF NOT EXISTS {table_name}_{key}_idx "
+                        f"ON {table} ((metadata_->>'{key}'))"
+                    )
+                )
+            if PGVECTOR_TENANT_HNSW and is_valid_tenant_id(id_empresa):
+                index_name = f"{table_name}_hnsw_{id_empresa.replace('-', '_')}"[:63]
+                session.execute(
+                    text(
+                        f'CREATE INDEX IF NOT EXISTS "{index_name}" ON {table} '
+                        "USING hnsw (embedding vector_cosine_ops) "
+                        f"WHERE (metadata_->>'id_empresa') = '{id_empresa}'"
+                    )
+                )
+            session.commit()
+        logger.info(f"Índices de tenant verificados na tabela {table}")
+
+    def create_text_search_index(self):
+        """
+        Add the generated tsvector column used by the hybrid retriever to a
+        table created before hybrid search was enabled, and index it.
+        """
+        from sqlalchemy import text
+
+        if not self.hybrid_search:
+            return
+        self._initialize()
+        table_name = self._table_class.__tablename__
+        table = f"{self.schema_name}.{table_name}"
+        with self._session() as session, session.begin():
+            session.execute(
+                text(
+                    f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS text_search_tsv "
+                    f"tsvector GENERATED ALWAYS AS "
+                    f"(to_tsvector('{self.text_search_config}', text)) STORED"
+                )
+            )
+            session.execute(
+                text(
+                    f"CREATE INDEX IF NOT EXISTS {table_name}_text_search_tsv_idx "
+                    f"ON {table} USING gin (text_search_tsv)"
+                )
+            )
+            session.commit()
+        logger.info(f"Índice de busca textual verificado na tabela {table}")
+
 
-vector_store: PGVectorStore = None
+vector_store: TenantPGVectorStore = None
 
 def get_vector_store():
     global vector_store
@@ -25,12 +126,14 @@ def get_vector_store():
             original_scheme, "postgresql+asyncpg://"
         )
 
-        vector_store = PGVectorStore(
+        vector_store = TenantPGVectorStore(
             connection_string=conn_string,
             async_connection_string=async_conn_string,
             schema_name=PGVECTOR_SCHEMA,
             table_name=PGVECTOR_TABLE,
             embed_dim=int(os.environ.get("EMBEDDING_DIM", 1024)),
+            hybrid_search=RETRIEVER_MODE == "hybrid",
+            text_search_config=PGVECTOR_TEXT_SEARCH_CONFIG,
         )
 
     return vector_store
@@ -0,0 +1,452 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timezone
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from llama_index.core.llms import ChatMessage
+
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+# Rollup rating of the feedback sent without one
+UNRATED = 0
+
+# TB_FEEDBACK_CHATBOT, the previous table with the whole conversation in a
+# single column and one row per user, is left as is for its existing data
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS TB_FEEDBACK (
+    id BIGSERIAL PRIMARY KEY,
+    user_uuid VARCHAR NOT NULL,
+    feedback TEXT,
+    rating SMALLINT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ix_feedback_user ON TB_FEEDBACK (user_uuid, id);
+CREATE INDEX IF NOT EXISTS ix_feedback_created_at ON TB_FEEDBACK (created_at);
+CREATE INDEX IF NOT EXISTS ix_feedback_rating ON TB_FEEDBACK (rating, id);
+CREATE TABLE IF NOT EXISTS TB_FEEDBACK_MENSAGEM (
+    feedback_id BIGINT NOT NULL REFERENCES TB_FEEDBACK (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    role VARCHAR NOT NULL,
+    content TEXT,
+    PRIMARY KEY (feedback_id, position)
+);
+CREATE TABLE IF NOT EXISTS TB_FEEDBACK_DIARIO (
+    day DATE NOT NULL,
+    rating SMALLINT NOT NULL,
+    total BIGINT NOT NULL,
+    PRIMARY KEY (day, rating)
+);
+"""
+
+
+class FeedbackRow(NamedTuple):
+    user_uuid: str
+    feedback: str
+    rating: Optional[int]
+    created_at: datetime
+    messages: List[ChatMessage]
+
+
+_STOP = object()
+
+
+class FeedbackQueueFull(Exception):
+    pass
+
+
+class FeedbackStore:
+    """
+    Pooled storage of the chat feedback: one row per feedback, one row per
+    message of the conversation it refers to, and daily totals per rating
+    kept up to date by the writes, so reports never scan the feedback.
+
+    Writes are behind: rows are queued by the route and inserted by a
+    background thread, with multi-row INSERTs per batch of up to `batch_size`
+    rows or per `flush_interval` seconds since the first queued row,
+    whichever comes first. The queue is bounded: `enqueue` waits up to
+    `enqueue_timeout` seconds for room and then raises FeedbackQueueFull.
+
+    A batch that fails on a connection error is retried up to `max_retries`
+    times, starting `backoff` seconds apart; one that fails on its data is
+    inserted row by row, so only the bad rows are lost.
+    """
+
+    def __init__(
+        self,
+        conn_params: dict,
+        min_connections: int = 1,
+        max_connections: int = 5,
+        queue_size: int = 1000,
+        batch_size: int = 100,
+        flush_interval: float = 2.0,
+        enqueue_timeout: float = 1.0,
+        max_retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        self.conn_params = conn_params
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._pool: Any = None
+        self._migrated = False
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._counters = {
+            "written": 0,
+            "batches": 0,
+            "failed": 0,
+            "retries": 0,
+            "rejected": 0,
+        }
+
+    @property
+    def pool(self) -> Any:
+        with self._lock:
+            if self._pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+
+                self._pool = ThreadedConnectionPool(
+                    self.min_connections, self.max_connections, **self.conn_params
+                )
+            return self._pool
+
+    def _transaction(self, work: Callable[[Any], Any]) -> Any:
+        """
+        Run `work(cursor)` in a transaction on a pooled connection.
+        """
+        conn = self.pool.getconn()
+        broken = False
+        try:
+            with conn.cursor() as cursor:
+                result = work(cursor)
+            conn.commit()
+            return result
+        except Exception:
+            broken = conn.closed != 0
+            if not broken:
+                conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn, close=broken)
+
+    def _fetch(self, query: str, params: Any = None) -> List[tuple]:
+        def work(cursor: Any) -> List[tuple]:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+        return self._transaction(work)
+
+    def migrate(self):
+        """
+        Create the feedback tables and indexes if needed, once per process.
+        """
+        if self._migrated:
+            return
+        self._transaction(lambda cursor: cursor.execute(SCHEMA))
+        self._migrated = True
+        logger.info("Tabelas de feedback prontas")
+
+    def start(self):
+        """
+        Migrate the schema and start the writer thread. A database that is
+        down at startup is migrated again before the first write.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="feedback-writer", daemon=True
+            )
+            self._thread.start()
+        try:
+            self.migrate()
+        except Exception as e:
+            logger.warning(f"Falha ao migrar as tabelas de feedback: {e}")
+
+    def enqueue(
+        self,
+        user_uuid: str,
+        feedback: str,
+        messages: List[ChatMessage],
+        rating: Optional[int] = None,
+    ):
+        self.start()
+        row = FeedbackRow(
+            user_uuid, feedback, rating, datetime.now(timezone.utc), messages
+        )
+        try:
+            self._queue.put(row, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self._counters["rejected"] += 1
+            raise FeedbackQueueFull("Fila de feedback cheia")
+
+    def _next_batch(self) -> Tuple[List[FeedbackRow], bool]:
+        batch: List[FeedbackRow] = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            try:
+                row = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if row is _STOP:
+                return batch, True
+            batch.append(row)
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+        return batch, False
+
+    @staticmethod
+    def _insert_batch(cursor: Any, batch: List[FeedbackRow]):
+        from psycopg2.extras import execute_values
+
+        # Ids are reserved up front so the message rows can reference them
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence('TB_FEEDBACK', 'id')) "
+            "FROM generate_series(1, %s)",
+            (len(batch),),
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+        execute_values(
+            cursor,
+            "INSERT INTO TB_FEEDBACK (id, user_uuid, feedback, rating, created_at) "
+            "VALUES %s",
+            [
+                (feedback_id, row.user_uuid, row.feedback, row.rating, row.created_at)
+                for feedback_id, row in zip(ids, batch)
+            ],
+            page_size=len(batch),
+        )
+        messages = [
+            (feedback_id, position, message.role.value, message.content)
+            for feedback_id, row in zip(ids, batch)
+            for position, message in enumerate(row.messages)
+        ]
+        if messages:
+            execute_values(
+                cursor,
+                "INSERT INTO TB_FEEDBACK_MENSAGEM (feedback_id, position, role, content) "
+                "VALUES %s",
+                messages,
+                page_size=1000,
+            )
+        totals = Counter(
+            (row.created_at.date(), row.rating or UNRATED) for row in batch
+        )
+        execute_values(
+            cursor,
+            "INSERT INTO TB_FEEDBACK_DIARIO (day, rating, total) VALUES %s "
+            "ON CONFLICT (day, rating) "
+            "DO UPDATE SET total = TB_FEEDBACK_DIARIO.total + EXCLUDED.total",
+            [(day, rating, total) for (day, rating), total in totals.items()],
+            page_size=len(totals),
+        )
+
+    def _insert(self, batch: List[FeedbackRow]):
+        """
+        Insert `batch` in one transaction, retrying connection errors (the
+        database restarting, a dropped connection) with exponential backoff.
+        """
+        import psycopg2
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.migrate()
+                self._transaction(lambda cursor: self._insert_batch(cursor, batch))
+                return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if attempt == self.max_retries:
+                    raise
+                self._counters["retries"] += 1
+                delay = self.backoff * 2**attempt
+                logger.warning(
+                    f"Falha de conexão ao inserir {len(batch)} feedbacks, nova "
+                    f"tentativa em {delay:.1f}s: {e}"
+                )
+                time.sleep(delay)
+
+    def _write(self, batch: List[FeedbackRow]):
+        import psycopg2
+
+        try:
+            self._insert(batch)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            self._counters["failed"] += len(batch)
+            logger.error(f"Erro ao inserir {len(batch)} feedbacks: {e}")
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                self._counters["failed"] += 1
+                logger.error(f"Erro ao inserir o feedback de {batch[0].user_uuid}: {e}")
+                return
+            # A bad row (e.g. a NUL byte in the content) fails the whole
+            # batch, so insert the rows one by one to only lose that one
+            logger.warning(f"Erro ao inserir {len(batch)} feedbacks, inserindo um a um: {e}")
+            for row in batch:
+                self._write([row])
+            return
+        self._counters["written"] += len(batch)
+        self._counters["batches"] += 1
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def close(self):
+        """
+        Write the queued rows, then stop the thread and close the pool.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+
+    def list_feedback(
+        self,
+        limit: int,
+        before_id: Optional[int] = None,
+        user_uuid: Optional[str] = None,
+        rating: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        include_messages: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        Feedback from the newest, at most `limit` rows with an id lower than
+        `before_id` (keyset pagination), with the number of messages of each
+        one and, with `include_messages`, the messages themselves.
+        """
+        self.migrate()
+        conditions = []
+        params: List[Any] = []
+        for condition, value in (
+            ("f.id < %s", before_id),
+            ("f.user_uuid = %s", user_uuid),
+            ("f.rating = %s", rating),
+            ("f.created_at >= %s", since),
+            ("f.created_at < %s", until),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._fetch(
+            f"""
+            SELECT f.id, f.user_uuid, f.feedback, f.rating, f.created_at,
+                (SELECT count(*) FROM TB_FEEDBACK_MENSAGEM m WHERE m.feedback_id = f.id)
+            FROM TB_FEEDBACK f {where}
+            ORDER BY f.id DESC
+            LIMIT %s
+            """,
+            (*params, limit),
+        )
+        items = [
+            dict(
+                zip(
+                    ("id", "user_uuid", "feedback", "rating", "created_at", "message_count"),
+                    row,
+                )
+            )
+            for row in rows
+        ]
+        if include_messages and items:
+            messages: Dict[int, List[dict]] = {item["id"]: [] for item in items}
+            for feedback_id, role, content in self._fetch(
+                "SELECT feedback_id, role, content FROM TB_FEEDBACK_MENSAGEM "
+                "WHERE feedback_id = ANY(%s) ORDER BY feedback_id, position",
+                (list(messages),),
+            ):
+                messages[feedback_id].append({"role": role, "content": content})
+            for item in items:
+                item["messages"] = messages[item["id"]]
+        return items
+
+    def daily_totals(
+        self,
+        since: Optional[date] = None,
+        until: Optional[date] = None,
+        rating: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Feedback per UTC day and rating from the rollup table, from `since`
+        up to `until` excluded, rating 0 being the feedback sent without one.
+        The rollup has no per-user totals.
+        """
+        self.migrate()
+        rows = self._fetch(
+            """
+            SELECT day, rating, total FROM TB_FEEDBACK_DIARIO
+            WHERE (%(since)s::date IS NULL OR day >= %(since)s)
+            AND (%(until)s::date IS NULL OR day < %(until)s)
+            AND (%(rating)s::smallint IS NULL OR rating = %(rating)s)
+            ORDER BY day DESC, rating
+            """,
+            {"since": since, "until": until, "rating": rating},
+        )
+        return [
+            {"day": day, "rating": rating, "total": total} for day, rating, total in rows
+        ]
+
+    def stats(self) -> dict:
+        return {**self._counters, "queued": self._queue.qsize()}
+
+
+feedback_store: Optional[FeedbackStore] = None
+
+
+def get_feedback_store() -> FeedbackStore:
+    """
+    FEEDBACK_POOL_MAX bounds the connections to the feedback database,
+    FEEDBACK_QUEUE_SIZE the rows waiting to be written, and FEEDBACK_BATCH_SIZE
+    and FEEDBACK_FLUSH_INTERVAL trigger the writes, FEEDBACK_WRITE_RETRIES and
+    FEEDBACK_WRITE_BACKOFF retry them on connection errors.
+    """
+    global feedback_store
+
+    if feedback_store is None:
+        feedback_store = FeedbackStore(
+            conn_params={
+                "dbname": os.getenv("POSTGRES_DB_FEEDBACK"),
+                "user": os.getenv("POSTGRES_USER"),
+                "password": os.getenv("POSTGRES_PASSWORD"),
+                "host": os.getenv("POSTGRES_HOST"),
+                "port": os.getenv("POSTGRES_PORT"),
+                "connect_timeout": int(os.getenv("FEEDBACK_CONNECT_TIMEOUT", "5")),
+            },
+            min_connections=int(os.getenv("FEEDBACK_POOL_MIN", "1")),
+            max_connections=int(os.getenv("FEEDBACK_POOL_MAX", "5")),
+            queue_size=int(os.getenv("FEEDBACK_QUEUE_SIZE", "1000")),
+            batch_size=int(os.getenv("FEEDBACK_BATCH_SIZE", "100")),
+            flush_interval=float(os.getenv("FEEDBACK_FLUSH_INTERVAL", "2")),
+            enqueue_timeout=float(os.getenv("FEEDBACK_ENQUEUE_TIMEOUT", "1")),
+            max_retries=int(os.getenv("FEEDBACK_WRITE_RETRIES", "3")),
+            backoff=float(os.getenv("FEEDBACK_WRITE_BACKOFF", "1")),
+        )
+        register_stats("feedback", feedback_store.stats)
+    return feedback_store
+
+
+async def aclose_feedback_store():
+    if feedback_store is not None:
+        await asyncio.to_thread(feedback_store.close)
@@ -0,0 +1,73 @@
+import importlib.util
+import logging
+import os
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger("uvicorn")
+
+
+def _http_config() -> dict:
+    http2 = os.getenv("HTTP_CLIENT_HTTP2", "true").lower() == "true"
+    if http2 and importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP/2 desativado: pacote h2 não instalado")
+        http2 = False
+    return {
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=int(os.getenv("HTTP_CLIENT_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(
+                os.getenv("HTTP_CLIENT_MAX_KEEPALIVE", "20")
+            ),
+            keepalive_expiry=float(os.getenv("HTTP_CLIENT_KEEPALIVE_EXPIRY", "30")),
+        ),
+        "timeout": httpx.Timeout(
+            float(os.getenv("HTTP_CLIENT_TIMEOUT", "30")),
+            connect=float(os.getenv("HTTP_CLIENT_CONNECT_TIMEOUT", "5")),
+        ),
+        "follow_redirects": True,
+    }
+
+
+http_client: Optional[httpx.Client] = None
+async_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Application wide pooled client for sync code (worker threads, scripts).
+    """
+    global http_client
+
+    if http_client is None or http_client.is_closed:
+        http_client = httpx.Client(**_http_config())
+    return http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Application wide pooled client for async code. Pass a per-request
+    `timeout` to override the default one.
+    """
+    global async_http_client
+
+    if async_http_client is None or async_http_client.is_closed:
+        async_http_client = httpx.AsyncClient(**_http_config())
+    return async_http_client
+
+
+def init_http_clients():
+    get_http_client()
+    get_async_http_client()
+
+
+async def aclose_http_clients():
+    global http_client, async_http_client
+
+    if async_http_client is not None:
+        await async_http_client.aclose()
+        async_http_client = None
+    if http_client is not None:
+        http_client.close()
+        http_client = None
@@ -0,0 +1,378 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    AsyncGenerator,
+    Deque,
+    Dict,
+    Generator,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Sequence,
+)
+
+from fastapi import HTTPException, status
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.llms.llm import LLM
+from llama_index.core.settings import Settings
+
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+# Queues in order of priority
+CHAT = "chat"
+SUGGESTIONS = "suggestions"
+BATCH = "batch"
+PRIORITIES = (CHAT, SUGGESTIONS, BATCH)
+
+llm_priority: ContextVar[str] = ContextVar("llm_priority", default=CHAT)
+
+
+@contextmanager
+def use_llm_priority(priority: str):
+    """
+    Send the LLM calls made within the block to the queue of `priority`.
+    """
+    token = llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        llm_priority.reset(token)
+
+
+class QueueConfig(NamedTuple):
+    max_size: int
+    max_wait: float
+
+
+class LLMGateway:
+    """
+    Limits the number of concurrent LLM calls. Calls over the limit wait in a
+    bounded queue per priority and the freed slots go to the highest priority
+    waiting call. A call is rejected with 429 when its queue is full and with
+    503 when it waits longer than the queue's max wait.
+    """
+
+    def __init__(self, max_concurrency: int, queues: Dict[str, QueueConfig]):
+        self.max_concurrency = max_concurrency
+        self.queues = queues
+        self._active = 0
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {
+            priority: deque() for priority in PRIORITIES
+        }
+        self._counters = {
+            priority: {
+                "admitted": 0,
+                "rejected_full": 0,
+                "rejected_timeout": 0,
+                "wait_seconds": 0.0,
+                "max_wait_seconds": 0.0,
+            }
+            for priority in PRIORITIES
+        }
+
+    def _record_wait(self, priority: str, seconds: float):
+        counters = self._counters[priority]
+        counters["admitted"] += 1
+        counters["wait_seconds"] += seconds
+        counters["max_wait_seconds"] = max(counters["max_wait_seconds"], seconds)
+
+    def _reject(self, priority: str, reason: str, status_code: int, detail: str):
+        self._counters[priority][reason] += 1
+        raise HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": "1"},
+        )
+
+    async def acquire(self, priority: str):
+        priority = priority if priority in self._waiters else CHAT
+        if self._active < self.max_concurrency and not any(self._waiters.values()):
+            self._active += 1
+            self._record_wait(priority, 0.0)
+            return
+
+        config = self.queues[priority]
+        waiters = self._waiters[priority]
+        if len(waiters) >= config.max_size:
+            self._reject(
+                priority,
+                "rejected_full",
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                "Muitas requisições ao modelo, tente novamente em instantes",
+            )
+
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        start = time.monotonic()
+        try:
+            await asyncio.wait((waiter,), timeout=config.max_wait)
+        except asyncio.CancelledError:
+            self._withdraw(waiters, waiter)
+            raise
+        if not waiter.done():
+            self._withdraw(waiters, waiter)
+            self._reject(
+                priority,
+                "rejected_timeout",
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                "Modelo sobrecarregado, tente novamente em instantes",
+            )
+        self._record_wait(priority, time.monotonic() - start)
+
+    def _withdraw(self, waiters: Deque[asyncio.Future], waiter: asyncio.Future):
+        if waiter.done():
+            # The slot was handed over right before giving up, pass it on
+            self.release()
+        else:
+            waiters.remove(waiter)
+            waiter.cancel()
+
+    def release(self):
+        for priority in PRIORITIES:
+            waiters = self._waiters[priority]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    # Hand the slot over, the active count doesn't change
+                    waiter.set_result(None)
+                    return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def aslot(self) -> AsyncGenerator[None, None]:
+        await self.acquire(llm_priority.get())
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def slot(self) -> Generator[None, None, None]:
+        """
+        Slot for sync calls, which FastAPI runs in worker threads. The queue
+        lives in the event loop, so the thread waits on it through anyio.
+        Sync calls made outside of a worker thread (e.g. scripts) aren't limited.
+        """
+        from anyio import from_thread
+
+        try:
+            from_thread.run(self.acquire, llm_priority.get())
+            limited = True
+        except RuntimeError:
+            limited = False
+        try:
+            yield
+        finally:
+            if limited:
+                from_thread.run_sync(self.release)
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "max_concurrency": self.max_concurrency,
+            "queues": {
+                priority: {
+                    **counters,
+                    "depth": len(self._waiters[priority]),
+                    "avg_wait_seconds": (
+                        counters["wait_seconds"] / counters["admitted"]
+                        if counters["admitted"]
+                        else 0.0
+                    ),
+                }
+                for priority, counters in self._counters.items()
+            },
+        }
+
+
+class GatewayStream:
+    """
+    Async stream that holds a gateway slot until it is exhausted, closed or
+    released. Releasing doesn't depend on the stream ever being iterated, so
+    a consumer cancelled before reading it can still give the slot back.
+    """
+
+    def __init__(self, stream: AsyncGenerator, gateway: LLMGateway):
+        self._stream = stream
+        self._gateway = gateway
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._gateway.release()
+
+    def __aiter__(self) -> "GatewayStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            # Exhausted, failed or cancelled
+            self.release()
+            raise
+
+    async def aclose(self):
+        try:
+            aclose = getattr(self._stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            self.release()
+
+
+class GatewayLLM(LLM):
+    """
+    LLM that makes every call to the wrapped LLM through the gateway. Streams
+    hold their slot until they are consumed or closed.
+    """
+
+    llm: LLM = Field(description="The wrapped LLM.")
+
+    _gateway: LLMGateway = PrivateAttr()
+
+    def __init__(self, llm: LLM, gateway: LLMGateway, **kwargs: Any):
+        super().__init__(llm=llm, **kwargs)
+        self._gateway = gateway
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "GatewayLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self.llm.metadata
+
+    def wrap(self, llm: LLM) -> "GatewayLLM":
+        """
+        Put another LLM behind the same gateway.
+        """
+        return GatewayLLM(llm=llm, gateway=self._gateway)
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        with self._gateway.slot():
+            return self.llm.chat(messages, **kwargs)
+
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        with self._gateway.slot():
+            return self.llm.complete(prompt, formatted=formatted, **kwargs)
+
+    def _stream(self, open_stream) -> Iterator[Any]:
+        with self._gateway.slot():
+            yield from open_stream()
+
+    def stream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseGen:
+        return self._stream(lambda: self.llm.stream_chat(messages, **kwargs))
+
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        return self._stream(
+            lambda: self.llm.stream_complete(prompt, formatted=formatted, **kwargs)
+        )
+
+    async def achat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponse:
+        async with self._gateway.aslot():
+            return await self.llm.achat(messages, **kwargs)
+
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        async with self._gateway.aslot():
+            return await self.llm.acomplete(prompt, formatted=formatted, **kwargs)
+
+    async def astream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseAsyncGen:
+        # Admitted before returning, so a rejection surfaces before streaming
+        await self._gateway.acquire(llm_priority.get())
+        try:
+            stream = await self.llm.astream_chat(messages, **kwargs)
+        except BaseException:
+            self._gateway.release()
+            raise
+        return GatewayStream(stream, self._gateway)
+
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        await self._gateway.acquire(llm_priority.get())
+        try:
+            stream = await self.llm.astream_complete(
+                prompt, formatted=formatted, **kwargs
+            )
+        except BaseException:
+            self._gateway.release()
+            raise
+        return GatewayStream(stream, self._gateway)
+
+    # Structured outputs may use the function calling API of the wrapped LLM
+    def structured_predict(self, *args: Any, **kwargs: Any) -> Any:
+        with self._gateway.slot():
+            return self.llm.structured_predict(*args, **kwargs)
+
+    async def astructured_predict(self, *args: Any, **kwargs: Any) -> Any:
+        async with self._gateway.aslot():
+            return await self.llm.astructured_predict(*args, **kwargs)
+
+
+def _queue_config(priority: str, max_size: int, max_wait: float) -> QueueConfig:
+    name = priority.upper()
+    return QueueConfig(
+        max_size=int(os.getenv(f"LLM_QUEUE_{name}_SIZE", max_size)),
+        max_wait=float(os.getenv(f"LLM_QUEUE_{name}_MAX_WAIT", max_wait)),
+    )
+
+
+llm_gateway: Optional[LLMGateway] = None
+
+
+def init_llm_gateway():
+    """
+    Put Settings.llm behind the gateway, unless LLM_GATEWAY_ENABLED=false.
+    """
+    global llm_gateway
+
+    if os.getenv("LLM_GATEWAY_ENABLED", "true").lower() != "true":
+        return
+    if isinstance(Settings.llm, GatewayLLM):
+        return
+
+    llm_gateway = LLMGateway(
+        max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+        queues={
+            CHAT: _queue_config(CHAT, 64, 30),
+            SUGGESTIONS: _queue_config(SUGGESTIONS, 32, 5),
+            BATCH: _queue_config(BATCH, 16, 120),
+        },
+    )
+    Settings.llm = GatewayLLM(llm=Settings.llm, gateway=llm_gateway)
+    register_stats("llm_gateway", llm_gateway.stats)
+    logger.info(
+        f"Gateway do LLM ativo com {llm_gateway.max_concurrency} chamadas simultâneas"
+    )
@@ -0,0 +1,594 @@
+import asyncio
+import logging
+import os
+import statistics
+import threading
+import time
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Sequence, Set
+
+import httpx
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms.llm import LLM
+
+from app.http_client import get_async_http_client
+from app.observability import register_stats
+
+logger = logging.getLogger("uvicorn")
+
+# Kinds of latency: whole calls, and time to first token of streams
+CALL = "call"
+STREAM = "stream"
+
+
+def parse_endpoints(value: Optional[str]) -> List[str]:
+    """
+    Split a comma separated list of base URLs.
+    """
+    if not value:
+        return []
+    return [url.strip().rstrip("/") for url in value.split(",") if url.strip()]
+
+
+class Endpoint:
+    """
+    Load and health of one backend replica.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # Moving average of the latency per kind, as whole calls and time to
+        # first token of streams can't be compared
+        self.latencies: Dict[str, float] = {}
+        self.healthy = True
+        self.ejected_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.ejected_until <= time.monotonic()
+
+    def begin(self):
+        with self._lock:
+            self.outstanding += 1
+            self.requests += 1
+
+    def end(self):
+        with self._lock:
+            self.outstanding -= 1
+
+    def stats(self) -> dict:
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "latency_ms": {
+                kind: latency * 1000 for kind, latency in self.latencies.items()
+            },
+            "healthy": self.healthy,
+            "ejected": self.ejected_until > time.monotonic(),
+        }
+
+
+class EndpointPool:
+    """
+    Picks the replica with the fewest outstanding requests among the healthy
+    ones. Replicas are ejected for a while after consecutive failures or when
+    their `compare` latency (time to first token for LLMs, whole calls for
+    embeddings) gets much slower than the rest of the pool, and a background
+    task probes each replica's health URL.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        urls: List[str],
+        health_path: Optional[str] = None,
+        health_interval: float = 10,
+        eject_failures: int = 3,
+        eject_seconds: float = 30,
+        slow_factor: float = 3.0,
+        compare: str = CALL,
+    ):
+        self.name = name
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.slow_factor = slow_factor
+        self.compare = compare
+        self._health_task: Optional[asyncio.Task] = None
+        self._counters = {"hedges": 0, "hedges_won": 0}
+
+    def count(self, counter: str):
+        self._counters[counter] += 1
+
+    def pick(self, exclude: Sequence[Endpoint] = ()) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e.available and e not in exclude]
+        if not candidates:
+            # Better to try an ejected replica than to fail the request
+            candidates = [e for e in self.endpoints if e not in exclude]
+        if not candidates:
+            return None
+        return min(
+            candidates,
+            key=lambda e: (e.outstanding, e.latencies.get(self.compare, 0.0)),
+        )
+
+    def record_success(self, endpoint: Endpoint, latency: float, kind: str = CALL):
+        endpoint.consecutive_failures = 0
+        previous = endpoint.latencies.get(kind)
+        endpoint.latencies[kind] = (
+            latency if previous is None else 0.8 * previous + 0.2 * latency
+        )
+        if kind != self.compare:
+            return
+        peers = [
+            e.latencies[kind]
+            for e in self.endpoints
+            if e is not endpoint and e.available and kind in e.latencies
+        ]
+        if peers and endpoint.latencies[kind] > self.slow_factor * statistics.median(
+            peers
+        ):
+            self._eject(endpoint, "lento")
+
+    def record_failure(self, endpoint: Endpoint, error: BaseException):
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.eject_failures:
+            self._eject(endpoint, f"falhas consecutivas ({error})")
+
+    def _eject(self, endpoint: Endpoint, reason: str):
+        if not endpoint.available:
+            return
+        endpoint.ejected_until = time.monotonic() + self.eject_seconds
+        endpoint.consecutive_failures = 0
+        # Start over when the replica comes back
+        endpoint.latencies.clear()
+        logger.warning(f"Réplica {endpoint.url} ({self.name}) removida por {reason}")
+
+    def ensure_health_checks(self):
+        """
+        Start probing the replicas, once there is a running event loop.
+        """
+        if self.health_path is None or len(self.endpoints) < 2:
+            return
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.get_running_loop().create_task(
+                self._health_loop()
+            )
+
+    async def astop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*[self._probe(endpoint) for endpoint in self.endpoints])
+            await asyncio.sleep(self.health_interval)
+
+    async def _probe(self, endpoint: Endpoint):
+        try:
+            response = await get_async_http_client().get(
+                f"{endpoint.url}{self.health_path}", timeout=5.0
+            )
+            healthy = response.status_code < 500
+        except httpx.HTTPError:
+            healthy = False
+        if healthy != endpoint.healthy:
+            logger.warning(
+                f"Réplica {endpoint.url} ({self.name}) "
+                + ("voltou a responder" if healthy else "não responde")
+            )
+        endpoint.healthy = healthy
+
+    def stats(self) -> dict:
+        return {
+            **self._counters,
+            "endpoints": {e.url: e.stats() for e in self.endpoints},
+        }
+
+
+class RoutedLLM(LLM):
+    """
+    LLM spread over several replicas, one LLM instance per replica. Each call
+    goes to the replica picked by the pool. If `hedge_delay` is set, a
+    stream whose first token hasn't arrived after that many seconds is also
+    started on a second replica, and the first to answer is kept.
+    """
+
+    _nodes: Dict[str, LLM] = PrivateAttr()
+    _pool: EndpointPool = PrivateAttr()
+    _hedge_delay: float = PrivateAttr()
+
+    def __init__(
+        self,
+        nodes: Dict[str, LLM],
+        pool: EndpointPool,
+        hedge_delay: float = 0,
+        **kwargs: Any,
+    ):
+        super().__init__(**kwargs)
+        self._nodes = nodes
+        self._pool = pool
+        self._hedge_delay = hedge_delay
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RoutedLLM"
+
+    @property
+    def nodes(self) -> List[LLM]:
+        return list(self._nodes.values())
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self.nodes[0].metadata
+
+    def copy_nodes(self, update: Dict[str, Any]) -> "RoutedLLM":
+        """
+        Copy of this LLM with `update` applied to every replica's LLM, sharing
+        the load and health of the replicas.
+        """
+        return RoutedLLM(
+            nodes={url: llm.copy(update=update) for url, llm in self._nodes.items()},
+            pool=self._pool,
+            hedge_delay=self._hedge_delay,
+        )
+
+    def _pick(self, exclude: Sequence[Endpoint] = ()) -> Endpoint:
+        try:
+            self._pool.ensure_health_checks()
+        except RuntimeError:
+            # No running event loop (sync call from a worker thread)
+            pass
+        endpoint = self._pool.pick(exclude)
+        if endpoint is None:
+            raise RuntimeError(f"No replica available for {self._pool.name}")
+        return endpoint
+
+    def _call(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        endpoint = self._pick()
+        endpoint.begin()
+        start = time.monotonic()
+        try:
+            result = getattr(self._nodes[endpoint.url], method)(*args, **kwargs)
+        except Exception as e:
+            self._pool.record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.end()
+        self._pool.record_success(endpoint, time.monotonic() - start)
+        return result
+
+    async def _acall(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        endpoint = self._pick()
+        endpoint.begin()
+        start = time.monotonic()
+        try:
+            result = await getattr(self._nodes[endpoint.url], method)(*args, **kwargs)
+        except Exception as e:
+            self._pool.record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.end()
+        self._pool.record_success(endpoint, time.monotonic() - start)
+        return result
+
+    def _stream(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        endpoint = self._pick()
+        endpoint.begin()
+        start = time.monotonic()
+        first = True
+        try:
+            for item in getattr(self._nodes[endpoint.url], method)(*args, **kwargs):
+                if first:
+                    first = False
+                    self._pool.record_success(
+                        endpoint, time.monotonic() - start, STREAM
+                    )
+                yield item
+        except Exception as e:
+            self._pool.record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.end()
+
+    async def _astart(
+        self, endpoint: Endpoint, method: str, args: Any, kwargs: Any
+    ) -> Any:
+        """
+        Open a stream on the replica and wait for its first item.
+        """
+        endpoint.begin()
+        start = time.monotonic()
+        stream = None
+        try:
+            stream = await getattr(self._nodes[endpoint.url], method)(*args, **kwargs)
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException as e:
+            endpoint.end()
+            if stream is not None:
+                await stream.aclose()
+            if isinstance(e, Exception):
+                self._pool.record_failure(endpoint, e)
+            raise
+        self._pool.record_success(endpoint, time.monotonic() - start, STREAM)
+        return stream, first
+
+    async def _astream(self, method: str, *args: Any, **kwargs: Any) -> AsyncGenerator:
+        endpoint = self._pick()
+        started = {
+            asyncio.create_task(self._astart(endpoint, method, args, kwargs)): endpoint
+        }
+        winner = None
+        try:
+            if self._hedge_delay > 0:
+                done, _ = await asyncio.wait(started, timeout=self._hedge_delay)
+                backup = None if done else self._pool.pick(exclude=[endpoint])
+                if backup is not None:
+                    self._pool.count("hedges")
+                    started[
+                        asyncio.create_task(self._astart(backup, method, args, kwargs))
+                    ] = backup
+            winner = await self._afirst(started)
+        finally:
+            await self._acancel(started, winner)
+        if started[winner] is not endpoint:
+            self._pool.count("hedges_won")
+        return self._arelay(started[winner], *winner.result())
+
+    @staticmethod
+    async def _afirst(started: Dict[asyncio.Task, Endpoint]) -> asyncio.Task:
+        """
+        The first stream to deliver its first item, or the last error.
+        """
+        pending: Set[asyncio.Task] = set(started)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    return task
+                if not pending:
+                    raise task.exception()
+
+    @staticmethod
+    async def _acancel(started: Dict[asyncio.Task, Endpoint], winner: Any):
+        for task in started:
+            if task is winner:
+                continue
+            if task.done():
+                if not task.cancelled() and task.exception() is None:
+                    # Both answered at the same time, close the loser
+                    stream, _ = task.result()
+                    started[task].end()
+                    if stream is not None:
+                        await stream.aclose()
+            else:
+                task.cancel()
+
+    async def _arelay(
+        self, endpoint: Endpoint, stream: Any, first: Any
+    ) -> AsyncGenerator[Any, None]:
+        try:
+            if first is None:
+                return
+            yield first
+            async for item in stream:
+                yield item
+        except Exception as e:
+            self._pool.record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.end()
+            await stream.aclose()
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return self._call("chat", messages, **kwargs)
+
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        return self._call("complete", prompt, formatted=formatted, **kwargs)
+
+    def stream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseGen:
+        return self._stream("stream_chat", messages, **kwargs)
+
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        return self._stream("stream_complete", prompt, formatted=formatted, **kwargs)
+
+    async def achat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponse:
+        return await self._acall("achat", messages, **kwargs)
+
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        return await self._acall("acomplete", prompt, formatted=formatted, **kwargs)
+
+    async def astream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseAsyncGen:
+        return await self._astream("astream_chat", messages, **kwargs)
+
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        return await self._astream(
+            "astream_complete", prompt, formatted=formatted, **kwargs
+        )
+
+    # Structured outputs may use the function calling API of the replica's LLM
+    def structured_predict(self, *args: Any, **kwargs: Any) -> Any:
+        return self._call("structured_predict", *args, **kwargs)
+
+    async def astructured_predict(self, *args: Any, **kwargs: Any) -> Any:
+        return await self._acall("astructured_predict", *args, **kwargs)
+
+
+class RoutedEmbedding(BaseEmbedding):
+    """
+    Embedding model spread over several replicas, with its own pool so that
+    embeddings and chat completions are balanced independently.
+    """
+
+    _nodes: Dict[str, BaseEmbedding] = PrivateAttr()
+    _pool: EndpointPool = PrivateAttr()
+
+    def __init__(self, nodes: Dict[str, BaseEmbedding], pool: EndpointPool, **kwargs):
+        first = next(iter(nodes.values()))
+        super().__init__(
+            model_name=first.model_name,
+            embed_batch_size=first.embed_batch_size,
+            **kwargs,
+        )
+        self._nodes = nodes
+        self._pool = pool
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RoutedEmbedding"
+
+    @property
+    def nodes(self) -> List[BaseEmbedding]:
+        return list(self._nodes.values())
+
+    def _pick(self) -> Endpoint:
+        try:
+            self._pool.ensure_health_checks()
+        except RuntimeError:
+            pass
+        return self._pool.pick()
+
+    def _call(self, method: str, *args: Any) -> Any:
+        endpoint = self._pick()
+        endpoint.begin()
+        start = time.monotonic()
+        try:
+            result = getattr(self._nodes[endpoint.url], method)(*args)
+        except Exception as e:
+            self._pool.record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.end()
+        self._pool.record_success(endpoint, time.monotonic() - start)
+        return result
+
+    async def _acall(self, method: str, *args: Any) -> Any:
+        endpoint = self._pick()
+        endpoint.begin()
+        start = time.monotonic()
+        try:
+            result = await getattr(self._nodes[endpoint.url], method)(*args)
+        except Exception as e:
+            self._pool.record_failure(endpoint, e)
+            raise
+        finally:
+            endpoint.end()
+        self._pool.record_success(endpoint, time.monotonic() - start)
+        return result
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._call("_get_query_embedding", query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self._acall("_aget_query_embedding", query)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._call("_get_text_embedding", text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return await self._acall("_aget_text_embedding", text)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._call("_get_text_embeddings", texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._acall("_aget_text_embeddings", texts)
+
+
+endpoint_pools: List[EndpointPool] = []
+
+
+def create_pool(
+    name: str, urls: List[str], health_path: Optional[str], compare: str
+) -> EndpointPool:
+    pool = EndpointPool(
+        name,
+        urls,
+        health_path=health_path,
+        health_interval=float(os.getenv("LLM_ROUTER_HEALTH_INTERVAL", "10")),
+        eject_failures=int(os.getenv("LLM_ROUTER_EJECT_FAILURES", "3")),
+        eject_seconds=float(os.getenv("LLM_ROUTER_EJECT_SECONDS", "30")),
+        slow_factor=float(os.getenv("LLM_ROUTER_SLOW_FACTOR", "3")),
+        compare=compare,
+    )
+    register_stats(f"{name}_router", pool.stats)
+    endpoint_pools.append(pool)
+    return pool
+
+
+async def astop_routers():
+    """
+    Stop the health checks of the replica pools.
+    """
+    for pool in endpoint_pools:
+        await pool.astop()
+
+
+def routed_llm(
+    urls: List[str], factory: Callable[[str], LLM], health_path: Optional[str] = None
+) -> LLM:
+    """
+    LLM for the given replicas, routed if there is more than one.
+    """
+    if len(urls) == 1:
+        return factory(urls[0])
+    return RoutedLLM(
+        nodes={url: factory(url) for url in urls},
+        pool=create_pool("llm", urls, health_path, compare=STREAM),
+        hedge_delay=float(os.getenv("LLM_HEDGE_DELAY_MS", "0")) / 1000,
+    )
+
+
+def routed_embedding(
+    urls: List[str],
+    factory: Callable[[str], BaseEmbedding],
+    health_path: Optional[str] = None,
+) -> BaseEmbedding:
+    """
+    Embedding model for the given replicas, routed if there is more than one.
+    """
+    if len(urls) == 1:
+        return factory(urls[0])
+    return RoutedEmbedding(
+        nodes={url: factory(url) for url in urls},
+        pool=create_pool("embedding", urls, health_path, compare=CALL),
+    )
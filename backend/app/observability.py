@@ -1,2 +1,19 @@
+from typing import Any, Callable, Dict
+
+_stats_providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
 def init_observability():
     pass
+
+
+def register_stats(name: str, provider: Callable[[], Dict[str, Any]]):
+    """
+    Register a callable that returns the current counters of a component.
+    The counters are exposed together by the `/api/metrics` route.
+    """
+    _stats_providers[name] = provider
+
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: provider() for name, provider in _stats_providers.items()}
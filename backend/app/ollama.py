@@ -0,0 +1,299 @@
+import asyncio
+import json
+from typing import Any, AsyncGenerator, Dict, Generator, List, Optional, Sequence
+
+import httpx
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    MessageRole,
+)
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.embeddings.ollama import OllamaEmbedding
+from llama_index.llms.ollama import Ollama
+from llama_index.llms.ollama.base import get_additional_kwargs
+
+from app.http_client import get_async_http_client, get_http_client
+
+
+class PooledOllama(Ollama):
+    """
+    Ollama LLM over the application's pooled HTTP clients, instead of a new
+    client (and connection) per call. The chat stream is natively async; the
+    stock one runs the sync stream inside the event loop, blocking it until
+    each token arrives.
+    """
+
+    keep_alive: Optional[str] = Field(
+        default=None,
+        description="How long Ollama keeps the model loaded after a request.",
+    )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PooledOllama_llm"
+
+    @property
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.request_timeout)
+
+    def _payload(self, stream: bool, **kwargs: Any) -> Dict[str, Any]:
+        payload = {
+            "model": self.model,
+            "options": self._model_kwargs,
+            "stream": stream,
+            **kwargs,
+        }
+        if self.json_mode:
+            payload["format"] = "json"
+        if self.keep_alive is not None:
+            payload.setdefault("keep_alive", self.keep_alive)
+        return payload
+
+    async def awarmup(self):
+        """
+        Load the model into memory (a generate request without a prompt).
+        """
+        payload = {"model": self.model}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        await self._apost("/api/generate", payload)
+
+    def _chat_payload(
+        self, messages: Sequence[ChatMessage], stream: bool, **kwargs: Any
+    ) -> Dict[str, Any]:
+        messages = [
+            {
+                "role": message.role.value,
+                "content": message.content,
+                **message.additional_kwargs,
+            }
+            for message in messages
+        ]
+        return self._payload(stream, messages=messages, **kwargs)
+
+    def _complete_payload(self, prompt: str, stream: bool, **kwargs: Any) -> Dict[str, Any]:
+        return self._payload(stream, **{self.prompt_key: prompt}, **kwargs)
+
+    @staticmethod
+    def _chat_response(raw: Dict[str, Any], text: str, delta: Any = None) -> ChatResponse:
+        message = raw["message"]
+        return ChatResponse(
+            message=ChatMessage(
+                content=text,
+                role=MessageRole(message.get("role")),
+                additional_kwargs=get_additional_kwargs(message, ("content", "role")),
+            ),
+            delta=delta,
+            raw=raw,
+            additional_kwargs=get_additional_kwargs(raw, ("message",)),
+        )
+
+    @staticmethod
+    def _completion_response(
+        raw: Dict[str, Any], text: str, delta: Any = None
+    ) -> CompletionResponse:
+        return CompletionResponse(
+            text=text,
+            delta=delta,
+            raw=raw,
+            additional_kwargs=get_additional_kwargs(raw, ("response",)),
+        )
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = get_http_client().post(
+            f"{self.base_url}{path}", json=payload, timeout=self._timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def _apost(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        response = await get_async_http_client().post(
+            f"{self.base_url}{path}", json=payload, timeout=self._timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def _stream_chunks(
+        self, path: str, payload: Dict[str, Any]
+    ) -> Generator[Dict[str, Any], None, None]:
+        with get_http_client().stream(
+            "POST", f"{self.base_url}{path}", json=payload, timeout=self._timeout
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    async def _astream_chunks(
+        self, path: str, payload: Dict[str, Any]
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        async with get_async_http_client().stream(
+            "POST", f"{self.base_url}{path}", json=payload, timeout=self._timeout
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    yield json.loads(line)
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        raw = self._post("/api/chat", self._chat_payload(messages, False, **kwargs))
+        return self._chat_response(raw, raw["message"].get("content"))
+
+    @llm_chat_callback()
+    async def achat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponse:
+        raw = await self._apost(
+            "/api/chat", self._chat_payload(messages, False, **kwargs)
+        )
+        return self._chat_response(raw, raw["message"].get("content"))
+
+    @llm_chat_callback()
+    def stream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseGen:
+        payload = self._chat_payload(messages, True, **kwargs)
+        text = ""
+        for chunk in self._stream_chunks("/api/chat", payload):
+            if chunk.get("done"):
+                break
+            delta = chunk["message"].get("content")
+            text += delta
+            yield self._chat_response(chunk, text, delta)
+
+    @llm_chat_callback()
+    async def astream_chat(
+        self, messages: Sequence[ChatMessage], **kwargs: Any
+    ) -> ChatResponseAsyncGen:
+        payload = self._chat_payload(messages, True, **kwargs)
+
+        async def gen() -> ChatResponseAsyncGen:
+            text = ""
+            async for chunk in self._astream_chunks("/api/chat", payload):
+                if chunk.get("done"):
+                    break
+                delta = chunk["message"].get("content")
+                text += delta
+                yield self._chat_response(chunk, text, delta)
+
+        return gen()
+
+    @llm_completion_callback()
+    def complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        raw = self._post("/api/generate", self._complete_payload(prompt, False, **kwargs))
+        return self._completion_response(raw, raw.get("response"))
+
+    @llm_completion_callback()
+    async def acomplete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponse:
+        raw = await self._apost(
+            "/api/generate", self._complete_payload(prompt, False, **kwargs)
+        )
+        return self._completion_response(raw, raw.get("response"))
+
+    @llm_completion_callback()
+    def stream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseGen:
+        payload = self._complete_payload(prompt, True, **kwargs)
+        text = ""
+        for chunk in self._stream_chunks("/api/generate", payload):
+            delta = chunk.get("response")
+            text += delta
+            yield self._completion_response(chunk, text, delta)
+
+    @llm_completion_callback()
+    async def astream_complete(
+        self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        payload = self._complete_payload(prompt, True, **kwargs)
+
+        async def gen() -> CompletionResponseAsyncGen:
+            text = ""
+            async for chunk in self._astream_chunks("/api/generate", payload):
+                delta = chunk.get("response")
+                text += delta
+                yield self._completion_response(chunk, text, delta)
+
+        return gen()
+
+
+class PooledOllamaEmbedding(OllamaEmbedding):
+    """
+    Ollama embeddings over the pooled HTTP clients, with real async calls
+    (the stock async methods make blocking requests calls).
+    """
+
+    keep_alive: Optional[str] = Field(
+        default=None,
+        description="How long Ollama keeps the model loaded after a request.",
+    )
+
+    def __init__(self, *args: Any, keep_alive: Optional[str] = None, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.keep_alive = keep_alive
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PooledOllamaEmbedding"
+
+    def _request_body(self, prompt: str) -> Dict[str, Any]:
+        body = {
+            "prompt": prompt,
+            "model": self.model_name,
+            "options": self.ollama_additional_kwargs,
+        }
+        if self.keep_alive is not None:
+            body["keep_alive"] = self.keep_alive
+        return body
+
+    async def awarmup(self):
+        await self.aget_general_text_embedding("warmup")
+
+    @staticmethod
+    def _parse(response: httpx.Response) -> List[float]:
+        if response.status_code != 200:
+            try:
+                detail = response.json().get("error")
+            except ValueError:
+                detail = response.text
+            raise ValueError(
+                f"Ollama call failed with status code {response.status_code}."
+                f" Details: {detail}"
+            )
+        return response.json()["embedding"]
+
+    def get_general_text_embedding(self, prompt: str) -> List[float]:
+        response = get_http_client().post(
+            f"{self.base_url}/api/embeddings", json=self._request_body(prompt)
+        )
+        return self._parse(response)
+
+    async def aget_general_text_embedding(self, prompt: str) -> List[float]:
+        response = await get_async_http_client().post(
+            f"{self.base_url}/api/embeddings", json=self._request_body(prompt)
+        )
+        return self._parse(response)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self.aget_general_text_embedding(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return await self.aget_general_text_embedding(text)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # One text per request, so send the batch's requests concurrently
+        return await asyncio.gather(
+            *[self.aget_general_text_embedding(text) for text in texts]
+        )
@@ -3,8 +3,20 @@ from typing import Dict
 
 from llama_index.core.settings import Settings
 
+settings_initialized = False
+
 
 def init_settings():
+    """
+    Configure the models once per process. Later calls (e.g. from
+    generate_single_doc inside the API) are no-ops, so they don't replace the
+    gateway, the router and the embedding cache the app is already using.
+    """
+    global settings_initialized
+
+    if settings_initialized:
+        return
+
     model_provider = os.getenv("MODEL_PROVIDER")
     match model_provider:
         case "openai":
@@ -31,21 +43,50 @@ def init_settings():
     Settings.chunk_size = int(os.getenv("CHUNK_SIZE", "1024"))
     Settings.chunk_overlap = int(os.getenv("CHUNK_OVERLAP", "20"))
 
+    from .embedding_cache import init_embedding_cache
+    from .llm_gateway import init_llm_gateway
+
+    init_embedding_cache()
+    init_llm_gateway()
+    settings_initialized = True
+
 
 def init_ollama():
-    from llama_index.embeddings.ollama import OllamaEmbedding
-    from llama_index.llms.ollama.base import DEFAULT_REQUEST_TIMEOUT, Ollama
+    from llama_index.llms.ollama.base import DEFAULT_REQUEST_TIMEOUT
 
-    base_url = os.getenv("OLLAMA_BASE_URL") or "http://127.0.0.1:11434"
+    from .llm_router import parse_endpoints, routed_embedding, routed_llm
+    from .ollama import PooledOllama, PooledOllamaEmbedding
+
+    # Comma separated lists of replicas; embeddings default to the LLM replicas
+    base_urls = parse_endpoints(os.getenv("OLLAMA_BASE_URL")) or [
+        "http://127.0.0.1:11434"
+    ]
+    embedding_base_urls = (
+        parse_endpoints(os.getenv("OLLAMA_EMBEDDING_BASE_URL")) or base_urls
+    )
     request_timeout = float(
         os.getenv("OLLAMA_REQUEST_TIMEOUT", DEFAULT_REQUEST_TIMEOUT)
     )
-    Settings.embed_model = OllamaEmbedding(
-        base_url=base_url,
-        model_name=os.getenv("EMBEDDING_MODEL"),
+    # e.g. "30m", or "-1" to keep the models loaded
+    keep_alive = os.getenv("OLLAMA_KEEP_ALIVE")
+    Settings.embed_model = routed_embedding(
+        embedding_base_urls,
+        lambda base_url: PooledOllamaEmbedding(
+            base_url=base_url,
+            model_name=os.getenv("EMBEDDING_MODEL"),
+            keep_alive=keep_alive,
+        ),
+        health_path="/api/tags",
     )
-    Settings.llm = Ollama(
-        base_url=base_url, model=os.getenv("MODEL"), request_timeout=request_timeout
+    Settings.llm = routed_llm(
+        base_urls,
+        lambda base_url: PooledOllama(
+            base_url=base_url,
+            model=os.getenv("MODEL"),
+            request_timeout=request_timeout,
+            keep_alive=keep_alive,
+        ),
+        health_path="/api/tags",
     )
 
 
@@ -0,0 +1,59 @@
+import importlib
+import logging
+import time
+from contextlib import contextmanager
+from types import ModuleType
+from typing import Dict, Generator, Optional
+
+logger = logging.getLogger("uvicorn")
+
+
+class StartupTimings:
+    """
+    Wall time of each boot phase and of each module imported through
+    `import_module`, reported once the app is ready. Run the process with
+    `python -X importtime` for the breakdown of a single import.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.ready_seconds: Optional[float] = None
+
+    @contextmanager
+    def phase(self, name: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def import_module(self, name: str) -> ModuleType:
+        with self.phase(f"import {name}"):
+            return importlib.import_module(name)
+
+    def complete(self):
+        self.ready_seconds = time.perf_counter() - self._start
+        report = ", ".join(
+            f"{name}={seconds:.2f}s"
+            for name, seconds in sorted(
+                self.phases.items(), key=lambda item: item[1], reverse=True
+            )
+        )
+        logger.info(f"Inicialização concluída em {self.ready_seconds:.2f}s ({report})")
+
+    def stats(self) -> dict:
+        return {"ready_seconds": self.ready_seconds, "phases": dict(self.phases)}
+
+
+startup_timings: Optional[StartupTimings] = None
+
+
+def get_startup_timings() -> StartupTimings:
+    global startup_timings
+
+    if startup_timings is None:
+        startup_timings = StartupTimings()
+    return startup_timings
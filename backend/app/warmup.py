@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, List, Optional, Set
+
+from llama_index.core.settings import Settings
+
+logger = logging.getLogger("uvicorn")
+
+
+def _warmable_models(model: Any) -> List[Any]:
+    """
+    The models that can be warmed up behind the gateway, router and cache
+    wrappers set up by init_settings.
+    """
+    for attribute in ("llm", "embed_model"):
+        inner = getattr(model, attribute, None)
+        if inner is not None and inner is not model:
+            return _warmable_models(inner)
+    nodes = getattr(model, "nodes", None)
+    if isinstance(nodes, list):
+        return [warmable for node in nodes for warmable in _warmable_models(node)]
+    return [model] if hasattr(model, "awarmup") else []
+
+
+class ModelWarmup:
+    """
+    Loads the configured LLM and embedding model on every replica at startup,
+    then pings them periodically so they stay loaded. The instance reports
+    ready once the first warmup succeeded.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        keep_warm_interval: float = 240,
+        retry_interval: float = 5,
+    ):
+        self.enabled = enabled
+        self.keep_warm_interval = keep_warm_interval
+        self.retry_interval = retry_interval
+        self.ready = False
+        self.warmup_seconds: Optional[float] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def models(self) -> List[Any]:
+        return _warmable_models(Settings.llm) + _warmable_models(Settings.embed_model)
+
+    async def awarmup(self) -> bool:
+        results = await asyncio.gather(
+            *[model.awarmup() for model in self.models], return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            logger.warning(f"Falha ao aquecer modelo: {error}")
+        return not errors
+
+    async def _arun(self):
+        start = time.monotonic()
+        while not await self.awarmup():
+            await asyncio.sleep(self.retry_interval)
+        self.warmup_seconds = time.monotonic() - start
+        self.ready = True
+        logger.info(f"Modelos aquecidos em {self.warmup_seconds:.1f}s")
+
+        while self.keep_warm_interval > 0:
+            await asyncio.sleep(self.keep_warm_interval)
+            await self.awarmup()
+
+    def start(self):
+        if not self.enabled or not self.models:
+            self.ready = True
+            return
+        task = asyncio.create_task(self._arun())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def astop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def status(self) -> dict:
+        return {"ready": self.ready, "warmup_seconds": self.warmup_seconds}
+
+
+model_warmup: Optional[ModelWarmup] = None
+
+
+def get_model_warmup() -> ModelWarmup:
+    """
+    Set MODEL_WARMUP=false to report ready without warming up the models, and
+    MODEL_KEEP_WARM_INTERVAL=0 to disable the periodic pings.
+    """
+    global model_warmup
+
+    if model_warmup is None:
+        model_warmup = ModelWarmup(
+            enabled=os.getenv("MODEL_WARMUP", "true").lower() == "true",
+            keep_warm_interval=float(os.getenv("MODEL_KEEP_WARM_INTERVAL", "240")),
+        )
+    return model_warmup
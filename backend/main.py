@@ -2,27 +2,62 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+from app.startup import get_startup_timings
+
+startup_timings = get_startup_timings()
+
+import asyncio
 import logging
 import os
-import uvicorn
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
-from app.api.routers.chat import chat_router
-from app.api.routers.upload import file_upload_router
-from app.api.routers.s3_event import s3_new_document_event_router
-from app.api.routers.feedback import chat_feedback
-from app.api.routers.ocr import ocr_llm_route
-from app.api.routers.general import general_prompt_route
-from app.settings import init_settings
-from app.observability import init_observability
-from fastapi.staticfiles import StaticFiles
-
-
-app = FastAPI()
-
-init_settings()
+from contextlib import asynccontextmanager
+
+with startup_timings.phase("import fastapi"):
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import RedirectResponse
+    from fastapi.staticfiles import StaticFiles
+with startup_timings.phase("import llama_index"):
+    from app.settings import init_settings
+    from app.observability import init_observability, register_stats
+    from app.http_client import aclose_http_clients, init_http_clients
+    from app.llm_router import astop_routers
+    from app.feedback_store import aclose_feedback_store, get_feedback_store
+    from app.warmup import get_model_warmup
+
+
+def router_enabled(name: str) -> bool:
+    return os.getenv(f"ROUTER_{name.upper()}_ENABLED", "true").lower() == "true"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with startup_timings.phase("http_clients"):
+        init_http_clients()
+    if router_enabled("feedback"):
+        with startup_timings.phase("feedback_store"):
+            await asyncio.to_thread(get_feedback_store().start)
+    get_model_warmup().start()
+    startup_timings.complete()
+    yield
+    await get_model_warmup().astop()
+    await astop_routers()
+    await aclose_feedback_store()
+    if router_enabled("chat") or router_enabled("feedback"):
+        # Imported here: app.engine loads the whole engine, which the other
+        # routers don't need
+        from app.engine.chat_store import aclose_chat_store
+
+        await aclose_chat_store()
+    await aclose_http_clients()
+
+
+app = FastAPI(lifespan=lifespan)
+
+with startup_timings.phase("settings"):
+    init_settings()
 init_observability()
+register_stats("startup", startup_timings.stats)
 
 environment = os.getenv("ENVIRONMENT", "dev")  # Default to 'development' if not set
 logging.basicConfig(level=logging.DEBUG)
@@ -58,12 +93,26 @@ mount_static_files("data", "/api/files/data")
 # Mount the output files from tools
 mount_static_files("output", "/api/files/output")
 
-app.include_router(chat_router, prefix="/api/chat")
-app.include_router(file_upload_router, prefix="/api/chat/upload")
-app.include_router(s3_new_document_event_router, prefix="/api/s3_event")
-app.include_router(chat_feedback, prefix="/api/feedback")
-app.include_router(ocr_llm_route, prefix="/api/ocr")
-app.include_router(general_prompt_route, prefix="/api/general")
+# (name, module, router, prefix); set ROUTER_<NAME>_ENABLED=false to skip
+# mounting a router, along with importing its module and dependencies
+routers = [
+    ("chat", "app.api.routers.chat", "chat_router", "/api/chat"),
+    ("upload", "app.api.routers.upload", "file_upload_router", "/api/chat/upload"),
+    ("s3_event", "app.api.routers.s3_event", "s3_new_document_event_router", "/api/s3_event"),
+    ("feedback", "app.api.routers.feedback", "chat_feedback", "/api/feedback"),
+    ("ocr", "app.api.routers.ocr", "ocr_llm_route", "/api/ocr"),
+    ("general", "app.api.routers.general", "general_prompt_route", "/api/general"),
+    ("metrics", "app.api.routers.metrics", "metrics_router", "/api/metrics"),
+    ("health", "app.api.routers.health", "health_router", "/api/health"),
+]
+
+for name, module, router, prefix in routers:
+    if not router_enabled(name):
+        logger.info(f"Rota {prefix} desativada")
+        continue
+    app.include_router(
+        getattr(startup_timings.import_module(module), router), prefix=prefix
+    )
 
 if __name__ == "__main__":
     app_host = os.getenv("APP_HOST", "0.0.0.0")
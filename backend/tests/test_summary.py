@@ -0,0 +1,123 @@
+import asyncio
+
+import fakeredis
+import fakeredis.aioredis
+import pytest
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from app.engine.chat_store import PooledRedisChatStore
+from app.engine.summary import ConversationSummarizer, SummarizingChatMemory
+
+
+class SummaryLLM:
+    async def apredict(self, prompt, **kwargs) -> str:
+        return "resumo"
+
+
+def turns(count: int):
+    return [
+        ChatMessage(
+            role=MessageRole.USER if i % 2 == 0 else MessageRole.ASSISTANT,
+            content=f"mensagem {i}",
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.fixture
+def memory():
+    server = fakeredis.FakeServer()
+    store = PooledRedisChatStore()
+    store._client = fakeredis.FakeRedis(server=server)
+    store._aclient = fakeredis.aioredis.FakeRedis(server=server)
+    return SummarizingChatMemory.from_defaults(
+        token_limit=1000,
+        chat_store=store,
+        chat_store_key="conversa",
+        tokenizer_fn=str.split,
+    )
+
+
+def interleave_before_writes(monkeypatch, client, work):
+    """
+    Run `work` once an aset has read the stored state, right before its
+    writes reach Redis.
+    """
+    pending = [work]
+    pipeline = client.pipeline
+    created = []
+
+    def interleaved_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        created.append(pipe)
+        if len(created) == 1:
+            # The reads
+            return pipe
+
+        def interleaved(method):
+            async def run(*args, **kwargs):
+                if pending:
+                    await pending.pop()()
+                return await method(*args, **kwargs)
+
+            return run
+
+        pipe.watch = interleaved(pipe.watch)
+        pipe.execute = interleaved(pipe.execute)
+        return pipe
+
+    monkeypatch.setattr(client, "pipeline", interleaved_pipeline)
+
+
+def stored(memory: SummarizingChatMemory):
+    client = memory._client
+    messages = memory._decode_messages(client.lrange(memory.chat_store_key, 0, -1))
+    return [message.content for message in messages], client.llen(memory._tokens_key)
+
+
+def test_aset_interleaved_with_acompact(memory, monkeypatch):
+    history = turns(6)
+    summarizer = ConversationSummarizer(threshold=0, keep_tokens=4, llm=SummaryLLM())
+
+    async def run():
+        await memory.aset(history)
+        # The last answer is regenerated while the history is being compacted
+        regenerated = [*history[:5], ChatMessage(role=MessageRole.ASSISTANT, content="outra")]
+        interleave_before_writes(
+            monkeypatch, memory._aclient, lambda: summarizer.acompact(memory)
+        )
+        await memory.aset(regenerated)
+
+    asyncio.run(run())
+
+    assert summarizer.stats()["compacted"] == 1
+    contents, tokens = stored(memory)
+    assert contents == [
+        memory._summary_message("resumo").content,
+        "mensagem 4",
+        "outra",
+    ]
+    assert tokens == len(contents)
+    assert [message.content for message in memory.get_all()] == contents
+
+
+def test_acompact_after_aset_keeps_history(memory):
+    history = turns(6)
+    summarizer = ConversationSummarizer(threshold=0, keep_tokens=4, llm=SummaryLLM())
+
+    async def run():
+        await memory.aset(history)
+        await summarizer.acompact(memory)
+        await memory.aset([*history, *turns(8)[6:]])
+
+    asyncio.run(run())
+
+    contents, tokens = stored(memory)
+    assert contents == [
+        memory._summary_message("resumo").content,
+        "mensagem 4",
+        "mensagem 5",
+        "mensagem 6",
+        "mensagem 7",
+    ]
+    assert tokens == len(contents)